@@ -0,0 +1,473 @@
+# region COPYRIGHT
+
+# Copyright © 2025 [MinerMouse]
+# Luogu UID:1203704
+# Portions Copyright © 2025 ILoveScratch2
+
+# endregion
+
+# benchmark.py
+
+"""服务器压力测试
+
+在本机 (127.0.0.1) 启动服务器并模拟大量客户端。客户端全部注册后分散到 rooms 个房间，
+其中 senders 个客户端每秒各执行 rate 次操作，每次按 --mix 的权重随机选择一种:
+
+- message: 在当前房间发言
+- dm: 私聊一个随机用户
+- file: 分块上传一个 file_size 字节的文件 (房间内的其他人收到 file_shared)
+- join: 换到另一个房间
+- reconnect: 断开后重新连接并注册
+
+统计各类消息的送达数、送达延迟 (p50/p99/p999)、吞吐量以及服务器进程的内存和 CPU 占用。
+客户端分布在 load_procs 个进程中 (为 0 时在本进程内运行)，避免压测端本身成为瓶颈。
+依次测试 --workers 中的每个 worker 数；--json 保存结果，--compare 与之前保存的结果对比。
+
+    python benchmark.py --workers 1 2 4 --clients 2000 --rooms 20 --senders 200 --rate 5 --json result.json
+    python benchmark.py --mix message=80,dm=10,file=2,join=4,reconnect=4 --compare result.json
+"""
+
+import argparse, asyncio, configparser, json, math, multiprocessing, os, random, tempfile, time, uuid
+from collections import Counter
+import websockets
+import server, tuning
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+ACTIONS = ("message", "dm", "file", "join", "reconnect")
+# 统计延迟的操作: 消息/私聊/文件为发送到送达，reconnect 为连接到收到 api_version
+TIMED = ("message", "dm", "file", "reconnect")
+
+# 延迟直方图: 从 10 微秒开始，每个桶比上一个大 5%，各进程的结果可以直接相加
+HIST_BASE = 1e-5
+HIST_RATIO = math.log(1.05)
+HIST_BUCKETS = 400
+
+
+def hist_add(hist, seconds):
+    index = int(math.log(max(seconds, HIST_BASE) / HIST_BASE) / HIST_RATIO)
+    hist[min(index, HIST_BUCKETS - 1)] += 1
+
+
+def hist_quantile(hist, q):
+    """返回第 q 分位数所在桶的上界 (毫秒)"""
+    total = sum(hist)
+    if not total:
+        return None
+    seen = 0
+    for index, count in enumerate(hist):
+        seen += count
+        if seen >= q * total:
+            return HIST_BASE * math.exp((index + 1) * HIST_RATIO) * 1000
+
+
+def raise_fd_limit():
+    """数千个连接会超过默认的文件描述符限制"""
+    if resource is not None:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def run_server(port, workers, root, overrides):
+    os.chdir(root)
+    raise_fd_limit()
+    cfg = configparser.ConfigParser()
+    cfg.read_dict({"HISTORY": {"enabled": "false"}, "BUS": {"backend": "local", "path": ""}})
+    cfg.read_dict(overrides)
+    if workers > 1:
+        tuning.run(server.run_workers("127.0.0.1", port, "", cfg, workers), cfg)
+    else:
+        tuning.run(server.ChatServer("127.0.0.1", port, "", cfg).run(), cfg)
+
+
+def process_tree(pid):
+    """pid 及其所有子进程"""
+    pids = [pid]
+    for p in pids:
+        try:
+            with open(f"/proc/{p}/task/{p}/children") as f:
+                pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+def server_usage(pid):
+    """服务器进程树的内存 (MB) 和 CPU 时间 (秒)，读取不到 /proc 时 (非 Linux) 返回 None"""
+    usage = {"rss_mb": 0.0, "peak_rss_mb": 0.0, "cpu_s": 0.0}
+    try:
+        for p in process_tree(pid):
+            with open(f"/proc/{p}/status") as f:
+                status = dict(line.split(":", 1) for line in f if ":" in line)
+            usage["rss_mb"] += int(status["VmRSS"].split()[0]) / 1024
+            usage["peak_rss_mb"] += int(status["VmHWM"].split()[0]) / 1024
+            with open(f"/proc/{p}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            usage["cpu_s"] += (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, KeyError, ValueError):
+        return None
+    return usage
+
+
+async def wait_ready(url, timeout=30):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            async with websockets.connect(url):
+                return
+        except OSError:
+            if time.time() > deadline:
+                raise
+            await asyncio.sleep(0.2)
+
+
+def room_of(index, rooms):
+    r = index % rooms
+    return f"bench-{r}" if r else "global"
+
+
+async def create_rooms(url, rooms):
+    """用一个管理连接预先创建 global 以外的房间"""
+    async with websockets.connect(url) as ws:
+        await ws.send(json.dumps({"type": "register", "username": "bench-admin"}))
+        for r in range(1, rooms):
+            await ws.send(json.dumps({"type": "create_room", "room_id": room_of(r, rooms),
+                                      "room_name": room_of(r, rooms)}))
+        # 等到前面的消息都处理完
+        await ws.send(json.dumps({"type": "get_users"}))
+        while json.loads(await ws.recv()).get("type") != "user_list":
+            pass
+
+
+class LoadClient:
+    """一个模拟客户端，断线或选中 reconnect 时重新连接，直到测试结束"""
+
+    def __init__(self, index, load):
+        self.index = index
+        self.load = load
+        self.username = f"bench{index}"
+        self.room = room_of(index, load.rooms)
+        self.ws = None
+        self.connected_at = None
+        self.uploads = {}                # upload_id -> 文件内容
+
+    async def run(self):
+        while time.time() < self.load.end:
+            try:
+                await self.session()
+            except (OSError, asyncio.TimeoutError, websockets.WebSocketException):
+                self.load.stats["errors"] += 1
+                await asyncio.sleep(0.5)
+
+    async def session(self):
+        load = self.load
+        self.connected_at = time.time() if load.measuring() else None
+        async with websockets.connect(load.url, max_queue=None, open_timeout=60) as ws:
+            self.ws = ws
+            await ws.send(json.dumps({"type": "register", "username": self.username, "presence": "delta"}))
+            if self.room != "global":
+                await ws.send(json.dumps({"type": "join_room", "room_id": self.room}))
+            sender = asyncio.create_task(self.act()) if self.index < load.senders else None
+            try:
+                await self.receive(sender)
+            finally:
+                if sender:
+                    sender.cancel()
+
+    async def receive(self, sender):
+        """处理收到的消息，直到测试结束或发送者要求重新连接"""
+        load = self.load
+        recv = None
+        try:
+            while (left := load.end - time.time()) > 0:
+                if recv is None:
+                    recv = asyncio.ensure_future(self.ws.recv())
+                done, _ = await asyncio.wait({recv, sender} - {None}, timeout=left,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if sender in done:
+                    if sender.result():
+                        return
+                    sender = None
+                if recv not in done:
+                    continue
+                raw, recv = recv.result(), None
+                if isinstance(raw, str):
+                    await self.on_message(json.loads(raw))
+        finally:
+            if recv is not None:
+                recv.cancel()
+
+    async def on_message(self, data):
+        load = self.load
+        kind = data.get("type")
+        if kind == "file_upload_ready":
+            content = self.uploads.pop(data["upload_id"], None)
+            if content is not None:
+                offset = data["offset"]
+                await self.ws.send(server.CHUNK_HEADER.pack(bytes.fromhex(data["upload_id"]), offset)
+                                   + content[offset:])
+            return
+        if not load.measuring():
+            return
+        now = time.time()
+        # 发送时间戳放在消息内容 (文件则是文件名) 的开头: "b|时间戳|..."
+        if kind == "message" and data["content"].startswith("b|"):
+            load.delivered("message", now - float(data["content"].split("|")[1]))
+        elif kind == "private_message" and data["content"].startswith("b|"):
+            load.delivered("dm", now - float(data["content"].split("|")[1]))
+        elif kind == "file_shared" and data["filename"].startswith("b|"):
+            load.delivered("file", now - float(data["filename"].split("|")[1]))
+        elif kind == "api_version" and self.connected_at is not None:
+            load.delivered("reconnect", now - self.connected_at)
+            self.connected_at = None
+
+    async def act(self):
+        """按 rate 执行随机操作，返回 True 表示要重新连接"""
+        load = self.load
+        await asyncio.sleep(max(0, load.start_at - time.time()) + random.random() / load.rate)
+        while time.time() < load.end:
+            action = random.choices(ACTIONS, load.weights)[0]
+            stamp = f"b|{time.time():.6f}|"
+            if action == "message":
+                await self.ws.send(json.dumps({"type": "message", "content": stamp.ljust(load.message_size, "x")}))
+            elif action == "dm":
+                await self.ws.send(json.dumps({"type": "private_message",
+                                               "target": f"bench{random.randrange(load.clients)}",
+                                               "content": stamp.ljust(load.message_size, "x")}))
+            elif action == "file":
+                upload_id = uuid.uuid4().hex
+                self.uploads[upload_id] = os.urandom(load.file_size)
+                await self.ws.send(json.dumps({"type": "file_upload_start", "upload_id": upload_id,
+                                               "filename": f"{stamp}{self.index}.bin", "size": load.file_size}))
+            elif action == "join":
+                self.room = room_of(random.randrange(load.rooms), load.rooms)
+                await self.ws.send(json.dumps({"type": "join_room", "room_id": self.room}))
+            if load.measuring():
+                load.stats["sent"][action] += 1
+            if action == "reconnect":
+                return True
+            await asyncio.sleep(1 / load.rate)
+        return False
+
+
+class Load:
+    """一个压测进程内的全部客户端及其统计"""
+
+    def __init__(self, url, clients, senders, rooms, rate, weights, start_at, duration,
+                 message_size=64, file_size=65536):
+        self.url = url
+        self.clients = clients
+        self.senders = senders
+        self.rooms = rooms
+        self.rate = rate
+        self.weights = weights
+        self.start_at = start_at
+        self.end = start_at + duration
+        self.message_size = message_size
+        self.file_size = file_size
+        self.stats = new_stats()
+
+    def measuring(self):
+        return self.start_at <= time.time() < self.end
+
+    def delivered(self, action, latency):
+        self.stats["delivered"][action] += 1
+        hist_add(self.stats["hist"][action], latency)
+
+    async def run(self, indexes):
+        await asyncio.gather(*(LoadClient(i, self).run() for i in indexes))
+        return self.stats
+
+
+def new_stats():
+    return {"sent": Counter(), "delivered": Counter(), "errors": 0,
+            "hist": {action: [0] * HIST_BUCKETS for action in TIMED}}
+
+
+def run_load(url, first, count, options, results):
+    """一个压测进程: 负责编号 first ~ first+count-1 的客户端"""
+    raise_fd_limit()
+    load = Load(url, **options)
+    results.put(asyncio.run(load.run(range(first, first + count))))
+
+
+def merge(parts):
+    total = new_stats()
+    for part in parts:
+        total["sent"].update(part["sent"])
+        total["delivered"].update(part["delivered"])
+        total["errors"] += part["errors"]
+        for action, hist in part["hist"].items():
+            total["hist"][action] = [a + b for a, b in zip(total["hist"][action], hist)]
+    return total
+
+
+def bench(workers, args, port):
+    ctx = multiprocessing.get_context("spawn")
+    root = tempfile.mkdtemp(prefix="touchfox-bench-")
+    srv = ctx.Process(target=run_server, args=(port, workers, root, args.overrides), daemon=False)
+    srv.start()
+    url = f"ws://127.0.0.1:{port}"
+    try:
+        asyncio.run(wait_ready(url))
+        asyncio.run(create_rooms(url, args.rooms))
+        # 留出建立连接的时间
+        start_at = time.time() + args.warmup
+        options = {"clients": args.clients, "senders": args.senders, "rooms": args.rooms, "rate": args.rate,
+                   "weights": [args.mix.get(action, 0) for action in ACTIONS], "start_at": start_at,
+                   "duration": args.duration, "message_size": args.message_size, "file_size": args.file_size}
+        usage_start = None
+        if args.load_procs == 0:
+            raise_fd_limit()
+
+            async def in_process():
+                nonlocal usage_start
+                task = asyncio.create_task(Load(url, **options).run(range(args.clients)))
+                await asyncio.sleep(max(0, start_at - time.time()))
+                usage_start = server_usage(srv.pid)
+                return await task
+
+            parts = [asyncio.run(in_process())]
+        else:
+            results = ctx.Queue()
+            per_proc = -(-args.clients // args.load_procs)
+            loads = []
+            for first in range(0, args.clients, per_proc):
+                p = ctx.Process(target=run_load, args=(url, first, min(per_proc, args.clients - first),
+                                                        options, results))
+                p.start()
+                loads.append(p)
+            time.sleep(max(0, start_at - time.time()))
+            usage_start = server_usage(srv.pid)
+            parts = [results.get() for _ in loads]
+            for p in loads:
+                p.join()
+        usage_end = server_usage(srv.pid)
+    finally:
+        srv.terminate()
+        srv.join()
+
+    total = merge(parts)
+    result = {
+        "server_version": server.SERVER_VERSION,
+        "workers": workers,
+        "clients": args.clients,
+        "senders": args.senders,
+        "rooms": args.rooms,
+        "rate": args.rate,
+        "mix": args.mix,
+        "duration": args.duration,
+        "config": args.overrides,
+        "sent_per_s": {k: v / args.duration for k, v in total["sent"].items()},
+        "delivered_per_s": {k: v / args.duration for k, v in total["delivered"].items()},
+        "latency_ms": {
+            action: {"count": sum(hist), "p50": hist_quantile(hist, 0.5),
+                     "p99": hist_quantile(hist, 0.99), "p999": hist_quantile(hist, 0.999)}
+            for action, hist in total["hist"].items() if sum(hist)
+        },
+        "errors": total["errors"],
+        "server": None,
+    }
+    if usage_start and usage_end:
+        result["server"] = {"rss_mb": usage_end["rss_mb"], "peak_rss_mb": usage_end["peak_rss_mb"],
+                            "cpu_percent": (usage_end["cpu_s"] - usage_start["cpu_s"]) * 100 / args.duration}
+    return result
+
+
+def report(result, previous=None):
+    """打印一轮测试的结果，previous 为之前保存的相同 worker 数的结果"""
+    old = previous or {}
+
+    def change(new, before):
+        return f" ({(new - before) * 100 / before:+.0f}%)" if before and new is not None else ""
+
+    print(f"\n== workers: {result['workers']}，服务器 V{result['server_version']} ==")
+    sent = sum(result["sent_per_s"].values())
+    delivered = sum(result["delivered_per_s"].values())
+    print(f"操作/s: {sent:.0f}{change(sent, sum(old.get('sent_per_s', {}).values()))}  "
+          f"送达/s: {delivered:.0f}{change(delivered, sum(old.get('delivered_per_s', {}).values()))}  "
+          f"错误: {result['errors']}")
+    print(f"{'类型':>10} {'操作/s':>9} {'送达/s':>10} {'p50 ms':>9} {'p99 ms':>9} {'p999 ms':>9}")
+    for action in ACTIONS:
+        latency = result["latency_ms"].get(action, {})
+        if action not in result["sent_per_s"] and not latency:
+            continue
+        quantiles = " ".join(f"{latency[q]:>9.1f}" if latency.get(q) else f"{'-':>9}"
+                             for q in ("p50", "p99", "p999"))
+        old_p99 = old.get("latency_ms", {}).get(action, {}).get("p99")
+        print(f"{action:>10} {result['sent_per_s'].get(action, 0):>9.0f} "
+              f"{result['delivered_per_s'].get(action, 0):>10.0f} {quantiles}{change(latency.get('p99'), old_p99)}")
+    if result["server"]:
+        usage, old_usage = result["server"], old.get("server") or {}
+        print(f"服务器内存: {usage['rss_mb']:.0f}MB (峰值 {usage['peak_rss_mb']:.0f}MB)"
+              f"{change(usage['peak_rss_mb'], old_usage.get('peak_rss_mb'))}  "
+              f"CPU: {usage['cpu_percent']:.0f}%{change(usage['cpu_percent'], old_usage.get('cpu_percent'))}")
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(","):
+        action, _, weight = item.partition("=")
+        if action.strip() not in ACTIONS:
+            raise argparse.ArgumentTypeError(f"未知的操作 {action}，可选: {', '.join(ACTIONS)}")
+        mix[action.strip()] = float(weight or 1)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TouchFox 服务器压力测试")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1], help="要测试的 worker 数")
+    parser.add_argument("--clients", type=int, default=200, help="客户端连接数")
+    parser.add_argument("--senders", type=int, default=20, help="其中执行操作的连接数")
+    parser.add_argument("--rate", type=float, default=10, help="每个发送者每秒的操作数")
+    parser.add_argument("--rooms", type=int, default=1, help="房间数 (含全局聊天室)")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("message=90,dm=8,join=1,reconnect=1"),
+                        help="操作权重，例如 message=80,dm=10,file=2,join=4,reconnect=4")
+    parser.add_argument("--message-size", type=int, default=64, help="消息内容的字节数")
+    parser.add_argument("--file-size", type=int, default=65536, help="上传文件的字节数")
+    parser.add_argument("--duration", type=float, default=10, help="每轮测试的秒数")
+    parser.add_argument("--warmup", type=float, default=5, help="建立连接的等待秒数")
+    parser.add_argument("--load-procs", type=int, default=max(1, os.cpu_count() // 2),
+                        help="压测进程数，0 为在本进程内运行")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--set", action="append", default=[], metavar="SECTION.key=value",
+                        help="覆盖服务器配置，例如 --set TUNING.uvloop=true，可重复")
+    parser.add_argument("--json", metavar="PATH", help="把结果保存为 JSON")
+    parser.add_argument("--compare", metavar="PATH", help="与之前用 --json 保存的结果对比")
+    args = parser.parse_args()
+    args.overrides = {}
+    for item in args.set:
+        key, _, value = item.partition("=")
+        section, _, option = key.partition(".")
+        if not option:
+            parser.error(f"无效的 --set 参数: {item}")
+        args.overrides.setdefault(section, {})[option] = value
+    if not 0 < args.senders <= args.clients:
+        parser.error("--senders 应在 1 到 --clients 之间")
+
+    previous = {}
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            previous = {r["workers"]: r for r in json.load(f)["results"]}
+
+    print(f"CPU 核心数: {os.cpu_count()}，客户端: {args.clients}，房间: {args.rooms}，"
+          f"发送: {args.senders} x {args.rate}/s，操作权重: {args.mix}")
+    if args.set:
+        print(f"配置: {' '.join(args.set)}")
+    results = []
+    for i, workers in enumerate(args.workers):
+        result = bench(workers, args, args.port + i)
+        results.append(result)
+        report(result, previous.get(workers))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "cpu_count": os.cpu_count(),
+                       "results": results}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+# region COPYRIGHT
+
+# Copyright © 2025 [MinerMouse]
+# Luogu UID:1203704
+# Portions Copyright © 2025 ILoveScratch2
+
+# endregion
+
+# bus.py
+
+"""多进程模式下 worker 之间的消息总线
+
+每条总线消息是一个 dict: {"op": 操作, "worker": 发送方编号, ...}，发送方自己不会收到。
+
+- local: 主进程运行 BusHub，监听一个 Unix domain socket，把每个 worker 发来的消息
+  转发给其他所有 worker；某个 worker 断开时广播 worker_down
+- redis: 通过 Redis (或兼容的服务) 的 pub/sub 频道交换消息，需要安装 redis 包
+"""
+
+import asyncio, json, logging, struct
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+BUS_BACKENDS = ("local", "redis")
+
+# 本机总线的帧: 4字节长度 + JSON
+FRAME = struct.Struct("!I")
+
+
+def _frame(message):
+    data = json.dumps(message, ensure_ascii=False).encode()
+    return FRAME.pack(len(data)) + data
+
+
+async def _read_frame(reader):
+    (size,) = FRAME.unpack(await reader.readexactly(FRAME.size))
+    return json.loads(await reader.readexactly(size))
+
+
+class BusHub:
+    """本机总线的中转站，运行在主进程中"""
+
+    def __init__(self, path):
+        self.path = path
+        self.writers = {}                # StreamWriter -> worker 编号
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_unix_server(self._handle, self.path)
+
+    async def close(self):
+        if self.server:
+            self.server.close()
+            for writer in list(self.writers):
+                writer.close()
+            await self.server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        worker = None
+        try:
+            # 第一帧声明 worker 编号
+            worker = (await _read_frame(reader))["worker"]
+            self.writers[writer] = worker
+            while True:
+                (size,) = FRAME.unpack(await reader.readexactly(FRAME.size))
+                # 原样转发，不需要解析
+                frame = FRAME.pack(size) + await reader.readexactly(size)
+                for other in self.writers:
+                    if other is not writer:
+                        other.write(frame)
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self.writers.pop(writer, None)
+            writer.close()
+            if worker is not None:
+                logging.warning(f"worker {worker} 已断开总线连接")
+                down = _frame({"op": "worker_down", "worker": worker})
+                for other in self.writers:
+                    other.write(down)
+
+
+class LocalBus:
+    """连接到 BusHub 的 worker 端"""
+
+    # 各 worker 共用同一个聊天记录数据库
+    shared_storage = True
+
+    def __init__(self, path, worker):
+        self.path = path
+        self.worker = worker
+        self.writer = None
+        self.task = None
+
+    async def connect(self, on_message):
+        """连接总线，收到的消息按顺序交给 await on_message(message) 处理"""
+        reader, self.writer = await asyncio.open_unix_connection(self.path)
+        self.writer.write(_frame({"worker": self.worker}))
+        self.task = asyncio.create_task(self._reader(reader, on_message))
+
+    def publish(self, message):
+        message["worker"] = self.worker
+        self.writer.write(_frame(message))
+
+    async def _reader(self, reader, on_message):
+        try:
+            while True:
+                await on_message(await _read_frame(reader))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logging.error("总线连接已断开")
+
+    async def wait_closed(self):
+        """等待总线连接断开 (主进程退出)"""
+        await asyncio.shield(self.task)
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+        if self.writer:
+            self.writer.close()
+
+
+class RedisBus:
+    """通过 Redis pub/sub 频道交换消息"""
+
+    # 各 worker 共用同一个聊天记录数据库
+    shared_storage = True
+
+    def __init__(self, url, worker, channel="touchfox"):
+        self.url = url
+        self.worker = worker
+        self.channel = channel
+        self.outbox = asyncio.Queue()    # 保证发布顺序
+        self.redis = None
+        self.tasks = []
+
+    async def connect(self, on_message):
+        self.redis = aioredis.from_url(self.url)
+        pubsub = self.redis.pubsub()
+        await pubsub.subscribe(self.channel)
+        self.tasks = [asyncio.create_task(self._reader(pubsub, on_message)),
+                      asyncio.create_task(self._sender())]
+
+    def publish(self, message):
+        message["worker"] = self.worker
+        self.outbox.put_nowait(json.dumps(message, ensure_ascii=False))
+
+    async def _sender(self):
+        while True:
+            await self.redis.publish(self.channel, await self.outbox.get())
+
+    async def wait_closed(self):
+        await asyncio.shield(self.tasks[0])
+
+    async def _reader(self, pubsub, on_message):
+        async for item in pubsub.listen():
+            if item["type"] != "message":
+                continue
+            message = json.loads(item["data"])
+            if message.get("worker") != self.worker:
+                await on_message(message)
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        if self.redis:
+            await self.redis.aclose()
+
+
+def make_bus(cfg, worker):
+    """按 [BUS] 配置创建总线"""
+    backend = cfg.get("BUS", "backend", fallback="local")
+    if backend not in BUS_BACKENDS:
+        logging.warning(f"未知的总线类型 {backend}，使用 local")
+        backend = "local"
+    if backend == "redis":
+        if aioredis is None:
+            raise RuntimeError("未安装 redis，无法使用 redis 总线")
+        return RedisBus(cfg.get("BUS", "url", fallback="redis://localhost:6379/0"), worker,
+                        cfg.get("BUS", "channel", fallback="touchfox"))
+    return LocalBus(cfg.get("BUS", "path"), worker)
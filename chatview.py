@@ -0,0 +1,313 @@
+# region COPYRIGHT
+
+# Copyright © 2025 [MinerMouse]
+# Luogu UID:1203704
+# Portions Copyright © 2025 ILoveScratch2
+
+# endregion
+
+# chatview.py
+
+"""聊天记录视图 (client.ini 的 [CHAT] 段)
+
+消息保存在 ChatModel 中，QListView 只绘制可见的几条: 每条消息在第一次显示时才排版，
+排好版的 QTextDocument 只缓存最近用到的 cache 条，行高单独缓存，窗口宽度、字体或主题
+变化时重新计算。追加一条消息只排版这一条，耗时与已有的消息数无关。
+
+停留在最新消息处时最多保留 scrollback 条，超出的最早消息被丢弃；向上翻看时暂不丢弃，
+回到底部后再裁剪。滚动到顶部时发出 need_older，由 ChatWindow 向服务器请求更早的一页
+聊天记录插入到开头。
+
+- scrollback: 停留在最新消息处时保留的消息条数
+- cache: 缓存排版结果的消息条数
+"""
+
+import itertools, math
+from collections import OrderedDict
+from PySide6.QtWidgets import QAbstractItemView, QApplication, QListView, QStyle, QStyledItemDelegate
+from PySide6.QtCore import QAbstractListModel, QModelIndex, QPointF, QRectF, QSize, Qt, QEvent, Signal
+from PySide6.QtGui import QColor, QKeySequence, QPainter, QTextDocument, QTextDocumentFragment
+
+SECTION = "CHAT"
+
+# 气泡样式: 消息种类 -> (背景和边框的 RGB, 标题颜色)
+STYLES = {
+    "self": ((66, 133, 244), "#1565C0"),        # 自己发送的消息，深蓝色标题
+    "other": ((102, 187, 106), "#2E7D32"),      # 他人发送的消息，深绿色标题
+    "owner": ((102, 187, 106), "white"),        # 房主发送的消息，白色名字
+    "broadcast": ((255, 193, 7), "#FFA000"),    # 房主广播，橙色标题
+    "priv_sent": ((255, 112, 67), "#E65100"),   # 自己发送的私聊
+    "priv_recv": ((156, 39, 176), "#6A1B9A"),   # 接收的私聊
+    "sys": ((158, 158, 158), None),             # 系统消息
+}
+
+PAD_X, PAD_Y = 14, 10                           # 气泡内边距
+MARGIN = 6                                      # 气泡外边距
+RADIUS = 12
+
+
+class ChatModel(QAbstractListModel):
+    """按时间顺序排列的消息
+
+    每条消息是一个字典: kind (STYLES 中的种类)、title (标题，系统消息为 None)、
+    body (HTML 内容)、id (服务器聊天记录中的 id，没有时为 None)，加入时再写入唯一的 key。
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.entries = []
+        self.trimmed_id = None           # 被裁剪掉的消息中最大的 id
+        self.keys = itertools.count()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.entries)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and index.isValid():
+            entry = self.entries[index.row()]
+            return entry["title"] or entry["body"]
+        return None
+
+    def append(self, entry):
+        entry["key"] = next(self.keys)
+        row = len(self.entries)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.entries.append(entry)
+        self.endInsertRows()
+
+    def prepend(self, entries):
+        if not entries:
+            return
+        for entry in entries:
+            entry["key"] = next(self.keys)
+        self.beginInsertRows(QModelIndex(), 0, len(entries) - 1)
+        self.entries[:0] = entries
+        self.endInsertRows()
+
+    def trim(self, limit):
+        """丢弃最早的消息，只保留 limit 条，返回丢弃的消息中是否有服务器聊天记录中的消息"""
+        extra = len(self.entries) - limit
+        if extra <= 0:
+            return False
+        dropped = [entry["id"] for entry in self.entries[:extra] if entry["id"] is not None]
+        self.beginRemoveRows(QModelIndex(), 0, extra - 1)
+        del self.entries[:extra]
+        self.endRemoveRows()
+        if dropped:
+            self.trimmed_id = max(dropped + [self.trimmed_id or 0])
+        return bool(dropped)
+
+    def clear(self):
+        self.beginResetModel()
+        self.entries = []
+        self.trimmed_id = None
+        self.endResetModel()
+
+    def ids(self):
+        return {entry["id"] for entry in self.entries if entry["id"] is not None}
+
+    def oldest_id(self):
+        """向前翻页的位置: 最早一条有 id 的消息；剩下的消息都没有 id 时从被丢弃的消息之后开始"""
+        for entry in self.entries:
+            if entry["id"] is not None:
+                return entry["id"]
+        return None if self.trimmed_id is None else self.trimmed_id + 1
+
+
+class ChatDelegate(QStyledItemDelegate):
+    """把消息画成圆角气泡，排版结果按消息 key 缓存"""
+
+    def __init__(self, view, cache=200):
+        super().__init__(view)
+        self.view = view
+        self.cache = cache
+        self.docs = OrderedDict()        # key -> 排好版的 QTextDocument (最近用到的在末尾)
+        self.heights = {}                # key -> 行高
+        self.width = 0
+
+    def reset(self):
+        self.docs.clear()
+        self.heights.clear()
+
+    def forget(self, keys):
+        for key in keys:
+            self.docs.pop(key, None)
+            self.heights.pop(key, None)
+
+    def _check_width(self):
+        width = self.view.viewport().width()
+        if width != self.width:
+            self.width = width
+            self.reset()
+
+    def document(self, entry):
+        key = entry["key"]
+        doc = self.docs.get(key)
+        if doc is not None:
+            self.docs.move_to_end(key)
+            return doc
+        doc = QTextDocument()
+        doc.setDocumentMargin(0)
+        doc.setDefaultFont(self.view.font())
+        doc.setHtml(self.view.entry_html(entry))
+        # 气泡最多占视图宽度的 70% (系统消息 60%)，短消息按内容收窄
+        limit = max(80, int(self.width * (0.6 if entry["kind"] == "sys" else 0.7)) - 2 * PAD_X)
+        doc.setTextWidth(limit)
+        doc.setTextWidth(min(limit, math.ceil(doc.idealWidth())))
+        self.docs[key] = doc
+        while len(self.docs) > self.cache:
+            self.docs.popitem(last=False)
+        return doc
+
+    def sizeHint(self, option, index):
+        self._check_width()
+        entry = self.view.chat_model.entries[index.row()]
+        height = self.heights.get(entry["key"])
+        if height is None:
+            height = math.ceil(self.document(entry).size().height()) + 2 * (PAD_Y + MARGIN)
+            self.heights[entry["key"]] = height
+        return QSize(self.width, height)
+
+    def paint(self, painter, option, index):
+        self._check_width()
+        entry = self.view.chat_model.entries[index.row()]
+        doc = self.document(entry)
+        rgb, _ = STYLES[entry["kind"]]
+        fill, border = (38, 77) if entry["kind"] == "sys" else (64, 128)
+        rect = QRectF(option.rect.left() + MARGIN, option.rect.top() + MARGIN,
+                      doc.textWidth() + 2 * PAD_X, doc.size().height() + 2 * PAD_Y)
+        painter.save()
+        painter.setRenderHint(QPainter.Antialiasing)
+        if option.state & QStyle.State_Selected:
+            highlight = QColor(option.palette.highlight().color())
+            highlight.setAlpha(60)
+            painter.fillRect(option.rect, highlight)
+        painter.setPen(QColor(*rgb, border))
+        painter.setBrush(QColor(*rgb, fill))
+        painter.drawRoundedRect(rect, RADIUS, RADIUS)
+        painter.translate(rect.topLeft() + QPointF(PAD_X, PAD_Y))
+        doc.drawContents(painter)
+        painter.restore()
+
+
+class ChatView(QListView):
+    need_older = Signal(object)          # 参数为当前最早一条消息的 id
+
+    def __init__(self, scrollback=2000, cache=200, parent=None):
+        super().__init__(parent)
+        self.scrollback = scrollback
+        self.text_color = "#E0E0E0"
+        self.sys_color = "#9E9E9E"
+        self.following = True            # 是否停留在最新消息处
+        self.has_older = False           # 服务器上是否还有更早的消息
+        self.loading_older = False
+        self.chat_model = ChatModel(self)
+        self.setModel(self.chat_model)
+        self.delegate = ChatDelegate(self, cache)
+        self.setItemDelegate(self.delegate)
+        self.setVerticalScrollMode(QAbstractItemView.ScrollPerPixel)
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.setSelectionMode(QAbstractItemView.ExtendedSelection)
+        self.setResizeMode(QListView.Adjust)
+        self.chat_model.rowsAboutToBeRemoved.connect(self.on_rows_removed)
+        self.verticalScrollBar().valueChanged.connect(self.on_scroll)
+
+    # ---------- 内容 ----------
+    def entry_html(self, entry):
+        if entry["kind"] == "sys":
+            return f'<i><span style="color: {self.sys_color};">{entry["body"]}</span></i>'
+        title_color = STYLES[entry["kind"]][1]
+        return (f'<span style="font-weight: bold; color: {title_color};">{entry["title"]}</span><br>'
+                f'<span style="color: {self.text_color};">{entry["body"]}</span>')
+
+    def entry_text(self, entry):
+        text = QTextDocumentFragment.fromHtml(entry["body"]).toPlainText()
+        return f"{entry['title']}\n{text}" if entry["title"] else text
+
+    def add_entry(self, entry):
+        self.chat_model.append(entry)
+        if self.following:
+            self.trim()
+            self.scrollToBottom()
+
+    def trim(self):
+        # 丢弃的消息可以再从服务器取回
+        if self.chat_model.trim(self.scrollback):
+            self.has_older = True
+
+    def prepend_older(self, entries, has_more):
+        """插入服务器返回的更早一页消息，保持当前看到的位置不动"""
+        self.loading_older = False
+        self.has_older = has_more
+        if not entries:
+            return
+        bar = self.verticalScrollBar()
+        from_bottom = bar.maximum() - bar.value()
+        self.chat_model.prepend(entries)
+        self.doItemsLayout()
+        bar.setValue(bar.maximum() - from_bottom)
+
+    def clear(self):
+        self.chat_model.clear()
+        self.delegate.reset()
+        self.following = True
+        self.has_older = False
+        self.loading_older = False
+
+    def set_colors(self, text_color, sys_color):
+        """主题变化后用新的颜色重新排版所有消息"""
+        self.text_color, self.sys_color = text_color, sys_color
+        self.relayout()
+
+    def relayout(self):
+        self.delegate.reset()
+        self.doItemsLayout()
+        self.viewport().update()
+
+    def to_plain_text(self):
+        return "\n".join(self.entry_text(entry) for entry in self.chat_model.entries)
+
+    def to_html(self):
+        body = "".join(f"<div>{self.entry_html(entry)}</div>" for entry in self.chat_model.entries)
+        return f"<html><body>{body}</body></html>"
+
+    # ---------- 滚动 ----------
+    def on_rows_removed(self, parent, first, last):
+        self.delegate.forget(entry["key"] for entry in self.chat_model.entries[first:last + 1])
+
+    def on_scroll(self, value):
+        bar = self.verticalScrollBar()
+        self.following = value >= bar.maximum() - MARGIN
+        if self.following:
+            # 回到底部后再丢弃向上翻看时加载的消息
+            self.trim()
+        elif value == bar.minimum():
+            self.request_older()
+
+    def request_older(self):
+        if not self.has_older or self.loading_older:
+            return
+        oldest = self.chat_model.oldest_id()
+        if oldest is not None:
+            self.loading_older = True
+            self.need_older.emit(oldest)
+
+    def wheelEvent(self, event):
+        # 消息不满一屏时没有滚动条，向上滚动滚轮也加载更早的消息
+        bar = self.verticalScrollBar()
+        if event.angleDelta().y() > 0 and bar.value() == bar.minimum():
+            self.request_older()
+        super().wheelEvent(event)
+
+    def keyPressEvent(self, event):
+        if event.matches(QKeySequence.Copy):
+            rows = sorted(index.row() for index in self.selectedIndexes())
+            QApplication.clipboard().setText(
+                "\n".join(self.entry_text(self.chat_model.entries[row]) for row in rows))
+            return
+        super().keyPressEvent(event)
+
+    def changeEvent(self, event):
+        super().changeEvent(event)
+        if event.type() == QEvent.FontChange:
+            self.relayout()
@@ -8,7 +8,7 @@
 
 # client.py
 
-import sys, os, json, asyncio, websockets, threading, queue, datetime, re, logging
+import sys, os, asyncio, websockets, threading, queue, datetime, re, logging, struct
 from pathlib import Path
 from PySide6.QtWidgets import *
 from PySide6.QtCore import Qt, QThread, Signal, QEvent
@@ -17,6 +17,10 @@ import markdown
 from qt_material import apply_stylesheet, list_themes
 import configparser
 import hashlib
+from compression import client_extensions
+from codec import CLIENT_SCHEMAS, CodecError, get_codec
+import wire
+from chatview import SECTION as CHAT_SECTION, ChatView
 
 # 版本定义
 APP_VERSION = "3.0.1"
@@ -26,12 +30,42 @@ OWNER_COLOR = QColor(Qt.white)  # 房主名字颜色
 DEFAULT_TEXT_COLOR = QColor(0xE0, 0xE0, 0xE0)  # 亮灰色文本 (默认暗主题)
 LIGHT_TEXT_COLOR = QColor(0x33, 0x33, 0x33)  # 深灰色文本 (亮主题)
 
+# 分块上传/下载
+CHUNK_HEADER = struct.Struct("!16sQ")  # 16字节传输ID + 8字节偏移量
+CHUNK_SIZE = 256 * 1024
+UPLOAD_WINDOW = 4 * 1024 * 1024  # 未被服务器确认的数据上限
+
 # 配置文件路径
 CLIENT_CONFIG_PATH = Path(__file__).with_name("client.ini")
 
 logging.basicConfig(level=logging.INFO)
 INI_PATH = Path(__file__).with_name("server.ini")
 
+def load_client_config():
+    """读取 client.ini (不存在时返回空配置)"""
+    cfg = configparser.ConfigParser()
+    if CLIENT_CONFIG_PATH.exists():
+        try:
+            cfg.read(CLIENT_CONFIG_PATH, encoding="utf-8")
+        except Exception as e:
+            logging.error(f"读取客户端配置失败: {e}")
+    return cfg
+
+
+def load_client_option(section, key, fallback):
+    """读取 client.ini 中的选项"""
+    return load_client_config().get(section, key, fallback=fallback)
+
+
+def file_sha256(path):
+    """按块计算文件的 sha256"""
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(1 << 20):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
 class WS(QThread):
     msg = Signal(dict)
     error = Signal(str)
@@ -39,9 +73,38 @@ class WS(QThread):
     def __init__(self, url, name):
         super().__init__()
         self.url, self.name, self.q, self.running = url, name, queue.Queue(), True
+        self.downloads = {}  # download_id -> 下载状态，只在连接线程中读写文件
+        self.codec = get_codec(load_client_option("CODEC", "backend", "auto"), CLIENT_SCHEMAS)
+        # 紧凑协议: 注册时声明支持，服务器在 api_version 中同意后切换
+        compact = load_client_option("CODEC", "compact", "true").lower() in ("1", "true", "yes", "on")
+        self.offer_compact = compact and wire.available()
+        self.compact = False
+        self.wire = wire.Decoder()
 
     def send(self, t, d): self.q.put((t, d))
 
+    def send_binary(self, data): self.q.put((None, data))
+
+    def download(self, filename, path, sha256=None):
+        """后台下载服务器上的文件到 path
+
+        临时文件按内容的 sha256 命名，同一目录下已有同一内容的临时文件时从断点继续，
+        不会把其他文件的数据拼进来；完成后校验哈希再改名。不知道哈希时不续传。
+        """
+        download_id = os.urandom(16).hex()
+        path = Path(path)
+        if sha256:
+            part = path.with_name(f"{sha256}.part")
+            offset = part.stat().st_size if part.exists() else 0
+        else:
+            part, offset = Path(f"{path}.part"), 0
+        self.downloads[download_id] = {
+            'filename': filename, 'sha256': sha256, 'path': path, 'part': part, 'offset': offset,
+            'received': 0, 'length': None, 'size': None, 'file': None, 'progress': -1
+        }
+        self.send('file_request', {'download_id': download_id, 'filename': filename,
+                                   'sha256': sha256, 'offset': offset})
+
     def run(self):
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
@@ -52,11 +115,93 @@ class WS(QThread):
 
     async def _go(self):
         uri = f"ws://{self.url}"
-        async with websockets.connect(uri, ping_interval=20) as ws:
-            await ws.send(json.dumps({"type": "register", "username": self.name}))
+        async with websockets.connect(uri, ping_interval=20, compression=None,
+                                      extensions=client_extensions(load_client_config())) as ws:
+            register = {"type": "register", "username": self.name, "presence": "delta"}
+            if self.offer_compact:
+                register["wire"] = [wire.WIRE_NAME]
+            await ws.send(self.codec.encode(register), text=True)
             threading.Thread(target=self._sender, args=(ws,), daemon=True).start()
             async for m in ws:
-                self.msg.emit(json.loads(m))
+                try:
+                    if isinstance(m, str):
+                        data = self.codec.decode(m)
+                    elif not self.compact:
+                        self._download_chunk(m)
+                        continue
+                    elif m[:1] == wire.CHUNK_PREFIX:
+                        self._download_chunk(memoryview(m)[1:])
+                        continue
+                    else:
+                        data = self.wire.decode(m)
+                        if data is None:  # 字符串ID定义帧
+                            continue
+                        data = self.codec.validate(data)
+                except CodecError as e:
+                    logging.error(f"丢弃无效消息: {e}")
+                    continue
+                if data.get('type') == 'api_version' and data.get('wire') == wire.WIRE_NAME:
+                    self.compact = True
+                elif data.get('type') == 'file_download_start':
+                    self._download_start(data)
+                elif data.get('type') == 'file_error' and data.get('download_id') in self.downloads:
+                    d = self._download_close(data['download_id'])
+                    if d['offset'] > 0:
+                        # 服务器拒绝了续传的范围 (例如临时文件比原文件还大)，丢弃临时文件重新下载
+                        d['part'].unlink(missing_ok=True)
+                        self.download(d['filename'], d['path'], d['sha256'])
+                        continue
+                self.msg.emit(data)
+
+    def _download_start(self, data):
+        d = self.downloads.get(data['download_id'])
+        if not d:
+            return
+        d['length'], d['size'] = data['length'], data['size']
+        try:
+            d['file'] = open(d['part'], 'r+b' if d['part'].exists() else 'wb')
+            d['file'].truncate(d['offset'])
+            d['file'].seek(d['offset'])
+        except OSError as e:
+            self._download_close(data['download_id'])
+            self.msg.emit({'type': 'file_error', 'message': f"无法写入文件: {e}"})
+            return
+        if d['length'] == 0:
+            self._download_finish(data['download_id'])
+
+    def _download_chunk(self, frame):
+        raw_id, offset = CHUNK_HEADER.unpack_from(frame)
+        download_id = raw_id.hex()
+        d = self.downloads.get(download_id)
+        if not d or not d['file']:
+            return
+        chunk = memoryview(frame)[CHUNK_HEADER.size:]
+        d['file'].write(chunk)
+        d['received'] += len(chunk)
+        progress = (offset + len(chunk)) * 100 // d['size']
+        if progress != d['progress'] and progress < 100:
+            d['progress'] = progress
+            self.msg.emit({'type': 'file_download_progress', 'download_id': download_id, 'progress': progress})
+        if d['received'] >= d['length']:
+            self._download_finish(download_id)
+
+    def _download_finish(self, download_id):
+        d = self._download_close(download_id)
+        try:
+            if d['sha256'] and file_sha256(d['part']) != d['sha256']:
+                d['part'].unlink(missing_ok=True)
+                self.msg.emit({'type': 'file_error', 'message': "下载的文件校验失败，请重新下载"})
+                return
+            os.replace(d['part'], d['path'])
+            self.msg.emit({'type': 'file_downloaded', 'download_id': download_id, 'path': str(d['path'])})
+        except OSError as e:
+            self.msg.emit({'type': 'file_error', 'message': f"无法保存文件: {e}"})
+
+    def _download_close(self, download_id):
+        d = self.downloads.pop(download_id)
+        if d['file']:
+            d['file'].close()
+        return d
 
     def _sender(self, ws):
         loop = asyncio.new_event_loop()
@@ -64,7 +209,14 @@ class WS(QThread):
         while self.running:
             try:
                 t, d = self.q.get(timeout=0.1)
-                loop.run_until_complete(ws.send(json.dumps({"type": t, **d})))
+                if t is None:
+                    if self.compact:
+                        d = wire.CHUNK_PREFIX + d
+                    loop.run_until_complete(ws.send(d))
+                elif self.compact:
+                    loop.run_until_complete(ws.send(wire.encode({"type": t, **d})))
+                else:
+                    loop.run_until_complete(ws.send(self.codec.encode({"type": t, **d}), text=True))
             except queue.Empty:
                 pass
 
@@ -93,8 +245,9 @@ class ChatWindow(QMainWindow):
         left.addWidget(self.user_list)
         
         # 中间：聊天区域
-        self.chat = QTextEdit()
-        self.chat.setReadOnly(True)
+        self.chat = ChatView(int(load_client_option(CHAT_SECTION, "scrollback", "2000")),
+                             int(load_client_option(CHAT_SECTION, "cache", "200")))
+        self.chat.need_older.connect(self.load_older_history)
         
         # 右侧布局
         right = QVBoxLayout()
@@ -119,6 +272,8 @@ class ChatWindow(QMainWindow):
         self.preview_btn.clicked.connect(self.toggle_preview)
         self.file_btn = QPushButton("发送文件")
         self.file_btn.clicked.connect(self.upload_file)
+        self.download_btn = QPushButton("下载文件")
+        self.download_btn.clicked.connect(self.show_download_dialog)
         
         # 第一行
         btn_grid.addWidget(self.create_room_btn, 0, 0)
@@ -131,6 +286,9 @@ class ChatWindow(QMainWindow):
         # 第三行
         btn_grid.addWidget(self.file_btn, 2, 0, 1, 2)  # 跨两列
         
+        # 第四行
+        btn_grid.addWidget(self.download_btn, 3, 0, 1, 2)
+        
         right.addWidget(self.room_info)
         right.addLayout(btn_grid)
         right.setContentsMargins(10, 10, 10, 10)
@@ -196,9 +354,17 @@ class ChatWindow(QMainWindow):
 
         # 房主状态
         self.is_owner = False
+        self.owner = None  # 当前房主用户名
+        self.user_seq = None  # 在线用户列表的版本号
         self.banned_words = []
         self.saved_hashed_password = self.load_saved_password()
         
+        # 进行中的上传: upload_id -> {"path", "size", "acked"}
+        self.uploads = {}
+        self.upload_cond = threading.Condition()
+        # 本次会话中看到的共享文件: 文件名 -> file_shared 消息
+        self.shared_files = {}
+        
         # 存储被禁言和踢出的用户列表
         self.muted_users_list = []
         self.kicked_users_list = []
@@ -316,6 +482,9 @@ class ChatWindow(QMainWindow):
         self.is_dark_theme = "light" not in theme.lower()
         # 更新文本颜色
         self.current_text_color = DEFAULT_TEXT_COLOR if self.is_dark_theme else LIGHT_TEXT_COLOR
+        # 已显示的消息也换成新主题的颜色
+        self.chat.set_colors(self.get_color_hex(self.current_text_color),
+                             '#9E9E9E' if self.is_dark_theme else '#616161')
 
     # ---------- 消息 ----------
     def on_user_double_click(self, item):
@@ -421,13 +590,10 @@ class ChatWindow(QMainWindow):
         if t == 'user_list':
             self.user_list.clear()
             self.user_list.addItem("在线用户")
-            owner = data.get('owner')
+            self.user_seq = data.get('seq')
+            self.owner = data.get('owner')
             for user in data['users']:
-                item = QListWidgetItem(user)
-                if user == owner:
-                    # 房主名字颜色为白色
-                    item.setForeground(QColor(Qt.white))
-                self.user_list.addItem(item)
+                self.add_user_item(user)
         elif t == 'kicked':
             QMessageBox.warning(self, "被踢出", data.get('message', "您被房主踢出聊天室"))
             self.close()
@@ -455,6 +621,13 @@ class ChatWindow(QMainWindow):
         elif t == 'owner_changed':
             owner = data.get('owner')
             self.is_owner = (owner == self.name)
+            self.owner = owner
+            for i in range(1, self.user_list.count()):  # 跳过标题项
+                item = self.user_list.item(i)
+                if item.text() == owner:
+                    item.setForeground(QColor(Qt.white))
+                else:
+                    item.setData(Qt.ForegroundRole, None)
             # 更新房主功能菜单状态
             enabled = self.is_owner
             self.kick_user_action.setEnabled(enabled)
@@ -494,6 +667,8 @@ class ChatWindow(QMainWindow):
                 # 清空聊天框并显示系统消息
                 self.chat.clear()
                 self.add_sys(f"已切换到房间: {room_name}")
+                # 拉取该房间最近的聊天记录
+                self.ws.send('get_history', {'limit': 50})
                 
             except Exception as e:
                 self.add_sys(f"房间切换失败: {str(e)}")
@@ -503,29 +678,52 @@ class ChatWindow(QMainWindow):
                 return  # 忽略其他房间的消息
             # 传递房主状态给add方法
             is_owner = data.get('is_owner', False)
-            self.add(data['username'], data['content'], data['timestamp'], is_owner)
+            self.add(data['username'], data['content'], data['timestamp'], is_owner, data.get('id'))
+        elif t == 'history':
+            if data.get('room') != self.current_room:
+                return  # 已经切换到其他房间
+            messages = data.get('messages', [])
+            entries = []
+            for m in messages:
+                if m.get('type') == 'message':
+                    entries.append(self.message_entry(m['username'], m['content'], m['timestamp'],
+                                                      m.get('is_owner', False), m.get('id')))
+                elif m.get('type') == 'file_shared':
+                    self.shared_files.setdefault(m['filename'], m)
+                    entries.append(self.sys_entry(f"{m['username']} 分享了文件 {m['filename']}", m.get('id')))
+            # 等待聊天记录期间收到的实时消息可能也在这一页里，跳过已经显示的
+            shown = self.chat.chat_model.ids()
+            entries = [e for e in entries if e['id'] is None or e['id'] not in shown]
+            if entries and not self.chat.loading_older:
+                entries.append(self.sys_entry("—— 以上为历史消息 ——"))
+            # 更早一页和刚切换房间时的最近一页都插入到开头，排在已收到的实时消息之前
+            self.chat.prepend_older(entries, data.get('has_more', False))
         elif t == 'owner_broadcast':
             # 处理房主广播
             self.add_broadcast(data['content'], data['timestamp'])
-        elif t == 'user_joined':
-            username = data['username']
-            self.add_sys(f"{username} 加入了聊天")
-            # 更新在线用户列表
-            self.user_list.clear()
-            self.user_list.addItem("在线用户")
-            for user in sorted(self.user_order + [username]):
-                if user != "在线用户":
-                    self.user_list.addItem(user)
-            # 不再更新房间成员列表
-
-        elif t == 'user_left':
-            username = data['username']
-            self.add_sys(f"{username} 离开了聊天")
-            # 更新在线用户列表
-            items = self.user_list.findItems(username, Qt.MatchExactly)
-            for item in items:
-                self.user_list.takeItem(self.user_list.row(item))
-            # 不再更新房间成员列表
+        elif t in ('user_joined', 'user_left', 'user_presence'):
+            if not self.apply_user_seq(data['seq']):
+                return
+            if t == 'user_presence':
+                joined, left = data['joined'], data['left']
+            else:
+                joined = [data['username']] if t == 'user_joined' else []
+                left = [data['username']] if t == 'user_left' else []
+            for username in left:
+                for item in self.user_list.findItems(username, Qt.MatchExactly):
+                    self.user_list.takeItem(self.user_list.row(item))
+            for username in joined:
+                # 完整列表可能已经包含了这个用户
+                if not self.user_list.findItems(username, Qt.MatchExactly):
+                    self.add_user_item(username)
+            # 大量用户同时重连时只显示一条汇总
+            if len(joined) + len(left) > 5:
+                self.add_sys(f"{len(joined)} 位用户加入，{len(left)} 位用户离开")
+            else:
+                for username in joined:
+                    self.add_sys(f"{username} 加入了聊天")
+                for username in left:
+                    self.add_sys(f"{username} 离开了聊天")
         elif t == 'private_message':
             room_info = f" [来自: {data.get('room', '未知房间')}]" if 'room' in data else ""
             self.add_priv(data['from'] + " → 我" + room_info, data['content'], data['timestamp'])
@@ -537,11 +735,37 @@ class ChatWindow(QMainWindow):
             if not self.receive_files_action.isChecked():
                 logging.info(f"用户选择不接收文件: {data['filename']}")
                 return  # 用户选择不接收文件
+            self.shared_files[data['filename']] = data
             self.add_sys(f"{data['username']} 分享了文件 {data['filename']}")
+        elif t == 'file_download_start':
+            self.progress.setValue(0)
+            self.progress.setVisible(True)
+        elif t == 'file_download_progress':
+            self.progress.setValue(data['progress'])
+        elif t == 'file_downloaded':
+            self.progress.setVisible(False)
+            self.add_sys(f"文件已保存到 {data['path']}")
+        elif t == 'file_upload_ready':
+            upload = self.uploads.get(data['upload_id'])
+            if upload:
+                upload['acked'] = data['offset']
+                threading.Thread(target=self.send_chunks, args=(data['upload_id'], data['offset']),
+                                 daemon=True).start()
         elif t == 'file_progress':
+            if 'upload_id' in data:
+                with self.upload_cond:
+                    upload = self.uploads.get(data['upload_id'])
+                    if upload:
+                        upload['acked'] = data['received']
+                    if data['progress'] >= 100:
+                        self.uploads.pop(data['upload_id'], None)
+                    self.upload_cond.notify_all()
             self.progress.setValue(data['progress'])
             self.progress.setVisible(data['progress'] < 100)
         elif t == 'file_error':
+            with self.upload_cond:
+                self.uploads.pop(data.get('upload_id'), None)
+                self.upload_cond.notify_all()
             QMessageBox.warning(self, "文件错误", data['message'])
             self.progress.setVisible(False)
 
@@ -563,67 +787,44 @@ class ChatWindow(QMainWindow):
         QMessageBox.warning(self, "连接失败", f"无法连接到服务器：{msg}")
         self.close()
 
+    # ---------- 在线用户列表 ----------
+    def add_user_item(self, user):
+        item = QListWidgetItem(user)
+        if user == self.owner:
+            # 房主名字颜色为白色
+            item.setForeground(QColor(Qt.white))
+        self.user_list.addItem(item)
+
+    def apply_user_seq(self, seq):
+        """检查增量更新的版本号，返回是否应当应用该更新
+
+        早于当前列表的更新直接忽略；发现中间有缺失时重新获取完整列表。
+        """
+        if self.user_seq is None or seq <= self.user_seq:
+            return False
+        if seq != self.user_seq + 1:
+            self.user_seq = None  # 等待完整列表，期间的增量都忽略
+            self.ws.send('get_users', {})
+            return False
+        self.user_seq = seq
+        return True
+
     # ---------- 渲染 ----------
-    def add_sys(self, txt):
-        # 改进的系统消息样式 - 移到左侧
-        bubble_style = '''
-            background-color: rgba(158, 158, 158, 0.15);
-            border: 1px solid rgba(158, 158, 158, 0.3);
-            border-radius: 18px 18px 18px 4px;
-            padding: 8px 12px;
-            margin: 6px auto 6px 0;
-            display: inline-block;
-            max-width: 60%;
-            float: left;
-            clear: both;
-            font-style: italic;
-        '''
-        # 使用与当前主题协调的系统消息颜色
-        sys_color = '#9E9E9E' if self.is_dark_theme else '#616161'
-        self.chat.append(f'<div style="{bubble_style}"><span style="color: {sys_color};">{txt}</span></div>')
-
-    def add(self, user, content, ts, is_owner=False):
+    def sys_entry(self, txt, msg_id=None):
+        return {"kind": "sys", "title": None, "body": txt, "id": msg_id}
+
+    def message_entry(self, user, content, ts, is_owner=False, msg_id=None):
         dt = datetime.datetime.fromisoformat(ts).strftime('%H:%M')
-        
-        html = markdown.markdown(content, extensions=['nl2br', 'fenced_code'])
-        
         # 判断是否是自己发送的消息和是否是房主
-        is_self = user == self.name
-        
-        if is_self:
-            # 自己发送的消息 - 左侧气泡
-            bubble_style = '''
-                background-color: rgba(66, 133, 244, 0.25);
-                border: 1px solid rgba(66, 133, 244, 0.5);
-                border-radius: 18px 18px 18px 4px;
-                padding: 12px 16px;
-                margin: 6px auto 6px 0;
-                display: inline-block;
-                max-width: 70%;
-                float: left;
-                clear: both;
-            '''
-            color_style = 'font-weight: bold; color: #1565C0;'  # 深蓝色，更适合蓝色半透明背景
-        else:
-            # 他人发送的消息 - 左侧气泡
-            bubble_style = '''
-                background-color: rgba(102, 187, 106, 0.25);
-                border: 1px solid rgba(102, 187, 106, 0.5);
-                border-radius: 18px 18px 18px 4px;
-                padding: 12px 16px;
-                margin: 6px auto 6px 0;
-                display: inline-block;
-                max-width: 70%;
-                float: left;
-                clear: both;
-            '''
-            if is_owner:
-                color_style = 'font-weight: bold; color: white;'  # 房主名字为白色
-            else:
-                color_style = 'font-weight: bold; color: #2E7D32;'  # 深绿色，更适合绿色半透明背景   
-        # 使用当前主题对应的文本颜色
-        content_color = self.get_color_hex(self.current_text_color)
-        self.chat.append(f'<div style="{bubble_style}"><span style="{color_style}">[{dt}] {user}</span><br><span style="color: {content_color};">{html}</span></div>')
+        kind = "self" if user == self.name else "owner" if is_owner else "other"
+        return {"kind": kind, "title": f"[{dt}] {user}", "id": msg_id,
+                "body": markdown.markdown(content, extensions=['nl2br', 'fenced_code'])}
+
+    def add_sys(self, txt):
+        self.chat.add_entry(self.sys_entry(txt))
+
+    def add(self, user, content, ts, is_owner=False, msg_id=None):
+        self.chat.add_entry(self.message_entry(user, content, ts, is_owner, msg_id))
     
     def get_color_hex(self, qcolor):
         """将QColor对象转换为CSS十六进制颜色字符串"""
@@ -631,64 +832,18 @@ class ChatWindow(QMainWindow):
 
     def add_broadcast(self, content, ts):
         dt = datetime.datetime.fromisoformat(ts).strftime('%H:%M')
-        
-        html = markdown.markdown(content, extensions=['nl2br', 'fenced_code'])
-        
-        # 房主广播样式
-        bubble_style = '''
-            background-color: rgba(255, 193, 7, 0.25);
-            border: 1px solid rgba(255, 193, 7, 0.5);
-            border-radius: 18px 18px 18px 4px;
-            padding: 12px 16px;
-            margin: 6px auto;
-            display: inline-block;
-            max-width: 70%;
-            float: left;
-            clear: both;
-        '''
-        title_style = 'font-weight: bold; color: #FFA000;'  # 橙色标题
-        # 使用当前主题对应的文本颜色
-        content_color = self.get_color_hex(self.current_text_color)
-        self.chat.append(f'<div style="{bubble_style}"><span style="{title_style}">[{dt}] 房主广播</span><br><span style="color: {content_color};">{html}</span></div>')
+        self.chat.add_entry({"kind": "broadcast", "title": f"[{dt}] 房主广播", "id": None,
+                             "body": markdown.markdown(content, extensions=['nl2br', 'fenced_code'])})
 
     def add_priv(self, title, content, ts):
-        dt = datetime.datetime.fromisoformat(ts).strftime('%H:%M')
-        
-        html = markdown.markdown(content, extensions=['nl2br', 'fenced_code'])
-        
         # 判断是自己发送的私聊还是接收的私聊
-        if title.startswith('我 →'):
-            # 自己发送的私聊 - 左侧气泡
-            bubble_style = '''
-                background-color: rgba(255, 112, 67, 0.25);
-                border: 1px solid rgba(255, 112, 67, 0.5);
-                border-radius: 18px 18px 18px 4px;
-                padding: 12px 16px;
-                margin: 6px auto 6px 0;
-                display: inline-block;
-                max-width: 70%;
-                float: left;
-                clear: both;
-            '''
-            color_style = 'font-weight: bold; color: #E65100;'  # 深橙色，更适合橙色半透明背景
-        else:
-            # 接收的私聊 - 左侧气泡
-            bubble_style = '''
-                background-color: rgba(156, 39, 176, 0.25);
-                border: 1px solid rgba(156, 39, 176, 0.5);
-                border-radius: 18px 18px 18px 4px;
-                padding: 12px 16px;
-                margin: 6px auto 6px 0;
-                display: inline-block;
-                max-width: 70%;
-                float: left;
-                clear: both;
-            '''
-            color_style = 'font-weight: bold; color: #6A1B9A;'  # 深紫色，更适合紫色半透明背景
-        
-        # 使用当前主题对应的文本颜色
-        content_color = self.get_color_hex(self.current_text_color)
-        self.chat.append(f'<div style="{bubble_style}"><span style="{color_style}">[私聊] {title}</span><br><span style="color: {content_color};">{html}</span></div>')
+        kind = "priv_sent" if title.startswith('我 →') else "priv_recv"
+        self.chat.add_entry({"kind": kind, "title": f"[私聊] {title}", "id": None,
+                             "body": markdown.markdown(content, extensions=['nl2br', 'fenced_code'])})
+
+    def load_older_history(self, before_id):
+        """聊天区滚动到顶部时拉取更早的一页聊天记录"""
+        self.ws.send('get_history', {'limit': 50, 'before_id': before_id})
 
     def toggle_preview(self):
         vis = not self.preview.isVisible()
@@ -1128,27 +1283,90 @@ class ChatWindow(QMainWindow):
             self.progress.setVisible(True)
             self.progress.setValue(0)
 
-            def run():
+            # 同一文件 (路径、大小、修改时间相同) 使用相同的上传ID，服务器据此断点续传
+            stat = os.stat(path)
+            upload_id = hashlib.sha256(
+                f"{self.name}|{os.path.abspath(path)}|{file_size}|{stat.st_mtime_ns}".encode()
+            ).hexdigest()[:32]
+            self.uploads[upload_id] = {'path': path, 'size': file_size, 'acked': 0}
+
+            def start():
+                # 先计算哈希，服务器已有相同内容时可以秒传
                 try:
+                    hasher = hashlib.sha256()
                     with open(path, 'rb') as f:
-                        content = f.read().hex()
-                    self.ws.send('file_upload', {
-                        'filename': os.path.basename(path), 
-                        'content': content,
-                        'size': file_size
-                    })
+                        for block in iter(lambda: f.read(CHUNK_SIZE), b''):
+                            hasher.update(block)
                 except Exception as e:
-                    self.progress.setVisible(False)
-                    QMessageBox.warning(self, "上传失败", f"上传文件时出错: {str(e)}")
                     logging.error(f"文件上传失败: {e}")
+                    self.ws.msg.emit({'type': 'file_error', 'upload_id': upload_id,
+                                      'message': f"读取文件时出错: {str(e)}"})
+                    return
+                self.ws.send('file_upload_start', {
+                    'upload_id': upload_id,
+                    'filename': os.path.basename(path),
+                    'size': file_size,
+                    'sha256': hasher.hexdigest()
+                })
 
-            threading.Thread(target=run, daemon=True).start()
+            threading.Thread(target=start, daemon=True).start()
             
         except Exception as e:
             self.progress.setVisible(False)
             QMessageBox.warning(self, "错误", f"选择文件时出错: {str(e)}")
             logging.error(f"文件选择失败: {e}")
 
+    def show_download_dialog(self):
+        if not self.shared_files:
+            QMessageBox.information(self, "下载文件", "当前没有可下载的文件")
+            return
+        dlg = QDialog(self)
+        dlg.setWindowTitle("下载文件")
+        lay = QFormLayout(dlg)
+        
+        file_list = QComboBox()
+        for filename, info in self.shared_files.items():
+            file_list.addItem(f"{filename} ({info.get('size', 0) / 1024:.1f} KB)", filename)
+        download_btn = QPushButton("下载")
+        lay.addRow("选择文件:", file_list)
+        lay.addRow(download_btn)
+        download_btn.clicked.connect(dlg.accept)
+        
+        if dlg.exec():
+            filename = file_list.currentData()
+            path, _ = QFileDialog.getSaveFileName(self, "保存文件", filename)
+            if path:
+                self.ws.download(filename, path, self.shared_files[filename].get('sha256'))
+
+    def send_chunks(self, upload_id, offset):
+        """在后台线程中按块发送文件，未确认的数据不超过 UPLOAD_WINDOW"""
+        upload = self.uploads.get(upload_id)
+        if not upload:
+            return
+        raw_id = bytes.fromhex(upload_id)
+        try:
+            with open(upload['path'], 'rb') as f:
+                f.seek(offset)
+                while offset < upload['size']:
+                    with self.upload_cond:
+                        ready = self.upload_cond.wait_for(
+                            lambda: upload_id not in self.uploads or not self.ws.running
+                            or offset - upload['acked'] < UPLOAD_WINDOW, timeout=30)
+                        if upload_id not in self.uploads or not self.ws.running:
+                            return  # 上传已取消
+                        if not ready:
+                            raise IOError("服务器长时间未响应")
+                    chunk = f.read(CHUNK_SIZE)
+                    if not chunk:
+                        raise IOError("文件在上传过程中被修改")
+                    self.ws.send_binary(CHUNK_HEADER.pack(raw_id, offset) + chunk)
+                    offset += len(chunk)
+        except Exception as e:
+            logging.error(f"文件上传失败: {e}")
+            # 通过信号交给界面线程显示错误
+            self.ws.msg.emit({'type': 'file_error', 'upload_id': upload_id,
+                              'message': f"上传文件时出错: {str(e)}"})
+
     def closeEvent(self, e):
         if QMessageBox.question(self, "退出", "确认退出？") == QMessageBox.Yes:
             # 先移除窗口置顶标志，确保窗口可以正常关闭
@@ -1157,6 +1375,8 @@ class ChatWindow(QMainWindow):
                 self.show()
             
             self.ws.running = False
+            with self.upload_cond:
+                self.upload_cond.notify_all()
             e.accept()
         else:
             e.ignore()
@@ -1166,9 +1386,7 @@ class ChatWindow(QMainWindow):
         if not file:
             return
         try:
-            text = self.chat.toPlainText() if fmt == "txt" else self.chat.toHtml()
-            if fmt == "md":
-                text = self.chat.toPlainText()
+            text = self.chat.to_html() if fmt == "html" else self.chat.to_plain_text()
             with open(file, "w", encoding="utf-8") as f:
                 f.write(text)
             QMessageBox.information(self, "导出成功", f"已保存为 {fmt.upper()}")
@@ -0,0 +1,132 @@
+# region COPYRIGHT
+
+# Copyright © 2025 [MinerMouse]
+# Luogu UID:1203704
+# Portions Copyright © 2025 ILoveScratch2
+
+# endregion
+
+# cluster.py
+
+"""在本机 (127.0.0.1) 启动多个联邦节点
+
+节点 i 监听 port + i，并连接节点 i-1，整体连成一条链 (消息经中间节点 gossip 转发)。
+各节点在各自的临时目录中运行，使用同一个随机生成的 [FEDERATION] secret。
+不加 --check 时一直运行到 Ctrl+C；加 --check 时运行一组跨节点的检查后退出，
+全部通过时返回 0:
+
+- 分别连到第一个和最后一个节点的两个用户能在用户列表中看到对方
+- 公共聊天室的消息和私聊能跨节点送达
+- 不带 secret 的 peer_hello 会被拒绝
+
+    python cluster.py --nodes 3 --port 8800
+    python cluster.py --nodes 3 --check
+"""
+
+import argparse, asyncio, configparser, json, multiprocessing, os, secrets, tempfile, time
+import websockets
+import logpipe, server, tuning
+from benchmark import wait_ready
+
+
+def run_node(index, port, peers, secret, root):
+    os.chdir(root)
+    cfg = configparser.ConfigParser()
+    cfg.read_dict({
+        "HISTORY": {"enabled": "false"},
+        "FEDERATION": {"enabled": "true", "node_id": f"node{index}", "peers": ",".join(peers), "secret": secret},
+    })
+    logpipe.setup(cfg)
+    try:
+        tuning.run(server.ChatServer("127.0.0.1", port, "", cfg).run(), cfg)
+    except KeyboardInterrupt:
+        pass
+
+
+async def expect(ws, predicate, timeout=10):
+    """等待第一条满足 predicate 的文本消息"""
+    deadline = time.time() + timeout
+    while True:
+        raw = await asyncio.wait_for(ws.recv(), max(0.01, deadline - time.time()))
+        if isinstance(raw, str):
+            data = json.loads(raw)
+            if predicate(data):
+                return data
+
+
+async def wait_for_user(ws, username, timeout=10):
+    """轮询用户列表，直到 username 出现 (其他节点的用户经同步后才可见)"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        await ws.send(json.dumps({"type": "get_users"}))
+        data = await expect(ws, lambda d: d.get("type") == "user_list")
+        if username in data["users"]:
+            return
+        await asyncio.sleep(0.2)
+    raise AssertionError(f"{timeout} 秒内没有看到用户 {username}")
+
+
+async def check(urls):
+    first, last = urls[0], urls[-1]
+    async with websockets.connect(first) as alice, websockets.connect(last) as bob:
+        await alice.send(json.dumps({"type": "register", "username": "alice"}))
+        await bob.send(json.dumps({"type": "register", "username": "bob"}))
+        await wait_for_user(alice, "bob")
+        await wait_for_user(bob, "alice")
+        print("用户列表: 通过")
+
+        await alice.send(json.dumps({"type": "message", "content": "hello from node0"}))
+        await expect(bob, lambda d: d.get("type") == "message" and d.get("content") == "hello from node0")
+        print("公共聊天室消息: 通过")
+
+        await bob.send(json.dumps({"type": "private_message", "target": "alice", "content": "psst"}))
+        await expect(alice, lambda d: d.get("type") == "private_message" and d.get("content") == "psst")
+        print("私聊: 通过")
+
+    async with websockets.connect(first) as intruder:
+        await intruder.send(json.dumps({"type": "peer_hello", "node": "intruder"}))
+        reply = await expect(intruder, lambda d: d.get("type") in ("peer_welcome", "error"))
+        if reply["type"] != "error":
+            raise AssertionError("不带 secret 的 peer_hello 被接受了")
+    print("拒绝未认证的 peer: 通过")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="在本机启动多个 TouchFox 联邦节点")
+    parser.add_argument("--nodes", type=int, default=3, help="节点数")
+    parser.add_argument("--port", type=int, default=8800, help="第一个节点的端口，其余节点依次加一")
+    parser.add_argument("--check", action="store_true", help="运行跨节点检查后退出")
+    args = parser.parse_args()
+    if args.nodes < 2:
+        parser.error("--nodes 至少为 2")
+
+    secret = secrets.token_hex(16)
+    urls = [f"ws://127.0.0.1:{args.port + i}" for i in range(args.nodes)]
+    ctx = multiprocessing.get_context("spawn")
+    nodes = []
+    for i in range(args.nodes):
+        root = tempfile.mkdtemp(prefix=f"touchfox-node{i}-")
+        p = ctx.Process(target=run_node, args=(i, args.port + i, urls[i - 1:i], secret, root))
+        p.start()
+        nodes.append(p)
+    print(f"已启动 {args.nodes} 个节点: {', '.join(urls)}")
+    try:
+        for url in urls:
+            asyncio.run(wait_ready(url))
+        if args.check:
+            asyncio.run(check(urls))
+            print("全部检查通过")
+        else:
+            for p in nodes:
+                p.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for p in nodes:
+            if p.is_alive():
+                p.terminate()
+            p.join()
+
+
+if __name__ == "__main__":
+    main()
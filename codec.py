@@ -0,0 +1,132 @@
+# region COPYRIGHT
+
+# Copyright © 2025 [MinerMouse]
+# Luogu UID:1203704
+# Portions Copyright © 2025 ILoveScratch2
+
+# endregion
+
+# codec.py
+
+import json, logging
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+CODECS = ("auto", "json", "orjson", "msgspec")
+
+# 客户端发往服务器的常用消息: 消息类型 -> {字段: 类型}
+SERVER_SCHEMAS = {
+    "register": {"username": str},
+    "message": {"content": str},
+    "private_message": {"target": str, "content": str},
+    "peer_hello": {"node": str},
+    "peer": {"message": dict},
+}
+
+# 服务器发往客户端的常用消息
+CLIENT_SCHEMAS = {
+    "message": {"username": str, "content": str, "timestamp": str, "room": str},
+    "user_list": {"users": list},
+    "user_joined": {"username": str, "seq": int},
+    "user_left": {"username": str, "seq": int},
+    "user_presence": {"joined": list, "left": list, "seq": int},
+    "room_info": {"current_room": str, "room_name": str, "rooms": dict},
+}
+
+
+class CodecError(ValueError):
+    """消息无法解码或不符合预期的格式"""
+
+
+class Codec:
+    """消息编解码器
+
+    encode() 返回 bytes (标准库后端返回 str)，可以直接作为文本帧发送；
+    decode() 对 schemas 中登记的常用消息类型校验字段类型。
+    """
+
+    name = "json"
+
+    def __init__(self, schemas=None):
+        self.schemas = schemas or {}
+
+    def encode(self, message):
+        return json.dumps(message)
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def decode(self, data):
+        try:
+            message = self.loads(data)
+        except ValueError as e:
+            raise CodecError(f"无法解析消息: {e}") from None
+        return self.validate(message)
+
+    def validate(self, message):
+        """校验已解码的消息 (其他格式解码的消息也走这里)"""
+        if not isinstance(message, dict):
+            raise CodecError("消息必须是对象")
+        schema = self.schemas.get(message.get("type"))
+        if schema:
+            for field, kind in schema.items():
+                if not isinstance(message.get(field), kind):
+                    raise CodecError(f"{message['type']} 消息的字段 {field} 缺失或类型错误")
+        return message
+
+
+class OrjsonCodec(Codec):
+    name = "orjson"
+
+    def encode(self, message):
+        # 与 json.dumps 一样接受非字符串的键，仍然不支持的内容 (例如超过 64 位的整数) 交给标准库
+        try:
+            return orjson.dumps(message, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            return json.dumps(message)
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+class MsgspecCodec(Codec):
+    name = "msgspec"
+
+    def __init__(self, schemas=None):
+        super().__init__(schemas)
+        self.encoder = msgspec.json.Encoder()
+        self.decoder = msgspec.json.Decoder()
+
+    def encode(self, message):
+        try:
+            return self.encoder.encode(message)
+        except TypeError:
+            return json.dumps(message)
+
+    def loads(self, data):
+        try:
+            return self.decoder.decode(data)
+        except msgspec.DecodeError as e:
+            raise ValueError(str(e)) from None
+
+
+def get_codec(name="auto", schemas=None):
+    """按名称创建编解码器；auto 依次尝试 orjson、msgspec，都没有安装时使用标准库"""
+    if name not in CODECS:
+        logging.warning(f"未知的编解码器 {name}，使用 auto")
+        name = "auto"
+    if name in ("auto", "orjson") and orjson is not None:
+        return OrjsonCodec(schemas)
+    if name in ("auto", "msgspec") and msgspec is not None:
+        return MsgspecCodec(schemas)
+    if name not in ("auto", "json"):
+        logging.warning(f"未安装 {name}，使用标准库 json")
+    return Codec(schemas)
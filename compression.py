@@ -0,0 +1,107 @@
+# region COPYRIGHT
+
+# Copyright © 2025 [MinerMouse]
+# Luogu UID:1203704
+# Portions Copyright © 2025 ILoveScratch2
+
+# endregion
+
+# compression.py
+
+"""permessage-deflate 压缩设置 (server.ini / client.ini 的 [COMPRESSION] 段)
+
+- enabled: 是否协商压缩
+- level / mem_level: zlib 压缩级别和内存级别
+- window_bits: 压缩窗口大小 (8-15)，每个连接的压缩上下文约占 2^(window_bits+2) 字节
+- threshold: 小于该字节数的消息不压缩 (RFC 7692 允许同一连接上混合发送未压缩的消息)
+- no_context_takeover: 每条消息结束后释放压缩上下文，连接数很多时内存占用可预测，
+  代价是压缩率降低
+"""
+
+import logging
+from websockets.extensions.permessage_deflate import (
+    ClientPerMessageDeflateFactory, PerMessageDeflate, ServerPerMessageDeflateFactory)
+from websockets.frames import OP_BINARY, OP_TEXT
+
+SECTION = "COMPRESSION"
+
+
+class ThresholdDeflate(PerMessageDeflate):
+    """小于 threshold 的单帧消息直接发送，不经过压缩"""
+
+    def __init__(self, extension, threshold):
+        super().__init__(
+            extension.remote_no_context_takeover,
+            extension.local_no_context_takeover,
+            extension.remote_max_window_bits,
+            extension.local_max_window_bits,
+            extension.compress_settings)
+        self.threshold = threshold
+
+    def encode(self, frame):
+        if frame.opcode in (OP_TEXT, OP_BINARY) and frame.fin and len(frame.data) < self.threshold:
+            return frame
+        return super().encode(frame)
+
+
+class ServerDeflateFactory(ServerPerMessageDeflateFactory):
+    def __init__(self, threshold, **kwargs):
+        super().__init__(**kwargs)
+        self.threshold = threshold
+
+    def process_request_params(self, params, accepted_extensions):
+        response, extension = super().process_request_params(params, accepted_extensions)
+        return response, ThresholdDeflate(extension, self.threshold)
+
+
+class ClientDeflateFactory(ClientPerMessageDeflateFactory):
+    def __init__(self, threshold, **kwargs):
+        super().__init__(**kwargs)
+        self.threshold = threshold
+
+    def process_response_params(self, params, accepted_extensions):
+        extension = super().process_response_params(params, accepted_extensions)
+        return ThresholdDeflate(extension, self.threshold)
+
+
+def _settings(cfg):
+    window_bits = cfg.getint(SECTION, "window_bits", fallback=12)
+    if not 8 <= window_bits <= 15:
+        logging.warning(f"无效的压缩窗口大小 {window_bits}，使用 12")
+        window_bits = 12
+    return {
+        "enabled": cfg.getboolean(SECTION, "enabled", fallback=True),
+        "window_bits": window_bits,
+        "threshold": cfg.getint(SECTION, "threshold", fallback=256),
+        "no_context_takeover": cfg.getboolean(SECTION, "no_context_takeover", fallback=False),
+        "compress_settings": {
+            "level": cfg.getint(SECTION, "level", fallback=6),
+            "memLevel": cfg.getint(SECTION, "mem_level", fallback=5)
+        },
+    }
+
+
+def server_extensions(cfg):
+    """返回传给 websockets.serve 的 extensions 参数 (同时应传入 compression=None)"""
+    s = _settings(cfg)
+    if not s["enabled"]:
+        return []
+    return [ServerDeflateFactory(
+        s["threshold"],
+        server_no_context_takeover=s["no_context_takeover"],
+        client_no_context_takeover=s["no_context_takeover"],
+        server_max_window_bits=s["window_bits"],
+        client_max_window_bits=s["window_bits"],
+        compress_settings=s["compress_settings"])]
+
+
+def client_extensions(cfg):
+    """返回传给 websockets.connect 的 extensions 参数 (同时应传入 compression=None)"""
+    s = _settings(cfg)
+    if not s["enabled"]:
+        return []
+    return [ClientDeflateFactory(
+        s["threshold"],
+        client_no_context_takeover=s["no_context_takeover"],
+        client_max_window_bits=s["window_bits"],
+        compress_settings=s["compress_settings"])]
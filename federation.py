@@ -0,0 +1,161 @@
+# region COPYRIGHT
+
+# Copyright © 2025 [MinerMouse]
+# Luogu UID:1203704
+# Portions Copyright © 2025 ILoveScratch2
+
+# endregion
+
+# federation.py
+
+"""多台服务器之间的联邦 (server.ini 的 [FEDERATION] 段)
+
+每个节点主动连接 peers 中列出的其他节点，也接受其他节点连进来的 peer 连接，
+peer 连接就是普通的 WebSocket 连接，只是注册时发送 peer_hello 而不是 register。
+节点之间交换的消息与多进程总线 (bus.py) 相同，消息中的 "worker" 字段为来源节点ID。
+
+消息按 gossip 方式转发: 每条消息带有唯一的 msg_id，节点收到没见过的消息时
+转发给除来源以外的所有 peer，因此节点之间不必两两相连，只要整体连通即可。
+"""
+
+import asyncio, hmac, json, logging
+from collections import OrderedDict
+import websockets
+
+SEEN_LIMIT = 100000              # 记住的 msg_id 数量，用于去重
+
+
+class PeerLink:
+    """一条 peer 连接的发送端，消息按顺序发送且不会丢弃"""
+
+    def __init__(self, node, websocket):
+        self.node = node
+        self.websocket = websocket
+        self.outbox = asyncio.Queue()
+        self.task = asyncio.create_task(self._writer())
+
+    def send(self, frame):
+        self.outbox.put_nowait(frame)
+
+    async def _writer(self):
+        try:
+            while True:
+                await self.websocket.send(await self.outbox.get())
+        except websockets.ConnectionClosed:
+            pass
+
+    def close(self):
+        self.task.cancel()
+
+
+class PeerBus:
+    """通过 peer WebSocket 连接交换消息的总线"""
+
+    # 各节点有自己的聊天记录数据库，需要保存其他节点转发来的消息
+    shared_storage = False
+
+    def __init__(self, node, peers=(), secret=""):
+        self.node = node
+        self.worker = node
+        self.peers = list(peers)
+        self.secret = secret
+        self.links = {}                  # node -> [PeerLink, ...]，用第一条发送
+        self.seen = OrderedDict()        # 最近见过的 msg_id
+        self.counter = 0
+        self.on_message = None
+        self.tasks = []
+
+    async def connect(self, on_message):
+        self.on_message = on_message
+        self.tasks = [asyncio.create_task(self._dial(url)) for url in self.peers]
+
+    def check_secret(self, secret):
+        # 没有配置密钥时拒绝所有 peer 连接，否则任何客户端都能冒充节点
+        if not self.secret:
+            return False
+        return hmac.compare_digest(str(secret or ""), self.secret)
+
+    def publish(self, message):
+        self.counter += 1
+        message["worker"] = self.node
+        message["msg_id"] = f"{self.node}:{self.counter}"
+        self._remember(message["msg_id"])
+        self._forward(message)
+
+    def _forward(self, message, source=None):
+        frame = json.dumps({"type": "peer", "message": message}, ensure_ascii=False)
+        for node, links in self.links.items():
+            if node != source and node != message.get("worker"):
+                links[0].send(frame)
+
+    def _remember(self, msg_id):
+        self.seen[msg_id] = None
+        if len(self.seen) > SEEN_LIMIT:
+            self.seen.popitem(last=False)
+
+    async def receive(self, source, message):
+        """处理从 source 节点的连接上收到的消息"""
+        msg_id = message.get("msg_id")
+        if msg_id is None or msg_id in self.seen or message.get("worker") == self.node:
+            return
+        self._remember(msg_id)
+        self._forward(message, source)
+        await self.on_message(message)
+
+    async def attach(self, node, websocket):
+        """登记一条新的 peer 连接，并与整个集群交换状态"""
+        links = self.links.setdefault(node, [])
+        links.append(PeerLink(node, websocket))
+        logging.info(f"已连接联邦节点 {node}")
+        if len(links) == 1:
+            # 请求其他节点重新公布状态，同时公布自己的状态
+            self.publish({"op": "sync_request"})
+            await self.on_message({"op": "sync_request", "worker": node})
+
+    async def detach(self, node, websocket):
+        links = self.links.get(node, [])
+        for link in [l for l in links if l.websocket is websocket]:
+            link.close()
+            links.remove(link)
+        if links or node not in self.links:
+            return
+        del self.links[node]
+        logging.warning(f"与联邦节点 {node} 的连接已断开")
+        # 先移除该节点的用户并转告其他节点；它如果还能经由其他节点到达，会在同步时重新出现
+        await self.on_message({"op": "worker_down", "worker": node})
+        if self.links:
+            self.publish({"op": "worker_down", "down": node})
+            self.publish({"op": "sync_request"})
+
+    async def _dial(self, url):
+        """保持到一个 peer 的连接，断开后按指数退避重连"""
+        delay = 1
+        while True:
+            try:
+                async with websockets.connect(url) as ws:
+                    await ws.send(json.dumps({"type": "peer_hello", "node": self.node, "secret": self.secret}))
+                    welcome = json.loads(await ws.recv())
+                    if welcome.get("type") != "peer_welcome" or welcome.get("node") == self.node:
+                        logging.error(f"联邦节点 {url} 拒绝了连接: {welcome.get('message', '')}")
+                    else:
+                        node = welcome["node"]
+                        await self.attach(node, ws)
+                        delay = 1
+                        try:
+                            async for raw in ws:
+                                data = json.loads(raw)
+                                if data.get("type") == "peer":
+                                    await self.receive(node, data["message"])
+                        finally:
+                            await self.detach(node, ws)
+            except (OSError, ValueError, websockets.WebSocketException) as e:
+                logging.debug(f"连接联邦节点 {url} 失败: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        for links in self.links.values():
+            for link in links:
+                link.close()
@@ -0,0 +1,246 @@
+# region COPYRIGHT
+
+# Copyright © 2025 [MinerMouse]
+# Luogu UID:1203704
+# Portions Copyright © 2025 ILoveScratch2
+
+# endregion
+
+# filestore.py
+
+import asyncio, hashlib, logging, os, sqlite3, time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+EVICTION_POLICIES = ("lru", "age")
+
+
+class FileStore:
+    """按内容哈希保存上传文件，相同内容只存一份
+
+    文件保存在 objects/<sha256>，每次上传 (文件名、上传者、房间、大小、时间)
+    记录在 SQLite 索引中。未完成的上传保存在 .partial/ 中，按 (上传者, 上传ID) 区分，
+    开始上传时按声明的大小预留配额: 全部预留超过 quota 或同一上传者的预留超过
+    user_reserve 时拒绝新的上传。声明的大小未经验证，预留不会淘汰已有的对象；
+    只有对象真正存入时才按实际大小检查，对象总大小超过 quota 时按 LRU
+    或存放时间淘汰其他对象。所有磁盘操作都在单独的线程中串行执行。
+    """
+
+    def __init__(self, root="recvfiles", quota=1024 * 1024 * 1024, eviction="lru",
+                 user_reserve=200 * 1024 * 1024):
+        self.root = Path(root)
+        self.objects = self.root / "objects"
+        self.partials = self.root / ".partial"
+        self.quota = quota
+        self.user_reserve = user_reserve
+        self.eviction = eviction if eviction in EVICTION_POLICIES else "lru"
+        self.db = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="filestore")
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def open(self):
+        await self._run(self._open)
+
+    def _open(self):
+        self.objects.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(self.root / "index.db", check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS objects (
+                sha256 TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                last_access REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS files (
+                id INTEGER PRIMARY KEY,
+                sha256 TEXT NOT NULL REFERENCES objects (sha256),
+                filename TEXT NOT NULL,
+                uploader TEXT,
+                room TEXT,
+                size INTEGER NOT NULL,
+                timestamp TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS files_filename ON files (filename, id);
+            CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256);
+            CREATE TABLE IF NOT EXISTS partials (
+                name TEXT PRIMARY KEY,
+                uploader TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL
+            );
+        """)
+        self.db.commit()
+
+    async def close(self):
+        if self.db:
+            await self._run(self.db.close)
+        self.executor.shutdown(wait=False)
+
+    def object_path(self, sha256):
+        return self.objects / sha256
+
+    async def has(self, sha256):
+        return await self._run(self._has, sha256)
+
+    def _has(self, sha256):
+        row = self.db.execute("SELECT 1 FROM objects WHERE sha256 = ?", (sha256,)).fetchone()
+        return row is not None and self.object_path(sha256).exists()
+
+    async def add_file(self, src, sha256, filename, uploader, room, timestamp):
+        """把已经算好哈希的临时文件放入存储，内容已存在时直接删除临时文件"""
+        return await self._run(self._add_file, Path(src), sha256, filename, uploader, room, timestamp)
+
+    def _add_file(self, src, sha256, filename, uploader, room, timestamp):
+        dest = self.object_path(sha256)
+        if dest.exists():
+            src.unlink()
+        else:
+            os.replace(src, dest)
+        with self.db:
+            self.db.execute("DELETE FROM partials WHERE name = ?", (src.name,))
+        return self._link(sha256, filename, uploader, room, timestamp)
+
+    async def add_bytes(self, data, filename, uploader, room, timestamp):
+        return await self._run(self._add_bytes, data, filename, uploader, room, timestamp)
+
+    def _add_bytes(self, data, filename, uploader, room, timestamp):
+        sha256 = hashlib.sha256(data).hexdigest()
+        dest = self.object_path(sha256)
+        if not dest.exists():
+            tmp = dest.with_suffix(".tmp")
+            tmp.write_bytes(data)
+            os.replace(tmp, dest)
+        return self._link(sha256, filename, uploader, room, timestamp)
+
+    async def link(self, sha256, filename, uploader, room, timestamp):
+        """为已存在的内容再登记一次上传 (秒传)"""
+        return await self._run(self._link, sha256, filename, uploader, room, timestamp)
+
+    def _link(self, sha256, filename, uploader, room, timestamp):
+        size = self.object_path(sha256).stat().st_size
+        now = time.time()
+        with self.db:
+            self.db.execute(
+                "INSERT INTO objects (sha256, size, created, last_access) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (sha256) DO UPDATE SET last_access = excluded.last_access",
+                (sha256, size, now, now))
+            self.db.execute(
+                "INSERT INTO files (sha256, filename, uploader, room, size, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
+                (sha256, filename, uploader, room, size, timestamp))
+        self._evict(keep=sha256)
+        return {"sha256": sha256, "size": size}
+
+    async def resolve(self, sha256=None, filename=None, rooms=(), uploader=None):
+        """按哈希或文件名 (最近一次上传) 查找对象路径，找不到返回 None
+
+        只查找分享到 rooms 中某个房间或由 uploader 上传的文件。
+        """
+        return await self._run(self._resolve, sha256, filename, tuple(rooms), uploader)
+
+    def _resolve(self, sha256, filename, rooms, uploader):
+        visible = f"(room IN ({', '.join('?' * len(rooms))}) OR uploader = ?)" if rooms else "uploader = ?"
+        if sha256 is None and filename:
+            row = self.db.execute(f"SELECT sha256 FROM files WHERE filename = ? AND {visible} "
+                                  "ORDER BY id DESC LIMIT 1", (filename, *rooms, uploader)).fetchone()
+        elif sha256 is not None:
+            row = self.db.execute(f"SELECT sha256 FROM files WHERE sha256 = ? AND {visible} LIMIT 1",
+                                  (sha256, *rooms, uploader)).fetchone()
+        else:
+            row = None
+        sha256 = row[0] if row else None
+        if sha256 is None or not self._has(sha256):
+            return None
+        with self.db:
+            self.db.execute("UPDATE objects SET last_access = ? WHERE sha256 = ?", (time.time(), sha256))
+        return self.object_path(sha256)
+
+    def partial_path(self, uploader, upload_id):
+        # 用户名可能含有不能用作文件名的字符，取其哈希
+        return self.partials / f"{hashlib.sha256(uploader.encode()).hexdigest()[:16]}-{upload_id}.part"
+
+    async def reserve_partial(self, uploader, upload_id, size):
+        """为未完成的上传预留 size 字节的配额，返回其临时文件路径
+
+        配额不足时抛出 OSError。
+        """
+        return await self._run(self._reserve_partial, uploader, upload_id, size)
+
+    def _reserve_partial(self, uploader, upload_id, size):
+        path = self.partial_path(uploader, upload_id)
+        # 同一上传重新预留时不计入它原来的预留
+        others = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM partials WHERE name != ?",
+                                 (path.name,)).fetchone()[0]
+        mine = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM partials WHERE uploader = ? AND name != ?",
+                               (uploader, path.name)).fetchone()[0]
+        if mine + size > self.user_reserve:
+            raise OSError("未完成的上传过多，请先完成或取消其他上传")
+        if others + size > self.quota:
+            raise OSError("服务器存储空间不足，请稍后再试")
+        with self.db:
+            self.db.execute(
+                "INSERT INTO partials (name, uploader, size, created) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET size = excluded.size",
+                (path.name, uploader, size, time.time()))
+        return path
+
+    async def discard_partial(self, path):
+        """删除未完成的上传并释放其预留的配额"""
+        await self._run(self._discard_partial, Path(path))
+
+    def _discard_partial(self, path):
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+        with self.db:
+            self.db.execute("DELETE FROM partials WHERE name = ?", (path.name,))
+
+    async def expire_partials(self, max_age):
+        """删除超过 max_age 秒没有写入的未完成上传，返回被删除的路径"""
+        return await self._run(self._expire_partials, max_age)
+
+    def _expire_partials(self, max_age):
+        deadline = time.time() - max_age
+        created = dict(self.db.execute("SELECT name, created FROM partials").fetchall())
+        expired = []
+        if self.partials.exists():
+            for path in self.partials.glob("*.part"):
+                try:
+                    mtime = path.stat().st_mtime
+                except FileNotFoundError:
+                    continue
+                if max(mtime, created.pop(path.name, 0)) < deadline:
+                    self._discard_partial(path)
+                    expired.append(path)
+        # 文件已经不存在的预留
+        for name, ctime in created.items():
+            if ctime < deadline:
+                self._discard_partial(self.partials / name)
+        if expired:
+            logging.info(f"已删除 {len(expired)} 个过期的未完成上传")
+        return expired
+
+    def _evict(self, keep=None):
+        # 只计入已存入对象的实际大小，未完成上传声明的大小不能淘汰别人的文件
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM objects").fetchone()[0]
+        if total <= self.quota:
+            return
+        order = "last_access" if self.eviction == "lru" else "created"
+        rows = self.db.execute(f"SELECT sha256, size FROM objects ORDER BY {order}").fetchall()
+        for sha256, size in rows:
+            if total <= self.quota:
+                break
+            if sha256 == keep:
+                continue
+            try:
+                self.object_path(sha256).unlink()
+            except FileNotFoundError:
+                pass
+            with self.db:
+                self.db.execute("DELETE FROM files WHERE sha256 = ?", (sha256,))
+                self.db.execute("DELETE FROM objects WHERE sha256 = ?", (sha256,))
+            total -= size
+            logging.info(f"文件存储超过配额，已淘汰 {sha256} ({size} 字节)")
@@ -0,0 +1,140 @@
+# region COPYRIGHT
+
+# Copyright © 2025 [MinerMouse]
+# Luogu UID:1203704
+# Portions Copyright © 2025 ILoveScratch2
+
+# endregion
+
+# history.py
+
+import asyncio, json, logging, sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+
+class HistoryStore:
+    """按房间保存聊天记录 (SQLite, WAL 模式)
+
+    append() 只把消息放进内存缓冲并分配 id，由后台任务定期批量提交，
+    所有数据库操作都在单独的线程中串行执行，广播路径不会等待磁盘。
+    多个进程共用同一个数据库时，各自只分配 id % id_stride == id_offset 的 id。
+    """
+
+    def __init__(self, path="history.db", flush_interval=0.5, batch_size=500, id_offset=0, id_stride=1):
+        self.path = Path(path)
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.pending = []                # 待写入的 (id, room_id, message)
+        self.next_id = 1
+        self.id_offset = id_offset
+        self.id_stride = id_stride
+        self.db = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history")
+        self.wakeup = None
+        self.task = None
+
+    async def open(self):
+        loop = asyncio.get_running_loop()
+        last = await loop.run_in_executor(self.executor, self._open)
+        self.next_id = last + 1 + (self.id_offset - last - 1) % self.id_stride
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self._flusher())
+        logging.info(f"聊天记录数据库: {self.path.absolute()}")
+
+    def _open(self):
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY,
+                room TEXT NOT NULL,
+                timestamp TEXT NOT NULL,
+                data TEXT NOT NULL
+            )
+        """)
+        self.db.execute("CREATE INDEX IF NOT EXISTS messages_room_id ON messages (room, id)")
+        self.db.commit()
+        return self.db.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+        if self.db:
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.db.close)
+        self.executor.shutdown(wait=False)
+
+    def append(self, room_id, message):
+        """记录一条消息，为其写入自增的 "id" 字段后立即返回"""
+        message["id"] = self.next_id
+        self.next_id += self.id_stride
+        self.pending.append((message["id"], room_id, message))
+        if len(self.pending) >= self.batch_size and self.wakeup:
+            self.wakeup.set()
+        return message["id"]
+
+    async def _flusher(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        """把缓冲中的消息提交到数据库"""
+        if not self.pending or self.db is None:
+            return
+        batch, self.pending = self.pending, []
+        try:
+            await asyncio.get_running_loop().run_in_executor(self.executor, self._write, batch)
+        except Exception as e:
+            logging.error(f"写入聊天记录失败: {e}")
+
+    def _write(self, batch):
+        rows = [(msg_id, room_id, message.get("timestamp", ""), json.dumps(message, ensure_ascii=False))
+                for msg_id, room_id, message in batch]
+        with self.db:
+            self.db.executemany("INSERT INTO messages (id, room, timestamp, data) VALUES (?, ?, ?, ?)", rows)
+
+    async def fetch(self, room_id, limit=50, before_id=None, before=None):
+        """获取房间内最近的 limit 条消息，可选只取 id / 时间戳之前的一页
+
+        返回 (按时间正序的消息列表, 是否还有更早的消息)
+        """
+        await self.flush()
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, self._fetch, room_id, limit, before_id, before)
+
+    def _fetch(self, room_id, limit, before_id, before):
+        sql = "SELECT data FROM messages WHERE room = ?"
+        args = [room_id]
+        if before_id is not None:
+            sql += " AND id < ?"
+            args.append(before_id)
+        if before:
+            sql += " AND timestamp < ?"
+            args.append(before)
+        sql += " ORDER BY id DESC LIMIT ?"
+        args.append(limit + 1)
+        rows = self.db.execute(sql, args).fetchall()
+        has_more = len(rows) > limit
+        return [json.loads(row[0]) for row in reversed(rows[:limit])], has_more
+
+    async def drop_room(self, room_id):
+        """删除房间的全部记录 (房间关闭或过期时调用)"""
+        await self.flush()
+        if self.db is None:
+            return
+        await asyncio.get_running_loop().run_in_executor(self.executor, self._drop_room, room_id)
+
+    def _drop_room(self, room_id):
+        with self.db:
+            self.db.execute("DELETE FROM messages WHERE room = ?", (room_id,))
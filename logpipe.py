@@ -0,0 +1,161 @@
+# region COPYRIGHT
+
+# Copyright © 2025 [MinerMouse]
+# Luogu UID:1203704
+# Portions Copyright © 2025 ILoveScratch2
+
+# endregion
+
+# logpipe.py
+
+"""服务器日志 (server.ini 的 [LOGGING] 段)
+
+事件循环中的 logging 调用只把日志记录放进队列，格式化和写文件都在单独的线程中完成，
+磁盘或终端变慢不会拖慢事件循环。
+
+- level: 日志级别
+- format: 终端输出格式，text 或 json
+- file: 日志文件路径 (JSON Lines 格式，按大小轮转)，为空则不写文件；
+  多进程模式下各 worker 写入 文件名.编号
+- max_mb / backups: 单个日志文件的大小上限和保留的旧文件数
+- sample: 按类别 (logger 名称前缀) 抽样，例如 touchfox.presence=0.1,websockets=0.01
+  表示只保留 10% / 1% 的记录；WARNING 及以上级别不抽样
+
+每条记录带有当前连接的上下文 (conn / user / room / type)，由 ChatServer 通过 bind() 设置。
+"""
+
+import atexit, contextvars, json, logging, logging.handlers, queue, random
+from datetime import datetime
+
+SECTION = "LOGGING"
+
+_context = contextvars.ContextVar("touchfox_log_context", default={})
+_listener = None
+
+
+def bind(**fields):
+    """为当前任务 (及其创建的子任务) 的日志附加上下文字段"""
+    _context.set({**_context.get(), **fields})
+
+
+class ContextFilter(logging.Filter):
+    """在调用 logging 的任务中取出上下文 (监听线程中读取不到 contextvars)"""
+
+    def filter(self, record):
+        record.context = _context.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates               # logger 名称前缀 -> 保留比例
+        self.cache = {}                  # logger 名称 -> 保留比例 (None 为不抽样)
+
+    def rate(self, name):
+        if name not in self.cache:
+            prefixes = [p for p in self.rates if name == p or name.startswith(p + ".")]
+            self.cache[name] = self.rates[max(prefixes, key=len)] if prefixes else None
+        return self.cache[name]
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rate(record.name)
+        return rate is None or random.random() < rate
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            **getattr(record, "context", {}),
+        }
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """与 basicConfig 相同的格式，末尾附加上下文"""
+
+    def __init__(self):
+        super().__init__(logging.BASIC_FORMAT)
+
+    def format(self, record):
+        text = super().format(record)
+        context = getattr(record, "context", None)
+        if context:
+            text += " [" + " ".join(f"{k}={v}" for k, v in context.items()) + "]"
+        return text
+
+
+class FastQueueHandler(logging.handlers.QueueHandler):
+    """只在调用方合并 msg 和 args，格式化留给监听线程"""
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def parse_sample(text):
+    rates = {}
+    for item in text.split(","):
+        name, _, rate = item.partition("=")
+        if name.strip():
+            try:
+                rates[name.strip()] = min(1.0, max(0.0, float(rate)))
+            except ValueError:
+                logging.warning(f"无效的日志抽样设置: {item}")
+    return rates
+
+
+def setup(cfg, worker=None):
+    """把根 logger 换成队列 + 后台线程输出"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+    level = cfg.get(SECTION, "level", fallback="INFO").upper()
+    console = logging.StreamHandler()
+    console.setFormatter(JsonFormatter() if cfg.get(SECTION, "format", fallback="text") == "json"
+                         else TextFormatter())
+    handlers = [console]
+    path = cfg.get(SECTION, "file", fallback="")
+    if path:
+        if worker is not None:
+            path = f"{path}.{worker}"
+        file_handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=int(cfg.getfloat(SECTION, "max_mb", fallback=10) * 1024 * 1024),
+            backupCount=cfg.getint(SECTION, "backups", fallback=5), encoding="utf-8")
+        file_handler.setFormatter(JsonFormatter())
+        handlers.append(file_handler)
+
+    records = queue.SimpleQueue()
+    queue_handler = FastQueueHandler(records)
+    rates = parse_sample(cfg.get(SECTION, "sample", fallback=""))
+    if rates:
+        # 先抽样，被丢弃的记录不用再取上下文
+        queue_handler.addFilter(SamplingFilter(rates))
+    queue_handler.addFilter(ContextFilter())
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    # websockets 在 DEBUG 级别会为每一帧记一条日志，广播时开销太大，最多输出到 INFO
+    logging.getLogger("websockets").setLevel(max(root.level, logging.INFO))
+    _listener = logging.handlers.QueueListener(records, *handlers)
+    _listener.start()
+    atexit.register(shutdown)
+
+
+def shutdown():
+    """写完队列中剩余的日志"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,99 @@
+# region COPYRIGHT
+
+# Copyright © 2025 [MinerMouse]
+# Luogu UID:1203704
+# Portions Copyright © 2025 ILoveScratch2
+
+# endregion
+
+# loopwatch.py
+
+"""事件循环阻塞检测 (server.ini 的 [WATCHDOG] 段)
+
+事件循环中定时更新一个心跳时间，独立的监视线程发现心跳超过 threshold 秒没有更新时，
+说明循环正被同步代码卡住，此时抓取事件循环线程的调用栈，连同正在处理的消息类型
+记录到最近事件的环形缓冲区中，房主可以用 get_slow_events 查询。
+处理耗时 (含等待) 超过 slow_handler 秒的消息也会记录，但不带调用栈。
+"""
+
+import asyncio, logging, sys, threading, time, traceback
+from collections import deque
+
+SECTION = "WATCHDOG"
+
+
+class LoopWatchdog:
+    def __init__(self, threshold=0.25, slow_handler=1.0, capacity=100, handling=None):
+        self.threshold = threshold
+        self.slow_handler = slow_handler
+        self.events = deque(maxlen=capacity)
+        # asyncio.Task -> (消息类型, 用户名)，由 ChatServer.dispatch 维护
+        self.handling = {} if handling is None else handling
+        self.beat = time.monotonic()
+        self.loop = None
+        self.loop_thread = None
+        self.timer = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """在事件循环中调用"""
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self._heartbeat()
+        self.thread = threading.Thread(target=self._watch, name="touchfox-watchdog", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.timer:
+            self.timer.cancel()
+
+    def _heartbeat(self):
+        self.beat = time.monotonic()
+        self.timer = self.loop.call_later(self.threshold / 4, self._heartbeat)
+
+    def _watch(self):
+        stall = None                     # 当前这次阻塞的事件记录
+        while not self.stopped.wait(self.threshold / 4):
+            beat = self.beat
+            lag = time.monotonic() - beat
+            if stall is not None and stall["beat"] != beat:
+                # 循环已恢复，补上这次阻塞的总时长
+                stall["duration"] = round(beat - stall["beat"], 3)
+                logging.warning(f"事件循环阻塞了 {stall['duration']}s (处理 {stall['type']} 消息)")
+                stall = None
+            if stall is None and lag > self.threshold:
+                stall = self._capture(beat, lag)
+
+    def _capture(self, beat, lag):
+        frame = sys._current_frames().get(self.loop_thread)
+        task = asyncio.current_task(self.loop)
+        msg_type, username = self.handling.get(task, (None, None))
+        event = {
+            "kind": "loop_blocked",
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "type": msg_type,
+            "username": username,
+            "task": task.get_name() if task else None,
+            "duration": round(lag, 3),   # 阻塞结束后更新为总时长
+            "stack": "".join(traceback.format_stack(frame)) if frame else "",
+            "beat": beat,
+        }
+        self.events.append(event)
+        return event
+
+    def handler_done(self, msg_type, username, elapsed):
+        if elapsed > self.slow_handler:
+            self.events.append({
+                "kind": "slow_handler",
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "type": msg_type,
+                "username": username,
+                "duration": round(elapsed, 3),
+            })
+            logging.warning(f"处理 {username} 的 {msg_type} 消息用时 {elapsed:.3f}s")
+
+    def recent(self, limit=None):
+        events = list(self.events)[-limit:] if limit else list(self.events)
+        return [{k: v for k, v in e.items() if k != "beat"} for e in events]
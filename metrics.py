@@ -0,0 +1,187 @@
+# region COPYRIGHT
+
+# Copyright © 2025 [MinerMouse]
+# Luogu UID:1203704
+# Portions Copyright © 2025 ILoveScratch2
+
+# endregion
+
+# metrics.py
+
+"""服务器运行指标 (server.ini 的 [METRICS] 段)
+
+指标分为计数器、仪表和直方图三种，每个指标最多带一个标签 (例如消息类型)。
+房主可以发送 get_stats 获取 JSON 格式的快照；port 不为 0 时还会在该端口提供
+Prometheus 文本格式的 HTTP /metrics (多进程模式下第 i 个 worker 使用 port + i)。
+"""
+
+import asyncio, bisect, logging, math
+
+SECTION = "METRICS"
+
+# 耗时类直方图的默认桶 (秒)
+TIME_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+# 广播目标数的桶
+SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {}                 # 标签值 (无标签时为 None) -> 数值
+
+    def _labels(self, value, extra=""):
+        parts = [f'{self.label}="{_escape(value)}"'] if self.label and value is not None else []
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in self.values.items():
+            lines.append(f"{self.name}{self._labels(key)} {_number(value)}")
+        return lines
+
+    def snapshot(self):
+        if self.label is None:
+            return self.values.get(None, 0)
+        return dict(self.values)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, label=None):
+        self.values[label] = self.values.get(label, 0) + amount
+
+    def set(self, value, label=None):
+        """用于由其他对象自行累计的计数 (导出前同步过来)"""
+        self.values[label] = value
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, label=None):
+        self.values[label] = value
+
+    def replace(self, values):
+        """整体替换所有标签的值 (例如各房间的连接数，已删除的房间不再出现)"""
+        self.values = dict(values)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, label=None, buckets=TIME_BUCKETS):
+        super().__init__(name, help, label)
+        self.buckets = tuple(buckets)
+        self.values = {}                 # 标签值 -> [各桶计数..., +Inf 计数, 总和]
+
+    def observe(self, value, label=None):
+        counts = self.values.get(label)
+        if counts is None:
+            counts = self.values[label] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, counts in self.values.items():
+            total = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                total += count
+                le = 'le="+Inf"' if bound == math.inf else f'le="{_number(bound)}"'
+                lines.append(f"{self.name}_bucket{self._labels(key, le)} {total}")
+            lines.append(f"{self.name}_sum{self._labels(key)} {_number(counts[-1])}")
+            lines.append(f"{self.name}_count{self._labels(key)} {total}")
+        return lines
+
+    def snapshot(self):
+        result = {}
+        for key, counts in self.values.items():
+            count = sum(counts[:-1])
+            result[key] = {"count": count, "sum": counts[-1], "avg": counts[-1] / count if count else 0,
+                           "p50": self.quantile(counts, 0.5), "p99": self.quantile(counts, 0.99)}
+        return result if self.label is not None else result.get(None, {"count": 0})
+
+    def quantile(self, counts, q):
+        """按桶估算分位数 (返回所在桶的上界，超出最大桶时返回 None)"""
+        rank = q * sum(counts[:-1])
+        seen = 0
+        for bound, count in zip(self.buckets, counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []             # 导出前调用，用于更新按需计算的仪表
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, label=None):
+        return self._add(Counter(name, help, label))
+
+    def gauge(self, name, help, label=None):
+        return self._add(Gauge(name, help, label))
+
+    def histogram(self, name, help, label=None, buckets=TIME_BUCKETS):
+        return self._add(Histogram(name, help, label, buckets))
+
+    def collect(self):
+        for collector in self.collectors:
+            collector()
+
+    def render(self):
+        """Prometheus 文本格式"""
+        self.collect()
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        self.collect()
+        return {metric.name: metric.snapshot() for metric in self.metrics}
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+async def serve(registry, host, port):
+    """在 host:port 提供 HTTP GET /metrics"""
+
+    async def handle(reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+            parts = request.split(b" ", 2)
+            if len(parts) > 1 and parts[0] == b"GET" and parts[1].split(b"?")[0] == b"/metrics":
+                status, body = "200 OK", registry.render().encode()
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logging.info(f"指标接口: http://{host}:{port}/metrics")
+    return server
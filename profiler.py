@@ -0,0 +1,70 @@
+# region COPYRIGHT
+
+# Copyright © 2025 [MinerMouse]
+# Luogu UID:1203704
+# Portions Copyright © 2025 ILoveScratch2
+
+# endregion
+
+# profiler.py
+
+"""运行中服务器的采样分析器 (server.ini 的 [PROFILE] 段)
+
+独立线程每隔 interval 秒读取一次事件循环线程的调用栈，不需要插桩，开销很小。
+每个样本的根节点是当时正在处理的消息类型 (msg:类型，没有在处理消息时为 msg:-)，
+结果保存为 collapsed stack 格式 (每行 "帧;帧;... 次数")，可以直接用 flamegraph.pl
+或 https://www.speedscope.app 打开。
+"""
+
+import sys, threading, time
+from collections import Counter
+from pathlib import Path
+
+SECTION = "PROFILE"
+
+
+class SamplingProfiler:
+    def __init__(self, thread_id, interval=0.005, label=None):
+        """label() 在采样线程中调用，返回当前样本的根节点名称"""
+        self.thread_id = thread_id
+        self.interval = interval
+        self.label = label
+        self.samples = Counter()         # 折叠后的调用栈 -> 次数
+        self.count = 0
+        self.started = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.started = time.time()
+        self.thread = threading.Thread(target=self._run, name="touchfox-profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if self.label:
+                stack.append(self.label())
+            stack.reverse()
+            self.samples[";".join(stack)] += 1
+            self.count += 1
+
+    def save(self, path):
+        """写入 collapsed stack 文件 (同步执行，应放到线程中调用)"""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+        return path
@@ -8,18 +8,44 @@
 
 # server.py
 
-import asyncio, json, logging, hashlib
+import asyncio, logging, hashlib, mmap, os, struct, time
+import argparse, contextvars, multiprocessing, signal, socket, tempfile, threading
+from collections import deque, namedtuple
 from datetime import datetime, timedelta
 from pathlib import Path
 import websockets
 import configparser
 import re
+from bus import BusHub, make_bus
+from compression import server_extensions
+from federation import PeerBus
+import logpipe, metrics, tuning
+from loopwatch import LoopWatchdog
+from profiler import SamplingProfiler
+from codec import CodecError, SERVER_SCHEMAS, get_codec
+from filestore import FileStore
+from history import HistoryStore
+import wire
 
 # 版本定义
 SERVER_VERSION = "3.0.1"
-API_VERSION = "1.0.0"
+API_VERSION = "1.1.0"
 
+# 分块上传/下载的二进制帧头: 16字节传输ID + 8字节偏移量
+CHUNK_HEADER = struct.Struct("!16sQ")
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+
+# 为 True 时 ChatServer 的状态变更不发布到总线 (正在应用其他 worker 发来的变更)
+local_only = contextvars.ContextVar("local_only", default=False)
+
+# 发送队列满时的处理策略
+QUEUE_POLICIES = ("drop_oldest", "coalesce", "disconnect")
+INTERN_KIND = "intern"           # 紧凑协议的字符串ID定义帧
+
+# 读取配置前先用同步输出，main() 中按 [LOGGING] 换成后台线程输出
 logging.basicConfig(level=logging.INFO)
+log = logging.getLogger("touchfox")
+presence_log = logging.getLogger("touchfox.presence")
 
 INI_PATH = Path(__file__).with_name("server.ini")
 logging.info(f"加载配置文件: {INI_PATH.exists()}")
@@ -27,6 +53,22 @@ logging.info(f"加载配置文件: {INI_PATH.exists()}")
 def load_config():
     cfg = configparser.ConfigParser()
     cfg["SERVER"] = {"host": "localhost", "port": "8765", "owner_password": ""}  # 默认
+    cfg["QUEUE"] = {"max_size": "256", "policy": "drop_oldest"}
+    cfg["CODEC"] = {"backend": "auto", "compact": "true"}
+    cfg["COMPRESSION"] = {"enabled": "true", "level": "6", "mem_level": "5", "window_bits": "12",
+                          "threshold": "256", "no_context_takeover": "false"}
+    cfg["FILES"] = {"max_size_mb": "100", "quota_mb": "1024", "eviction": "lru", "partial_ttl_hours": "24",
+                    "user_reserve_mb": "200", "connection_reserve_mb": "100"}
+    cfg["PRESENCE"] = {"batch_window": "0.1"}
+    cfg["BUS"] = {"backend": "local", "path": "", "url": "redis://localhost:6379/0", "channel": "touchfox"}
+    cfg["FEDERATION"] = {"enabled": "false", "node_id": "", "peers": "", "secret": ""}
+    cfg["TUNING"] = dict(tuning.DEFAULTS)
+    cfg["METRICS"] = {"port": "0", "host": "127.0.0.1", "lag_interval": "0.5"}
+    cfg["WATCHDOG"] = {"enabled": "true", "threshold": "0.25", "slow_handler": "1.0", "capacity": "100"}
+    cfg["PROFILE"] = {"dir": "profiles", "interval_ms": "5", "max_seconds": "60"}
+    cfg["LOGGING"] = {"level": "INFO", "format": "text", "file": "", "max_mb": "10", "backups": "5", "sample": ""}
+    cfg["HISTORY"] = {"enabled": "true", "path": "history.db", "flush_interval": "0.5",
+                      "batch_size": "500", "max_page": "200"}
     logging.info(f"当前工作目录: {Path.cwd()}")
     logging.info(f"配置文件路径: {INI_PATH.absolute()}")
     
@@ -104,15 +146,255 @@ def load_config():
         logging.warning(f"无效的IP地址 {host} , 请关闭后使用ipconfig重新查询并输入")
         return
     
-    return host, port, owner_password
+    return host, port, owner_password, cfg
+
+# 消息处理函数登记表项
+Handler = namedtuple("Handler", "fn owner_only fields registered")
+
+# 处理函数抛出这些异常时视为消息格式错误，回复 error 而不是断开连接
+MALFORMED_ERRORS = (ValueError, TypeError, KeyError, AttributeError, OverflowError)
+
+# sqlite 的整数范围
+INT64_MIN, INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
+
+def handler(msg_type, owner_only=False, fields=(), registered=True):
+    """把 ChatServer 的方法登记为 msg_type 消息的处理函数"""
+    def decorate(fn):
+        fn.handler_spec = (msg_type, owner_only, fields, registered)
+        return fn
+    return decorate
+
+
+class ConnectionRegistry:
+    """连接注册表: websocket <-> 用户名 的双向索引
+
+    同一用户名可能同时存在多个连接 (例如客户端断线重连)，
+    按用户名查找时始终返回最近注册且仍在线的那个连接。
+    """
+
+    def __init__(self):
+        self._names = {}                 # websocket -> username
+        self._sockets = {}               # username -> [websocket, ...] 按注册顺序
+
+    def add(self, websocket, username):
+        self.remove(websocket)
+        self._names[websocket] = username
+        self._sockets.setdefault(username, []).append(websocket)
+
+    def remove(self, websocket):
+        """移除连接，返回其用户名 (未注册则返回 None)"""
+        username = self._names.pop(websocket, None)
+        if username is not None:
+            sockets = self._sockets[username]
+            sockets.remove(websocket)
+            if not sockets:
+                del self._sockets[username]
+        return username
+
+    def find(self, username):
+        """按用户名查找当前有效连接"""
+        sockets = self._sockets.get(username)
+        return sockets[-1] if sockets else None
+
+    def connections(self, username):
+        """用户名对应的全部连接"""
+        return tuple(self._sockets.get(username, ()))
+
+    def has_user(self, username):
+        return username in self._sockets
+
+    def usernames(self):
+        return list(self._sockets)
+
+    def get(self, websocket, default=None):
+        return self._names.get(websocket, default)
+
+    def keys(self):
+        return self._names.keys()
+
+    def items(self):
+        return self._names.items()
+
+    def __getitem__(self, websocket):
+        return self._names[websocket]
+
+    def __contains__(self, websocket):
+        return websocket in self._names
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def __len__(self):
+        return len(self._names)
+
+
+class OutboundQueue:
+    """单个连接的有界发送队列，由该连接自己的写任务负责发送
+
+    队列满时按 policy 处理:
+    - drop_oldest: 丢弃最早的待发送帧
+    - coalesce: 先丢弃过时的 user_list 帧 (只保留最新一份)，仍然满则丢弃最早的帧
+    - disconnect: 断开该连接
+    字符串ID定义帧 (紧凑协议) 不会被丢弃，否则后续的帧无法解码。
+    """
+
+    def __init__(self, websocket, max_size=256, policy="drop_oldest"):
+        self.websocket = websocket
+        self.max_size = max_size
+        self.policy = policy
+        self.frames = deque()            # (消息类型, 已编码的帧, 是否为文本帧)
+        self.ready = asyncio.Event()
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0                  # 连接关闭时未能发出的帧数
+        self.high_water = 0
+        self.overflowed = False
+        self.closing = None              # close_after() 设置的 (关闭码, 原因)
+        self.task = asyncio.create_task(self._writer())
+
+    def __len__(self):
+        return len(self.frames)
+
+    def put(self, kind, frame, text=True):
+        """放入一帧，返回 False 表示队列已满且策略要求断开连接"""
+        if self.overflowed or self.closing or self.task.done():
+            return True
+        if len(self.frames) >= self.max_size:
+            if self.policy == "disconnect":
+                # 交给写任务关闭连接
+                self.overflowed = True
+                self.frames.clear()
+                self.ready.set()
+                return False
+            if self.policy == "coalesce":
+                self._coalesce(kind)
+            self._drop_oldest()
+        self.frames.append((kind, frame, text))
+        self.high_water = max(self.high_water, len(self.frames))
+        self.ready.set()
+        return True
+
+    def close_after(self, code, reason):
+        """发完已排队的帧后关闭连接，之后放入的帧都被忽略"""
+        self.closing = (code, reason)
+        self.ready.set()
+
+    def _coalesce(self, kind):
+        # 新帧本身是 user_list 时，队列中的 user_list 全部过时；否则只保留最新的一份
+        keep_latest = kind != "user_list"
+        kept = deque()
+        for item in reversed(self.frames):
+            if item[0] == "user_list":
+                if not keep_latest:
+                    self.dropped += 1
+                    continue
+                keep_latest = False
+            kept.appendleft(item)
+        self.frames = kept
+
+    def _drop_oldest(self):
+        excess = len(self.frames) - self.max_size + 1
+        if excess <= 0:
+            return
+        kept = deque()
+        for item in self.frames:
+            if excess > 0 and item[0] != INTERN_KIND:
+                excess -= 1
+                self.dropped += 1
+                continue
+            kept.append(item)
+        self.frames = kept
+
+    async def _writer(self):
+        try:
+            while True:
+                if self.overflowed:
+                    await self.websocket.close(1008, "send queue overflow")
+                    return
+                if not self.frames:
+                    if self.closing:
+                        await self.websocket.close(*self.closing)
+                        return
+                    self.ready.clear()
+                    await self.ready.wait()
+                    continue
+                _, frame, text = self.frames.popleft()
+                await self.websocket.send(frame, text=text)
+                self.sent += 1
+        except websockets.ConnectionClosed:
+            self.failed += 1 + len(self.frames)
+            self.frames.clear()
+
+    async def close(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
 
 class ChatServer:
-    def __init__(self, host, port, owner_password):
+    def __init__(self, host, port, owner_password, cfg=None, worker=None):
+        """worker 为 (编号, 总数) 时以多进程模式中的一个 worker 运行"""
         self.host = host
         self.port = port
         self.owner_password = owner_password
-        self.clients = {}                # websocket -> username
+        self.cfg = cfg or configparser.ConfigParser()
+        self.queue_size = self.cfg.getint("QUEUE", "max_size", fallback=256)
+        self.queue_policy = self.cfg.get("QUEUE", "policy", fallback="drop_oldest")
+        if self.queue_policy not in QUEUE_POLICIES:
+            log.warning(f"未知的队列策略 {self.queue_policy}，使用 drop_oldest")
+            self.queue_policy = "drop_oldest"
+        self.codec = get_codec(self.cfg.get("CODEC", "backend", fallback="auto"), SERVER_SCHEMAS)
+        self.compact_enabled = self.cfg.getboolean("CODEC", "compact", fallback=True) and wire.available()
+        self.interns = wire.InternTable() if self.compact_enabled else None
+        self.compact = {}                # 使用紧凑协议的 websocket -> 已发送过定义的字符串ID集合
+        self.queues = {}                 # websocket -> OutboundQueue
+        self.recv_dir = Path("recvfiles")
+        self.file_max_size = self.cfg.getint("FILES", "max_size_mb", fallback=100) * 1024 * 1024
+        self.files = FileStore(
+            self.recv_dir,
+            self.cfg.getint("FILES", "quota_mb", fallback=1024) * 1024 * 1024,
+            self.cfg.get("FILES", "eviction", fallback="lru"),
+            self.cfg.getint("FILES", "user_reserve_mb", fallback=200) * 1024 * 1024)
+        # 单个连接上同时进行的上传最多预留这么多字节
+        self.connection_reserve = self.cfg.getint("FILES", "connection_reserve_mb", fallback=100) * 1024 * 1024
+        self.uploads = {}                # (上传者, upload_id) -> 进行中的上传
+        # 未完成的上传保留这么久 (秒) 用于断点续传，之后删除；不大于 0 时一直保留
+        self.partial_ttl = self.cfg.getfloat("FILES", "partial_ttl_hours", fallback=24) * 3600
+        self.partial_timer = None
+        self.downloads = {}              # download_id -> (websocket, 发送任务)
+        self.history = None              # 聊天记录存储
+        self.worker = worker
+        self.bus = None                  # 多进程模式或联邦模式下的消息总线
+        self.remote_users = {}           # username -> 该用户在线的其他 worker (或联邦节点) 集合
+        self.peer_sockets = {}           # 其他联邦节点连进来的 websocket -> 节点ID
+        self.state_version = 0.0         # 房主/禁言/屏蔽词等全局状态的最后修改时间
+        if self.cfg.getboolean("HISTORY", "enabled", fallback=True):
+            # 多个 worker 共用一个数据库，各自分配不重叠的 id
+            index, count = worker or (0, 1)
+            self.history = HistoryStore(
+                self.cfg.get("HISTORY", "path", fallback="history.db"),
+                self.cfg.getfloat("HISTORY", "flush_interval", fallback=0.5),
+                self.cfg.getint("HISTORY", "batch_size", fallback=500),
+                index, count)
+        self.history_max_page = self.cfg.getint("HISTORY", "max_page", fallback=200)
+        self.dropped_frames = 0          # 已关闭连接的丢帧数
+        self.failed_frames = 0           # 已关闭连接上未能发出的帧数
+        self.slow_disconnects = 0        # 因发送队列溢出被断开的连接数
+        self.clients = ConnectionRegistry()  # websocket <-> username
         self.user_order = []             # 按加入顺序保存用户名
+        self.presence_seq = 0            # 用户列表版本号，每次有用户加入/离开加一
+        self.delta_clients = set()       # 接收增量用户列表 (user_joined/user_left) 的连接
+        self.presence_window = self.cfg.getfloat("PRESENCE", "batch_window", fallback=0.1)
+        self.presence_pending = {}       # 窗口内状态有变化的用户名 -> 变化前是否在线
+        self.presence_changes = 0        # presence_changed 的调用次数
+        # 注册时已收到完整用户列表的旧版连接 -> 当时的 presence_changes，
+        # 之后没有新的变化时推送窗口内不必再发一遍
+        self.fresh_snapshots = {}
+        self.presence_timer = None
+        self.presence_flushed = 0.0      # 上次推送用户列表变化的时间 (loop.time())
         self.user_prefs = {}             # username -> preferences
         self.rooms = {
             "global": {
@@ -122,12 +404,108 @@ class ChatServer:
             }
         }                                # room_id -> room_info
         self.user_rooms = {}             # username -> room_id
-        self.expiring_rooms = {}         # room_id -> expiry_time (datetime object)
-        self.expiry_task = None          # 房间过期检查任务
+        self.room_sockets = {"global": set()}  # room_id -> websocket集合 (房间成员索引)
+        self.room_timers = {}            # room_id -> [过期提醒定时器, 删除定时器]
+        self.background_tasks = set()    # 定时器触发的任务，保留引用防止被回收
         self.owner = None                # 房主用户名
         self.muted_users = set()         # 被禁言的用户集合
         self.banned_words = []           # 屏蔽词列表
+        self.banned_pattern = None       # 由屏蔽词列表编译成的正则
+        self.banned_separate = []        # 含分组、不能合并的屏蔽词
         self.kicked_users = []           # 被踢出的用户列表，包含时间戳
+        self.handlers = {}               # 消息类型 -> Handler
+        self.init_metrics()
+        self.handling = {}               # 正在处理消息的 asyncio.Task -> (消息类型, 用户名)
+        self.watchdog = None             # 事件循环阻塞检测
+        if self.cfg.getboolean("WATCHDOG", "enabled", fallback=True):
+            self.watchdog = LoopWatchdog(self.cfg.getfloat("WATCHDOG", "threshold", fallback=0.25),
+                                         self.cfg.getfloat("WATCHDOG", "slow_handler", fallback=1.0),
+                                         self.cfg.getint("WATCHDOG", "capacity", fallback=100),
+                                         self.handling)
+        self.profiler = None             # 正在运行的采样分析器
+        self.profile_timer = None
+        for name in dir(type(self)):
+            spec = getattr(getattr(type(self), name), "handler_spec", None)
+            if spec:
+                self.register_handler(spec[0], getattr(self, name), *spec[1:])
+
+    def init_metrics(self):
+        self.metrics = metrics.Registry()
+        m = self.metrics
+        self.m_received = m.counter("touchfox_messages_received_total", "收到的消息数", "type")
+        self.m_handler = m.histogram("touchfox_handler_seconds", "消息处理耗时", "type")
+        self.m_broadcast = m.histogram("touchfox_broadcast_seconds", "broadcast 编码并放入发送队列的耗时", "type")
+        self.m_fanout = m.histogram("touchfox_broadcast_targets", "每次 broadcast 的目标连接数", "type",
+                                    metrics.SIZE_BUCKETS)
+        self.m_room_frames = m.counter("touchfox_room_frames_total",
+                                       "各房间 broadcast 放入发送队列的帧数 (all 为发给所有连接)", "room")
+        self.m_file_bytes = m.counter("touchfox_file_bytes_total", "文件上传/下载的字节数", "direction")
+        self.m_loop_lag = m.histogram("touchfox_loop_lag_seconds", "事件循环调度延迟")
+        self.m_connections = m.gauge("touchfox_connections", "当前连接数")
+        self.m_room_connections = m.gauge("touchfox_room_connections", "各房间的连接数", "room")
+        self.m_queue_depth = m.gauge("touchfox_send_queue_depth", "所有发送队列中的帧数")
+        self.m_dropped = m.counter("touchfox_dropped_frames_total", "发送队列满时丢弃的帧数")
+        self.m_failed = m.counter("touchfox_send_failures_total", "连接关闭导致未能发出的帧数")
+        self.m_slow = m.counter("touchfox_slow_disconnects_total", "因发送队列溢出被断开的连接数")
+        m.collectors.append(self.collect_metrics)
+
+    def collect_metrics(self):
+        queues = self.queues.values()
+        self.m_connections.set(len(self.clients))
+        self.m_room_connections.replace((room_id, len(sockets)) for room_id, sockets in self.room_sockets.items())
+        self.m_queue_depth.set(sum(len(q) for q in queues))
+        self.m_dropped.set(self.dropped_frames + sum(q.dropped for q in queues))
+        self.m_failed.set(self.failed_frames + sum(q.failed for q in queues))
+        self.m_slow.set(self.slow_disconnects)
+
+    async def monitor_loop(self, interval):
+        """定时测量事件循环的调度延迟 (实际唤醒时间比预定时间晚多少)"""
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + interval
+            await asyncio.sleep(interval)
+            self.m_loop_lag.observe(max(0.0, loop.time() - expected))
+
+    # ---------- 采样分析 ----------
+    def start_profile(self, duration=0):
+        """开始采样，duration 秒后 (不超过 max_seconds) 自动停止并保存；已在采样时返回 None"""
+        if self.profiler is not None:
+            return None
+        max_seconds = self.cfg.getfloat("PROFILE", "max_seconds", fallback=60)
+        duration = min(duration, max_seconds) if duration > 0 else max_seconds
+        loop = asyncio.get_running_loop()
+
+        def label():
+            # 在采样线程中调用，只读取字典，不修改事件循环的状态
+            msg_type, _ = self.handling.get(asyncio.current_task(loop), (None, None))
+            return f"msg:{msg_type or '-'}"
+
+        self.profiler = SamplingProfiler(threading.get_ident(),
+                                         self.cfg.getfloat("PROFILE", "interval_ms", fallback=5) / 1000, label)
+        self.profiler.start()
+        self.profile_timer = loop.call_later(duration, self.spawn, self.stop_profile)
+        log.info(f"开始采样分析，最长 {duration:g} 秒")
+        return duration
+
+    async def stop_profile(self):
+        """停止采样并写入文件，返回 (路径, 样本数)；没有在采样时返回 None"""
+        profiler, self.profiler = self.profiler, None
+        if profiler is None:
+            return None
+        self.profile_timer.cancel()
+        profiler.stop()
+        name = f"profile-{datetime.now():%Y%m%d-%H%M%S-%f}-{os.getpid()}.txt"
+        path = await asyncio.get_running_loop().run_in_executor(
+            None, profiler.save, Path(self.cfg.get("PROFILE", "dir", fallback="profiles")) / name)
+        log.info(f"采样分析已保存到 {path} ({profiler.count} 个样本)")
+        return path, profiler.count
+
+    def toggle_profile(self):
+        """SIGUSR1 信号: 开始或停止采样分析"""
+        if self.profiler is None:
+            self.start_profile()
+        else:
+            self.spawn(self.stop_profile)
 
     async def add_user(self, username):
         if username not in self.user_order:
@@ -140,18 +518,25 @@ class ChatServer:
         if room_id not in self.rooms:
             return False
         
+        sockets = self.clients.connections(username)
+        
         # 离开当前房间
         if username in self.user_rooms:
             old_room = self.user_rooms[username]
             self.rooms[old_room]["members"].discard(username)
+            if old_room in self.room_sockets:
+                self.room_sockets[old_room].difference_update(sockets)
         
         # 加入新房间
         self.user_rooms[username] = room_id
         self.rooms[room_id]["members"].add(username)
+        self.room_sockets[room_id].update(sockets)
+        self.publish("join_room", username=username, room=room_id)
         return True
 
     def create_room(self, room_id, room_name, expiry_hours=1):
-        if room_id in self.rooms:
+        # 房间ID会作为 room_info 中的键，必须是非空字符串
+        if not isinstance(room_id, str) or not room_id or room_id in self.rooms:
             return False
         
         # 默认房间有效期为1小时
@@ -163,472 +548,1289 @@ class ChatServer:
             "created": datetime.now().isoformat(),
             "expires": expiry_time.isoformat()
         }
+        self.room_sockets[room_id] = set()
         
-        # 添加到待检查过期的房间列表
-        self.expiring_rooms[room_id] = expiry_time
+        # 只由创建房间的 worker 负责过期删除
+        self.schedule_room_expiry(room_id, expiry_time)
+        self.publish("create_room", room=room_id, info=self.rooms[room_id] | {"members": []})
         return True
 
-    async def register(self, websocket, username):
-        self.clients[websocket] = username
-        logging.info(f"{username} 加入了聊天室")
-        await self.add_user(username)
+    def schedule_room_expiry(self, room_id, expiry_time):
+        """用事件循环定时器安排过期提醒 (提前10分钟) 和删除，空闲时没有任何开销"""
+        loop = asyncio.get_running_loop()
+        delay = (expiry_time - datetime.now()).total_seconds()
+        now = loop.time()
+        self.room_timers[room_id] = [
+            loop.call_at(now + max(0, delay - 600), self.spawn, self.warn_room_expiry, room_id),
+            loop.call_at(now + max(0, delay), self.spawn, self.expire_room, room_id)
+        ]
+
+    def cancel_room_expiry(self, room_id):
+        for timer in self.room_timers.pop(room_id, ()):
+            timer.cancel()
+
+    def spawn(self, fn, *args):
+        task = asyncio.create_task(fn(*args))
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+
+    async def warn_room_expiry(self, room_id):
+        if room_id in self.rooms:
+            await self.broadcast({
+                "type": "system_message",
+                "content": f"房间 {self.rooms[room_id]['name']} 将在10分钟后删除",
+                "timestamp": datetime.now().isoformat()
+            }, room_id)
+
+    async def expire_room(self, room_id):
+        self.room_timers.pop(room_id, None)
+        if room_id in self.rooms:
+            await self.remove_room(room_id, f"房间 {self.rooms[room_id]['name']} 已过期并被删除")
+
+    async def remove_room(self, room_id, notice):
+        """通知房间成员后删除房间，成员移至全局聊天室"""
+        self.publish("remove_room", room=room_id, notice=notice)
+        # 其他 worker 各自通知本地成员并移动房间，这里的广播和换房间都不再发布
+        token = local_only.set(True)
+        try:
+            await self._remove_room(room_id, notice)
+        finally:
+            local_only.reset(token)
+
+    async def _remove_room(self, room_id, notice):
+        self.cancel_room_expiry(room_id)
+        # 发送房间删除通知
         await self.broadcast({
-            "type": "user_list",
-            "users": self.user_order,
-            "owner": self.owner
-        })
+            "type": "system_message",
+            "content": notice,
+            "timestamp": datetime.now().isoformat()
+        }, room_id)
+        # 将房间成员移至全局聊天室
+        members = list(self.rooms[room_id]["members"])
+        for username in members:
+            await self.join_room(username, "global")
+        # 删除房间
+        del self.rooms[room_id]
+        self.room_sockets.pop(room_id, None)
+        # 通知用户房间已变更
+        for username in members:
+            for ws in self.clients.connections(username):
+                await self.send_room_info(ws)
+        if self.history:
+            await self.history.drop_room(room_id)
+
+    def rebuild_banned_pattern(self):
+        """编译屏蔽词，只在屏蔽词列表变化时调用
+
+        不含分组的屏蔽词合并为一个正则；含分组的单独编译，
+        否则合并后分组被重新编号，其中的反向引用 (例如 \\1) 会指向别的分组。
+        """
+        plain, self.banned_separate = [], []
+        for word in self.banned_words:
+            try:
+                pattern = re.compile(word, re.IGNORECASE)
+            except re.error:
+                # 不是合法的正则，按普通文本匹配
+                pattern = re.compile(re.escape(word), re.IGNORECASE)
+            (self.banned_separate if pattern.groups else plain).append(pattern)
+        try:
+            self.banned_pattern = re.compile("|".join(f"(?:{p.pattern})" for p in plain),
+                                             re.IGNORECASE) if plain else None
+        except re.error:
+            # 合并后冲突 (例如只能出现在开头的行内标志)，全部单独匹配
+            self.banned_pattern = None
+            self.banned_separate = plain + self.banned_separate
+
+    def contains_banned_word(self, content):
+        if self.banned_pattern is not None and self.banned_pattern.search(content):
+            return True
+        return any(pattern.search(content) for pattern in self.banned_separate)
+
+    async def register(self, websocket, username, wire_formats=(), deltas=False):
+        first_local = not self.clients.has_user(username)
+        self.clients.add(websocket, username)
+        joined = username not in self.user_order
+        await self.add_user(username)
+        logpipe.bind(user=username, room=self.user_rooms.get(username))
+        presence_log.info(f"{username} 加入了聊天室")
+        # 同名用户重复注册时 add_user 不会再次加入房间，这里补上房间索引
+        self.room_sockets[self.user_rooms.get(username, "global")].add(websocket)
+        if deltas:
+            self.delta_clients.add(websocket)
+        else:
+            # 下面发送的完整列表已经包含本次加入；presence_changed 可能立即推送，所以先登记
+            self.fresh_snapshots[websocket] = self.presence_changes + joined
+        if joined:
+            self.presence_changed(username, False)
+        if first_local:
+            self.publish("presence", username=username, online=True, room=self.user_rooms.get(username))
+        # 新连接总是收到完整的用户列表
+        self.send(websocket, self.user_snapshot())
         await self.send_room_info(websocket)
-        # 发送API版本信息
-        await websocket.send(json.dumps({
-            "type": "api_version",
-            "version": API_VERSION
-        }))
+        # 发送API版本信息，客户端支持时同时协商紧凑协议
+        reply = {"type": "api_version", "version": API_VERSION}
+        use_compact = self.compact_enabled and wire.WIRE_NAME in wire_formats
+        if use_compact:
+            reply["wire"] = wire.WIRE_NAME
+        self.send(websocket, reply)
+        # api_version 本身仍是 JSON，之后的消息才切换
+        if use_compact and websocket not in self.compact:
+            self.compact[websocket] = set()
 
     async def unregister(self, websocket):
-        username = self.clients.pop(websocket, None)
-        if username and username in self.user_order:
+        username = self.clients.remove(websocket)
+        self.delta_clients.discard(websocket)
+        self.fresh_snapshots.pop(websocket, None)
+        if username is not None:
+            room_id = self.user_rooms.get(username)
+            if room_id in self.room_sockets:
+                self.room_sockets[room_id].discard(websocket)
+        # 同名用户还有其他在线连接时保留在用户列表中
+        if username and not self.clients.has_user(username):
+            self.publish("presence", username=username, online=False)
+            self.drop_user(username)
+
+    def drop_user(self, username):
+        """用户在本 worker 和其他 worker 上都没有连接时从用户列表中移除"""
+        if username in self.user_order and not self.clients.has_user(username) \
+                and not self.remote_users.get(username):
             self.user_order.remove(username)
-            logging.info(f"{username} 退出了聊天室")
-            await self.broadcast({
-                "type": "user_list",
-                "users": self.user_order
-            })
+            presence_log.info(f"{username} 退出了聊天室")
+            self.presence_changed(username, True)
+
+    def user_snapshot(self):
+        return {
+            "type": "user_list",
+            "users": self.user_order,
+            "owner": self.owner,
+            "seq": self.presence_seq
+        }
+
+    def presence_changed(self, username, was_online):
+        """记录一次用户加入/离开
+
+        距离上次推送已超过 batch_window 时立即推送，否则合并到窗口结束时一起推送，
+        大量客户端同时重连时不会每次注册都广播一遍。
+        """
+        self.presence_pending.setdefault(username, was_online)
+        self.presence_changes += 1
+        if self.presence_timer is not None:
+            return
+        loop = asyncio.get_running_loop()
+        wait = self.presence_flushed + self.presence_window - loop.time()
+        if wait <= 0:
+            self.flush_presence()
+        else:
+            self.presence_timer = loop.call_later(wait, self.flush_presence)
+
+    def flush_presence(self):
+        """推送窗口内的用户变化: 支持增量的连接收到带版本号的 user_joined/user_left
+        (多个变化合并为一条 user_presence)，其他 (旧版) 连接收到完整的 user_list"""
+        self.presence_timer = None
+        self.presence_flushed = asyncio.get_running_loop().time()
+        pending, self.presence_pending = self.presence_pending, {}
+        fresh, self.fresh_snapshots = self.fresh_snapshots, {}
+        online = set(self.user_order)
+        # 窗口内加入后又离开 (或反之) 的用户不用通知
+        joined = [u for u, was in pending.items() if not was and u in online]
+        left = [u for u, was in pending.items() if was and u not in online]
+        if not joined and not left:
+            return
+        self.presence_seq += 1
+        if len(joined) + len(left) == 1:
+            kind = "user_joined" if joined else "user_left"
+            delta = {"type": kind, "username": (joined or left)[0], "seq": self.presence_seq}
+        else:
+            delta = {"type": "user_presence", "joined": joined, "left": left, "seq": self.presence_seq}
+        deltas, legacy = [], []
+        for ws in self.clients:
+            if ws in self.delta_clients:
+                deltas.append(ws)
+            elif fresh.get(ws) != self.presence_changes:
+                # 注册时收到的列表已经包含了这些变化的旧版连接跳过
+                legacy.append(ws)
+        self.deliver(deltas, delta)
+        if legacy:
+            self.deliver(legacy, self.user_snapshot())
 
     async def broadcast(self, message, room_id=None):
-        disconnected = []
+        start = time.perf_counter()
+        self.publish("broadcast", room=room_id, message=message)
         targets = []
         
         if room_id:
             # 发送给指定房间成员
-            if room_id in self.rooms:
-                targets = [ws for ws, name in self.clients.items() 
-                          if name in self.rooms[room_id]["members"]]
+            targets = list(self.room_sockets.get(room_id, ()))
         else:
             # 发送给所有连接
             targets = list(self.clients.keys())
         
+        # 序列化一次消息，放入所有目标连接的发送队列
+        self.deliver(targets, message)
+        kind = message.get("type")
+        self.m_fanout.observe(len(targets), kind)
+        self.m_room_frames.inc(len(targets), room_id or "all")
+        self.m_broadcast.observe(time.perf_counter() - start, kind)
+
+    def deliver(self, targets, message):
+        # JSON 和紧凑格式各最多编码一次
+        kind = message.get("type")
+        frame = compact_frame = None
         for ws in targets:
-            try:
-                await ws.send(json.dumps(message))
-            except websockets.ConnectionClosed:
-                disconnected.append(ws)
-        
-        for ws in disconnected:
-            await self.unregister(ws)
+            known = self.compact.get(ws)
+            if known is None:
+                if frame is None:
+                    frame = self.codec.encode(message)
+                self.enqueue(ws, kind, frame)
+                continue
+            if compact_frame is None:
+                compact_frame, used = self.interns.encode(message)
+            missing = used - known
+            if missing:
+                # 先发送该连接还不知道的字符串ID定义
+                known.update(missing)
+                self.enqueue(ws, INTERN_KIND, self.interns.definitions(missing), text=False)
+            self.enqueue(ws, kind, compact_frame, text=False)
+
+    def send(self, websocket, message):
+        """发送单条消息给指定连接 (不会阻塞调用方)"""
+        self.deliver((websocket,), message)
+
+    def enqueue(self, websocket, kind, frame, text=True):
+        queue = self.queues.get(websocket)
+        if queue is None:
+            return
+        if not queue.put(kind, frame, text):
+            self.slow_disconnects += 1
+            log.warning(f"{self.clients.get(websocket)} 发送队列已满，断开连接")
+
+    def queue_stats(self):
+        """发送队列的深度统计"""
+        queues = list(self.queues.values())
+        return {
+            "policy": self.queue_policy,
+            "max_size": self.queue_size,
+            "connections": len(queues),
+            "total_depth": sum(len(q) for q in queues),
+            "max_depth": max((len(q) for q in queues), default=0),
+            "high_water": max((q.high_water for q in queues), default=0),
+            "dropped": self.dropped_frames + sum(q.dropped for q in queues),
+            "slow_disconnects": self.slow_disconnects
+        }
 
     async def send_room_info(self, websocket):
         if websocket in self.clients:
             username = self.clients[websocket]
             current_room = self.user_rooms.get(username, "global")
-            await websocket.send(json.dumps({
+            self.send(websocket, {
                 "type": "room_info",
                 "current_room": current_room,
                 "room_name": self.rooms[current_room]["name"],
                 "rooms": {k: v["name"] for k, v in self.rooms.items()}
-            }))
-
-    async def check_room_expiry(self):
-        """定期检查房间是否过期"""
-        while True:
-            current_time = datetime.now()
-            
-            # 检查是否有房间需要发送即将过期通知 (10分钟前)
-            for room_id, expiry_time in list(self.expiring_rooms.items()):
-                time_diff = (expiry_time - current_time).total_seconds()
-                if 0 < time_diff <= 600:  # 10分钟内过期
-                    # 发送即将过期通知
-                    await self.broadcast({
-                        "type": "system_message",
-                        "content": f"房间 {self.rooms[room_id]['name']} 将在10分钟后删除",
-                        "timestamp": current_time.isoformat()
-                    }, room_id)
-                    # 从待通知列表中移除
-                    del self.expiring_rooms[room_id]
-            
-            # 检查是否有房间已过期需要删除
-            for room_id, room_info in list(self.rooms.items()):
-                if room_id != "global" and "expires" in room_info:
-                    if datetime.fromisoformat(room_info["expires"]) <= current_time:
-                        # 发送房间删除通知
-                        await self.broadcast({
-                            "type": "system_message",
-                            "content": f"房间 {room_info['name']} 已过期并被删除",
-                            "timestamp": current_time.isoformat()
-                        }, room_id)
-                        # 将房间成员移至全局聊天室
-                        for username in list(room_info["members"]):
-                            await self.join_room(username, "global")
-                            # 通知用户房间已变更
-                            for ws, name in self.clients.items():
-                                if name == username:
-                                    await self.send_room_info(ws)
-                                    break
-                        # 删除房间
-                        del self.rooms[room_id]
-            
-            await asyncio.sleep(60)  # 每分钟检查一次
+            })
 
     async def handle_client(self, websocket, path=None):
+        address = websocket.remote_address
+        logpipe.bind(conn=f"{address[0]}:{address[1]}" if address else "-")
+        self.queues[websocket] = OutboundQueue(websocket, self.queue_size, self.queue_policy)
         try:
             async for raw in websocket:
-                data = json.loads(raw)
-                username = self.clients.get(websocket)
-                
-                # 检查是否是房主验证
-                if data["type"] == "verify_owner":
-                    password = data["password"]
-                    is_hashed = data.get("is_hashed", False)
-                    
-                    if is_hashed:
-                        # 如果是已哈希的密码，直接比较
-                        if password == self.owner_password:
-                            self.owner = data["username"]
-                            await websocket.send(json.dumps({
-                                "type": "owner_verified",
-                                "success": True
-                            }))
-                            await self.broadcast({
-                                "type": "owner_changed",
-                                "owner": self.owner
-                            })
-                        else:
-                            await websocket.send(json.dumps({
-                                "type": "owner_verified",
-                                "success": False
-                            }))
-                    else:
-                        # 否则对密码进行哈希后再比较
-                        hashed_password = hashlib.sha256(password.encode()).hexdigest()
-                        if hashed_password == self.owner_password:
-                            self.owner = data["username"]
-                            await websocket.send(json.dumps({
-                                "type": "owner_verified",
-                                "success": True
-                            }))
-                            await self.broadcast({
-                                "type": "owner_changed",
-                                "owner": self.owner
-                            })
-                        else:
-                            await websocket.send(json.dumps({
-                            "success": False,
-                            "message": "密码错误"
-                        }))
+                if self.queues[websocket].closing:
+                    # 已被踢出，等待写任务关闭连接期间收到的消息不再处理
                     continue
-                
-                if data["type"] == "register":
-                    await self.register(websocket, data["username"])
-                elif data["type"] == "message":
-                    # 检查是否被禁言
-                    if username in self.muted_users:
-                        await websocket.send(json.dumps({
-                            "type": "error",
-                            "message": "您已被禁言，无法发送消息"
-                        }))
-                        continue
-                    
-                    # 检查屏蔽词
-                    content = data["content"]
-                    contains_banned_word = False
-                    for word in self.banned_words:
-                        if re.search(word, content, re.IGNORECASE):
-                            contains_banned_word = True
-                            break
-                    
-                    if contains_banned_word:
-                        await websocket.send(json.dumps({
-                            "type": "banned_word",
-                            "message": "您输入的内容含有屏蔽词，请重新输入"
-                        }))
-                        continue
-                    
-                    room_id = self.user_rooms.get(username, "global")
-                    await self.broadcast({
-                        "type": "message",
-                        "username": username,
-                        "content": content,
-                        "timestamp": datetime.now().isoformat(),
-                        "room": room_id,
-                        "is_owner": username == self.owner
-                    }, room_id)
-                elif data["type"] == "private_message":
-                    # 检查是否被禁言
-                    if username in self.muted_users:
-                        await websocket.send(json.dumps({
-                            "type": "error",
-                            "message": "您已被禁言，无法发送消息"
-                        }))
+                try:
+                    if isinstance(raw, str):
+                        data = self.codec.decode(raw)
+                    elif websocket not in self.compact:
+                        # 二进制帧只用于分块上传
+                        await self.handle_chunk(websocket, raw)
                         continue
-                    
-                    target = data["target"]
-                    sender = username
-                    content = data["content"]
-                    
-                    # 检查屏蔽词
-                    contains_banned_word = False
-                    for word in self.banned_words:
-                        if re.search(word, content, re.IGNORECASE):
-                            contains_banned_word = True
-                            break
-                    
-                    if contains_banned_word:
-                        await websocket.send(json.dumps({
-                            "type": "banned_word",
-                            "message": "您输入的内容含有屏蔽词，请重新输入"
-                        }))
+                    elif raw[:1] == wire.CHUNK_PREFIX:
+                        await self.handle_chunk(websocket, memoryview(raw)[1:])
                         continue
-                    
-                    for ws, name in self.clients.items():
-                        if name == target:
-                            await ws.send(json.dumps({
-                                "type": "private_message",
-                                "from": sender,
-                                "content": content,
-                                "timestamp": datetime.now().isoformat(),
-                                "room": self.user_rooms.get(sender, "global")
-                            }))
-                            await websocket.send(json.dumps({
-                                "type": "private_message_sent",
-                                "to": target,
-                                "content": content,
-                                "timestamp": datetime.now().isoformat()
-                            }))
-                            break
-                elif data["type"] == "get_users":
-                    await websocket.send(json.dumps({
-                        "type": "user_list",
-                        "users": list(self.clients.values())
-                    }))
-                elif data["type"] == "create_room":
-                    username = self.clients[websocket]
-                    room_id = data.get("room_id")
-                    room_name = data.get("room_name", f"{username}的房间")
-                    if self.create_room(room_id, room_name):
-                        await self.join_room(username, room_id)
-                        await self.send_room_info(websocket)
-                        await self.broadcast({
-                            "type": "system_message",
-                            "content": f"{username} 创建了房间 {room_name}",
-                            "timestamp": datetime.now().isoformat()
-                        })
                     else:
-                        await websocket.send(json.dumps({
-                            "type": "error",
-                            "message": "房间已存在"
-                        }))
-                elif data["type"] == "join_room":
-                    username = self.clients[websocket]
-                    room_id = data.get("room_id")
-                    if await self.join_room(username, room_id):
-                        await self.send_room_info(websocket)
-                        await self.broadcast({
-                            "type": "system_message",
-                            "content": f"{username} 加入了房间 {self.rooms[room_id]['name']}",
-                            "timestamp": datetime.now().isoformat()
-                        }, room_id)
-                    else:
-                        await websocket.send(json.dumps({
-                            "type": "error",
-                            "message": "房间不存在"
-                        }))
-                elif data["type"] == "file_upload":
-                    username = self.clients[websocket]
-                    room_id = self.user_rooms.get(username, "global")
-                    await self.handle_file(data, websocket, room_id)
-                # 房主特有功能
-                elif data["type"] == "kick_user" and username == self.owner:
-                    target = data["target"]
-                    # 找到目标用户的websocket连接
-                    target_ws = None
-                    for ws, name in self.clients.items():
-                        if name == target:
-                            target_ws = ws
-                            break
-                    
-                    if target_ws:
-                        await target_ws.send(json.dumps({
-                            "type": "kicked",
-                            "message": "您被房主踢出聊天室"
-                        }))
-                        await self.unregister(target_ws)
-                        # 添加到被踢出列表
-                        self.kicked_users.append({
-                            "username": target,
-                            "kicked_by": username,
-                            "timestamp": datetime.now().isoformat(),
-                            "reason": "被房主踢出聊天室"
-                        })
-                        
-                        await self.broadcast({
-                            "type": "system_message",
-                            "content": f"{target} 被房主踢出聊天室",
-                            "timestamp": datetime.now().isoformat()
-                        })
-                
-                elif data["type"] == "mute_user" and username == self.owner:
-                    target = data["target"]
-                    self.muted_users.add(target)
-                    await self.broadcast({
-                        "type": "system_message",
-                        "content": f"{target} 被房主禁言",
-                        "timestamp": datetime.now().isoformat()
-                    })
-                
-                elif data["type"] == "unmute_user" and username == self.owner:
-                    target = data["target"]
-                    if target in self.muted_users:
-                        self.muted_users.remove(target)
-                        await self.broadcast({
-                            "type": "system_message",
-                            "content": f"{target} 的禁言已被解除",
-                            "timestamp": datetime.now().isoformat()
-                        })
-                
-                elif data["type"] == "add_banned_word" and username == self.owner:
-                    word = data["word"]
-                    if word not in self.banned_words:
-                        self.banned_words.append(word)
-                        await websocket.send(json.dumps({
-                            "type": "banned_word_updated",
-                            "success": True,
-                            "message": f"屏蔽词 '{word}' 已添加"
-                        }))
-                
-                elif data["type"] == "remove_banned_word" and username == self.owner:
-                    word = data["word"]
-                    if word in self.banned_words:
-                        self.banned_words.remove(word)
-                        await websocket.send(json.dumps({
-                            "type": "banned_word_updated",
-                            "success": True,
-                            "message": f"屏蔽词 '{word}' 已移除"
-                        }))
-                
-                elif data["type"] == "owner_broadcast" and username == self.owner:
-                    content = data["content"]
-                    await self.broadcast({
-                        "type": "owner_broadcast",
-                        "content": content,
-                        "timestamp": datetime.now().isoformat()
-                    })
-                
-                elif data["type"] == "get_banned_words" and username == self.owner:
-                    # 房主获取屏蔽词列表
-                    await websocket.send(json.dumps({
-                        "type": "banned_words_list",
-                        "words": self.banned_words
-                    }))
-                elif data["type"] == "get_muted_users" and username == self.owner:
-                    # 房主获取被禁言用户列表
-                    await websocket.send(json.dumps({
-                        "type": "muted_users_list",
-                        "users": list(self.muted_users)
-                    }))
-                elif data["type"] == "get_kicked_users" and username == self.owner:
-                    # 房主获取被踢出用户列表
-                    await websocket.send(json.dumps({
-                        "type": "kicked_users_list",
-                        "users": self.kicked_users
-                    }))
-                elif data["type"] == "close_room" and username == self.owner:
-                    # 房主关闭房间
-                    room_id = data.get("room_id")
-                    if room_id and room_id != "global" and room_id in self.rooms:
-                        # 发送房间关闭通知
-                        await self.broadcast({
-                            "type": "system_message",
-                            "content": f"房间 {self.rooms[room_id]['name']} 已被房主关闭",
-                            "timestamp": datetime.now().isoformat()
-                        }, room_id)
-                        # 将房间成员移至全局聊天室
-                        for user_name in list(self.rooms[room_id]["members"]):
-                            await self.join_room(user_name, "global")
-                            # 通知用户房间已变更
-                            for ws, name in self.clients.items():
-                                if name == user_name:
-                                    await self.send_room_info(ws)
-                                    break
-                        # 删除房间
-                        del self.rooms[room_id]
-                        # 如果房间在过期检查列表中，也删除
-                        if room_id in self.expiring_rooms:
-                            del self.expiring_rooms[room_id]
-                
-                elif data["type"] == "set_preference":
-                    if username not in self.user_prefs:
-                        self.user_prefs[username] = {}
-                    self.user_prefs[username].update(data)
+                        data = self.codec.validate(wire.decode(raw))
+                except CodecError as e:
+                    self.send(websocket, {"type": "error", "message": str(e)})
+                    continue
+                await self.dispatch(websocket, data)
         except websockets.ConnectionClosed:
             pass
-        except json.decoder.JSONDecodeError:
-            logging.INFO(self, "JSON解析错误", "输入不能为空")
         finally:
             # 如果离开的用户是房主，清空房主状态
             if websocket in self.clients and self.clients[websocket] == self.owner:
                 self.owner = None
+                self.state_changed()
                 await self.broadcast({
                     "type": "owner_changed",
                     "owner": None
                 })
             await self.unregister(websocket)
+            await self.detach_uploads(websocket)
+            node = self.peer_sockets.pop(websocket, None)
+            if node is not None:
+                await self.bus.detach(node, websocket)
+            for ws, task in list(self.downloads.values()):
+                if ws is websocket:
+                    task.cancel()
+            self.compact.pop(websocket, None)
+            queue = self.queues.pop(websocket, None)
+            if queue is not None:
+                self.dropped_frames += queue.dropped
+                self.failed_frames += queue.failed
+                await queue.close()
+
+    def register_handler(self, msg_type, fn, owner_only=False, fields=(), registered=True):
+        """登记消息处理函数 fn(websocket, username, data)
+
+        owner_only 的消息只有房主能触发，registered 的消息只有注册后才能发送。
+        fields 为消息必须包含的字段: {字段: 类型}，或只检查是否存在的字段名列表。
+        插件可以直接调用它添加新的消息类型。
+        """
+        if not isinstance(fields, dict):
+            fields = dict.fromkeys(fields, object)
+        self.handlers[msg_type] = Handler(fn, owner_only, fields, registered)
+
+    async def dispatch(self, websocket, data):
+        msg_type = data.get("type")
+        handler = self.handlers.get(msg_type)
+        if handler is None:
+            return
+        username = self.clients.get(websocket)
+        if handler.owner_only and (username is None or username != self.owner):
+            return
+        if handler.registered and username is None:
+            self.send(websocket, {"type": "error", "message": "请先注册"})
+            return
+        missing = [field for field in handler.fields if field not in data]
+        if missing:
+            self.send(websocket, {
+                "type": "error",
+                "message": f"消息缺少字段: {', '.join(missing)}"
+            })
+            return
+        wrong = [field for field, kind in handler.fields.items() if not isinstance(data[field], kind)]
+        if wrong:
+            self.send(websocket, {
+                "type": "error",
+                "message": f"消息字段类型错误: {', '.join(wrong)}"
+            })
+            return
+        
+        self.m_received.inc(label=msg_type)
+        logpipe.bind(user=username, room=self.user_rooms.get(username), type=msg_type)
+        # 阻塞检测和采样分析器据此知道当前任务在处理哪条消息
+        task = asyncio.current_task()
+        self.handling[task] = (msg_type, username)
+        start = time.perf_counter()
+        try:
+            await handler.fn(websocket, username, data)
+        except MALFORMED_ERRORS as e:
+            log.warning(f"{msg_type} 消息格式错误: {e!r}")
+            self.send(websocket, {"type": "error", "message": f"消息格式错误: {msg_type}"})
+        finally:
+            elapsed = time.perf_counter() - start
+            self.handling.pop(task, None)
+            self.m_handler.observe(elapsed, msg_type)
+            if self.watchdog:
+                self.watchdog.handler_done(msg_type, username, elapsed)
+
+    # ---------- 消息处理 ----------
+    @handler("verify_owner", fields={"username": str, "password": str}, registered=False)
+    async def on_verify_owner(self, websocket, username, data):
+        password = data["password"]
+        # 已哈希的密码直接比较，否则先哈希再比较
+        if not data.get("is_hashed", False):
+            password = hashlib.sha256(password.encode()).hexdigest()
+        
+        if password == self.owner_password:
+            self.owner = data["username"]
+            self.state_changed()
+            self.send(websocket, {
+                "type": "owner_verified",
+                "success": True
+            })
+            await self.broadcast({
+                "type": "owner_changed",
+                "owner": self.owner
+            })
+        else:
+            self.send(websocket, {
+                "type": "owner_verified",
+                "success": False,
+                "message": "密码错误"
+            })
+
+    @handler("register", fields={"username": str}, registered=False)
+    async def on_register(self, websocket, username, data):
+        if username is not None:
+            # 同一连接重复注册会让房间索引中残留旧用户名对应的条目
+            self.send(websocket, {"type": "error", "message": "该连接已经注册"})
+            return
+        wire_formats = data.get("wire")
+        await self.register(websocket, data["username"], wire_formats if isinstance(wire_formats, list) else (),
+                            data.get("presence") == "delta")
+
+    @handler("message", fields={"content": str})
+    async def on_message(self, websocket, username, data):
+        content = data["content"]
+        if not self.check_can_send(websocket, username, content):
+            return
+        
+        room_id = self.user_rooms.get(username, "global")
+        message = {
+            "type": "message",
+            "username": username,
+            "content": content,
+            "timestamp": datetime.now().isoformat(),
+            "room": room_id,
+            "is_owner": username == self.owner
+        }
+        if self.history:
+            self.history.append(room_id, message)
+        await self.broadcast(message, room_id)
+
+    @handler("private_message", fields={"target": str, "content": str})
+    async def on_private_message(self, websocket, username, data):
+        target = data["target"]
+        content = data["content"]
+        if not self.check_can_send(websocket, username, content):
+            return
+        
+        target_ws = self.clients.find(target)
+        if target_ws or target in self.remote_users:
+            message = {
+                "type": "private_message",
+                "from": username,
+                "content": content,
+                "timestamp": datetime.now().isoformat(),
+                "room": self.user_rooms.get(username, "global")
+            }
+            if target_ws:
+                self.send(target_ws, message)
+            else:
+                # 目标用户连接在其他 worker 上
+                self.publish("private", target=target, message=message)
+            self.send(websocket, {
+                "type": "private_message_sent",
+                "to": target,
+                "content": content,
+                "timestamp": datetime.now().isoformat()
+            })
+
+    def check_can_send(self, websocket, username, content):
+        """检查禁言和屏蔽词，不能发送时回复原因并返回 False"""
+        if username in self.muted_users:
+            self.send(websocket, {
+                "type": "error",
+                "message": "您已被禁言，无法发送消息"
+            })
+            return False
+        if self.contains_banned_word(content):
+            self.send(websocket, {
+                "type": "banned_word",
+                "message": "您输入的内容含有屏蔽词，请重新输入"
+            })
+            return False
+        return True
+
+    @handler("get_history")
+    async def on_get_history(self, websocket, username, data):
+        # 获取当前房间的聊天记录，可按 id 或时间戳向前翻页
+        room_id = self.user_rooms.get(username, "global")
+        limit = max(1, min(int(data.get("limit", 50)), self.history_max_page))
+        before_id, before = data.get("before_id"), data.get("before")
+        # 这两个字段会直接作为 SQL 参数，类型不对时 sqlite3 抛出的异常不在 MALFORMED_ERRORS 中
+        wrong = [field for field, value, kind in (("before_id", before_id, int), ("before", before, str))
+                 if value is not None and (not isinstance(value, kind) or isinstance(value, bool))]
+        if wrong:
+            self.send(websocket, {
+                "type": "error",
+                "message": f"消息字段类型错误: {', '.join(wrong)}"
+            })
+            return
+        if before_id is not None:
+            # 超出 int64 的值 sqlite 会抛出 OverflowError，收紧到范围内不影响查询结果
+            before_id = max(INT64_MIN, min(before_id, INT64_MAX))
+        messages, has_more = [], False
+        if self.history:
+            messages, has_more = await self.history.fetch(room_id, limit, before_id, before)
+        self.send(websocket, {
+            "type": "history",
+            "room": room_id,
+            "messages": messages,
+            "has_more": has_more
+        })
+
+    @handler("get_users")
+    async def on_get_users(self, websocket, username, data):
+        # 客户端发现版本号不连续时也通过它重新获取完整列表
+        self.send(websocket, self.user_snapshot())
+
+    @handler("create_room", fields={"room_id": str})
+    async def on_create_room(self, websocket, username, data):
+        room_id = data["room_id"]
+        if not room_id:
+            self.send(websocket, {"type": "error", "message": "房间ID不能为空"})
+            return
+        room_name = data.get("room_name")
+        if not isinstance(room_name, str) or not room_name:
+            room_name = f"{username}的房间"
+        if self.create_room(room_id, room_name):
+            await self.join_room(username, room_id)
+            await self.send_room_info(websocket)
+            await self.broadcast({
+                "type": "system_message",
+                "content": f"{username} 创建了房间 {room_name}",
+                "timestamp": datetime.now().isoformat()
+            })
+        else:
+            self.send(websocket, {
+                "type": "error",
+                "message": "房间已存在"
+            })
+
+    @handler("join_room", fields={"room_id": str})
+    async def on_join_room(self, websocket, username, data):
+        room_id = data["room_id"]
+        if await self.join_room(username, room_id):
+            await self.send_room_info(websocket)
+            await self.broadcast({
+                "type": "system_message",
+                "content": f"{username} 加入了房间 {self.rooms[room_id]['name']}",
+                "timestamp": datetime.now().isoformat()
+            }, room_id)
+        else:
+            self.send(websocket, {
+                "type": "error",
+                "message": "房间不存在"
+            })
+
+    @handler("file_upload", fields={"filename": str, "content": str})
+    async def on_file_upload(self, websocket, username, data):
+        room_id = self.user_rooms.get(username, "global")
+        await self.handle_file(data, websocket, room_id)
+
+    @handler("set_preference")
+    async def on_set_preference(self, websocket, username, data):
+        if username not in self.user_prefs:
+            self.user_prefs[username] = {}
+        self.user_prefs[username].update(data)
+
+    # 房主特有功能
+    @handler("kick_user", owner_only=True, fields={"target": str})
+    async def on_kick_user(self, websocket, username, data):
+        target = data["target"]
+        if self.clients.has_user(target) or target in self.remote_users:
+            self.publish("kick", target=target)
+            await self.kick_connections(target)
+            # 添加到被踢出列表
+            self.kicked_users.append({
+                "username": target,
+                "kicked_by": username,
+                "timestamp": datetime.now().isoformat(),
+                "reason": "被房主踢出聊天室"
+            })
+            self.state_changed()
+            
+            await self.broadcast({
+                "type": "system_message",
+                "content": f"{target} 被房主踢出聊天室",
+                "timestamp": datetime.now().isoformat()
+            })
+
+    async def kick_connections(self, target):
+        # 断开目标用户在本 worker 上的所有连接 (发出 kicked 后由写任务关闭)
+        for target_ws in self.clients.connections(target):
+            self.send(target_ws, {
+                "type": "kicked",
+                "message": "您被房主踢出聊天室"
+            })
+            await self.unregister(target_ws)
+            queue = self.queues.get(target_ws)
+            if queue is not None:
+                queue.close_after(1008, "kicked")
+
+    @handler("mute_user", owner_only=True, fields={"target": str})
+    async def on_mute_user(self, websocket, username, data):
+        target = data["target"]
+        self.muted_users.add(target)
+        self.state_changed()
+        await self.broadcast({
+            "type": "system_message",
+            "content": f"{target} 被房主禁言",
+            "timestamp": datetime.now().isoformat()
+        })
+
+    @handler("unmute_user", owner_only=True, fields={"target": str})
+    async def on_unmute_user(self, websocket, username, data):
+        target = data["target"]
+        if target in self.muted_users:
+            self.muted_users.remove(target)
+            self.state_changed()
+            await self.broadcast({
+                "type": "system_message",
+                "content": f"{target} 的禁言已被解除",
+                "timestamp": datetime.now().isoformat()
+            })
+
+    @handler("add_banned_word", owner_only=True, fields={"word": str})
+    async def on_add_banned_word(self, websocket, username, data):
+        word = data["word"]
+        if word not in self.banned_words:
+            self.banned_words.append(word)
+            self.rebuild_banned_pattern()
+            self.state_changed()
+            self.send(websocket, {
+                "type": "banned_word_updated",
+                "success": True,
+                "message": f"屏蔽词 '{word}' 已添加"
+            })
+
+    @handler("remove_banned_word", owner_only=True, fields={"word": str})
+    async def on_remove_banned_word(self, websocket, username, data):
+        word = data["word"]
+        if word in self.banned_words:
+            self.banned_words.remove(word)
+            self.rebuild_banned_pattern()
+            self.state_changed()
+            self.send(websocket, {
+                "type": "banned_word_updated",
+                "success": True,
+                "message": f"屏蔽词 '{word}' 已移除"
+            })
+
+    @handler("owner_broadcast", owner_only=True, fields={"content": str})
+    async def on_owner_broadcast(self, websocket, username, data):
+        await self.broadcast({
+            "type": "owner_broadcast",
+            "content": data["content"],
+            "timestamp": datetime.now().isoformat()
+        })
+
+    @handler("get_banned_words", owner_only=True)
+    async def on_get_banned_words(self, websocket, username, data):
+        self.send(websocket, {
+            "type": "banned_words_list",
+            "words": self.banned_words
+        })
+
+    @handler("get_muted_users", owner_only=True)
+    async def on_get_muted_users(self, websocket, username, data):
+        self.send(websocket, {
+            "type": "muted_users_list",
+            "users": list(self.muted_users)
+        })
+
+    @handler("get_kicked_users", owner_only=True)
+    async def on_get_kicked_users(self, websocket, username, data):
+        self.send(websocket, {
+            "type": "kicked_users_list",
+            "users": self.kicked_users
+        })
+
+    @handler("get_queue_stats", owner_only=True)
+    async def on_get_queue_stats(self, websocket, username, data):
+        self.send(websocket, {
+            "type": "queue_stats",
+            **self.queue_stats()
+        })
+
+    @handler("get_handler_stats", owner_only=True)
+    async def on_get_handler_stats(self, websocket, username, data):
+        # 各消息类型的处理次数和平均耗时 (毫秒)
+        self.send(websocket, {
+            "type": "handler_stats",
+            "handlers": {
+                msg_type: {"count": stats["count"], "avg_ms": stats["avg"] * 1000}
+                for msg_type, stats in self.m_handler.snapshot().items()
+            }
+        })
+
+    @handler("get_stats", owner_only=True)
+    async def on_get_stats(self, websocket, username, data):
+        # 全部运行指标的快照，与 /metrics 接口的内容相同
+        self.send(websocket, {
+            "type": "stats",
+            "metrics": self.metrics.snapshot()
+        })
+
+    @handler("get_slow_events", owner_only=True)
+    async def on_get_slow_events(self, websocket, username, data):
+        # 最近的事件循环阻塞 (带调用栈) 和慢处理记录
+        self.send(websocket, {
+            "type": "slow_events",
+            "events": self.watchdog.recent(int(data.get("limit", 0))) if self.watchdog else []
+        })
+
+    @handler("start_profile", owner_only=True)
+    async def on_start_profile(self, websocket, username, data):
+        duration = self.start_profile(float(data.get("duration", 0)))
+        if duration is None:
+            self.send(websocket, {"type": "error", "message": "采样分析已在进行中"})
+            return
+        self.send(websocket, {
+            "type": "profile_started",
+            "duration": duration,
+            "interval_ms": self.cfg.getfloat("PROFILE", "interval_ms", fallback=5)
+        })
+
+    @handler("stop_profile", owner_only=True)
+    async def on_stop_profile(self, websocket, username, data):
+        result = await self.stop_profile()
+        if result is None:
+            self.send(websocket, {"type": "error", "message": "没有正在进行的采样分析"})
+            return
+        path, samples = result
+        self.send(websocket, {"type": "profile_saved", "path": str(path), "samples": samples})
+
+    @handler("close_room", owner_only=True)
+    async def on_close_room(self, websocket, username, data):
+        room_id = data.get("room_id")
+        if room_id and room_id != "global" and room_id in self.rooms:
+            await self.remove_room(room_id, f"房间 {self.rooms[room_id]['name']} 已被房主关闭")
 
     async def handle_file(self, data, websocket, room_id):
+        """旧版客户端的整文件上传 (十六进制编码)"""
         try:
             username = self.clients[websocket]
-            filename = data["filename"]
-            content = data["content"]
-            recv_dir = Path("recvfiles")
-            recv_dir.mkdir(exist_ok=True)
-            file_path = recv_dir / filename
-            with open(file_path, "wb") as f:
-                f.write(bytes.fromhex(content))
+            filename = Path(data["filename"]).name
+            # 大文件的十六进制解码也要几十毫秒，放到线程中执行
+            content = await asyncio.get_running_loop().run_in_executor(None, bytes.fromhex, data["content"])
+            self.m_file_bytes.inc(len(content), "in")
+            stored = await self.files.add_bytes(
+                content, filename, username, room_id, datetime.now().isoformat())
             
-            # 只发送给设置了接收文件的用户
-            targets = []
-            for ws, name in self.clients.items():
-                if name in self.rooms[room_id]["members"] and self.user_prefs.get(name, {}).get('receive_files', True):
-                    targets.append(ws)
-            
-            for ws in targets:
-                try:
-                    await ws.send(json.dumps({
-                        "type": "file_shared",
-                        "username": username,
-                        "filename": filename,
-                        "size": len(content) // 2,
-                        "timestamp": datetime.now().isoformat(),
-                        "room": room_id
-                    }))
-                except websockets.ConnectionClosed:
-                    await self.unregister(ws)
-            await websocket.send(json.dumps({"type": "file_progress", "progress": 100}))
+            await self.share_file(username, room_id, filename, stored["size"], stored["sha256"])
+            self.send(websocket, {"type": "file_progress", "progress": 100})
         except Exception as e:
-            await websocket.send(json.dumps({"type": "file_error", "message": str(e)}))
+            self.send(websocket, {"type": "file_error", "message": str(e)})
+
+    async def share_file(self, username, room_id, filename, size, sha256):
+        message = {
+            "type": "file_shared",
+            "username": username,
+            "filename": filename,
+            "size": size,
+            "sha256": sha256,
+            "timestamp": datetime.now().isoformat(),
+            "room": room_id
+        }
+        if self.history:
+            self.history.append(room_id, message)
+        self.publish("file_shared", room=room_id, message=message)
+        self.deliver_file_shared(room_id, message)
+
+    def deliver_file_shared(self, room_id, message):
+        # 只发送给设置了接收文件的用户
+        targets = [ws for ws in self.room_sockets.get(room_id, ())
+                   if self.user_prefs.get(self.clients[ws], {}).get('receive_files', True)]
+        self.deliver(targets, message)
+
+    @handler("file_upload_start", fields={"upload_id": str, "filename": str, "size": int})
+    async def on_start_upload(self, websocket, username, data):
+        """开始 (或续传) 一个分块上传，回复服务器已收到的字节数"""
+        upload_id = str(data.get("upload_id", ""))
+        if not re.fullmatch(r"[0-9a-f]{32}", upload_id):
+            self.send(websocket, {"type": "file_error", "message": "无效的上传ID"})
+            return
+        size = int(data["size"])
+        if size < 0:
+            self.send(websocket, {"type": "file_error", "upload_id": upload_id, "message": "无效的文件大小"})
+            return
+        if size > self.file_max_size:
+            self.send(websocket, {"type": "file_error", "upload_id": upload_id,
+                                  "message": f"文件大小超过 {self.file_max_size // 1024 // 1024}MB 限制"})
+            return
+        
+        filename = Path(data["filename"]).name
+        room_id = self.user_rooms.get(username, "global")
+        # 上传ID由客户端生成，只在同一用户的上传之间区分
+        key = (username, upload_id)
+        
+        # 服务器已有相同内容、且请求者本来就能下载它时直接秒传；
+        # 只知道哈希不能证明拥有内容，其他情况仍要完整上传
+        sha256 = data.get("sha256")
+        if sha256 and re.fullmatch(r"[0-9a-f]{64}", sha256) \
+                and await self.files.resolve(sha256=sha256, rooms=(room_id,), uploader=username) is not None:
+            upload = self.uploads.get(key)
+            if upload is not None:
+                await self.close_upload(upload)
+            stored = await self.files.link(sha256, filename, username, room_id, datetime.now().isoformat())
+            await self.share_file(username, room_id, filename, stored["size"], sha256)
+            self.send(websocket, {
+                "type": "file_progress",
+                "upload_id": upload_id,
+                "received": size,
+                "progress": 100
+            })
+            return
+        
+        upload = self.uploads.get(key)
+        if upload is None or upload["size"] != size:
+            if upload is not None:
+                await self.close_upload(upload)
+            pending = sum(u["size"] for u in self.uploads.values() if u["websocket"] is websocket)
+            if pending + size > self.connection_reserve:
+                self.send(websocket, {"type": "file_error", "upload_id": upload_id,
+                                      "message": "未完成的上传过多，请先完成或取消其他上传"})
+                return
+            try:
+                partial = await self.files.reserve_partial(username, upload_id, size)
+                fp, received, hasher = await asyncio.get_running_loop().run_in_executor(
+                    None, self._open_partial, partial, size)
+            except OSError as e:
+                self.send(websocket, {"type": "file_error", "upload_id": upload_id, "message": str(e)})
+                return
+            upload = {"id": upload_id, "key": key, "uploader": username, "size": size, "received": received,
+                      "path": partial, "file": fp, "hasher": hasher}
+            self.uploads[key] = upload
+        
+        # 续传时可能换了连接，以最新的连接为准
+        upload["websocket"] = websocket
+        upload["filename"] = filename
+        upload["sha256"] = sha256
+        # 上传期间切换房间时仍分享到开始上传时所在的房间
+        upload["room"] = room_id
+        self.send(websocket, {
+            "type": "file_upload_ready",
+            "upload_id": upload_id,
+            "offset": upload["received"]
+        })
+        if upload["received"] == size:
+            await self.finish_upload(upload)
+
+    def _open_partial(self, partial, size):
+        partial.parent.mkdir(parents=True, exist_ok=True)
+        received = partial.stat().st_size if partial.exists() else 0
+        if received > size:
+            received = 0
+        fp = open(partial, "r+b" if partial.exists() else "wb")
+        fp.truncate(received)
+        # 续传时先对已收到的部分计算哈希
+        hasher = hashlib.sha256()
+        while fp.tell() < received:
+            hasher.update(fp.read(min(DOWNLOAD_CHUNK_SIZE, received - fp.tell())))
+        fp.seek(received)
+        return fp, received, hasher
+
+    @staticmethod
+    def _write_chunk(upload, chunk):
+        upload["file"].write(chunk)
+        upload["hasher"].update(chunk)
+
+    async def handle_chunk(self, websocket, frame):
+        if len(frame) < CHUNK_HEADER.size:
+            return
+        raw_id, offset = CHUNK_HEADER.unpack_from(frame)
+        upload = self.uploads.get((self.clients.get(websocket), raw_id.hex()))
+        if upload is None or upload["websocket"] is not websocket:
+            self.send(websocket, {"type": "file_error", "message": "上传不存在或已失效"})
+            return
+        chunk = memoryview(frame)[CHUNK_HEADER.size:]
+        if offset != upload["received"] or offset + len(chunk) > upload["size"]:
+            self.send(websocket, {"type": "file_error", "upload_id": upload["id"], "message": "上传数据偏移错误"})
+            await self.close_upload(upload)
+            return
+        
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._write_chunk, upload, chunk)
+        except OSError as e:
+            self.send(websocket, {"type": "file_error", "upload_id": upload["id"], "message": str(e)})
+            await self.close_upload(upload)
+            return
+        upload["received"] += len(chunk)
+        self.m_file_bytes.inc(len(chunk), "in")
+        
+        if upload["received"] == upload["size"]:
+            await self.finish_upload(upload)
+        else:
+            self.send(websocket, {
+                "type": "file_progress",
+                "upload_id": upload["id"],
+                "received": upload["received"],
+                "progress": upload["received"] * 100 // upload["size"]
+            })
+
+    async def finish_upload(self, upload):
+        websocket = upload["websocket"]
+        await self.close_upload(upload)
+        sha256 = upload["hasher"].hexdigest()
+        if upload["sha256"] and upload["sha256"] != sha256:
+            # 内容与客户端声明的哈希不符，丢弃重新上传
+            await self.files.discard_partial(upload["path"])
+            self.send(websocket, {"type": "file_error", "upload_id": upload["id"], "message": "文件校验失败"})
+            return
+        
+        username = upload["uploader"]
+        room_id = upload["room"]
+        try:
+            await self.files.add_file(upload["path"], sha256, upload["filename"],
+                                      username, room_id, datetime.now().isoformat())
+        except OSError as e:
+            self.send(websocket, {"type": "file_error", "upload_id": upload["id"], "message": str(e)})
+            return
+        
+        await self.share_file(username, room_id, upload["filename"], upload["size"], sha256)
+        self.send(websocket, {
+            "type": "file_progress",
+            "upload_id": upload["id"],
+            "received": upload["size"],
+            "progress": 100
+        })
+
+    async def close_upload(self, upload):
+        self.uploads.pop(upload["key"], None)
+        await asyncio.get_running_loop().run_in_executor(None, upload["file"].close)
+
+    async def expire_partials(self):
+        """删除长时间没有继续的未完成上传，之后每小时检查一次
+
+        partial_ttl_hours 不大于 0 时不清理。
+        """
+        if self.partial_ttl <= 0:
+            return
+        self.partial_timer = asyncio.get_running_loop().call_later(
+            min(3600, max(60, self.partial_ttl)), self.spawn, self.expire_partials)
+        expired = set(await self.files.expire_partials(self.partial_ttl))
+        for upload in [u for u in self.uploads.values() if u["path"] in expired]:
+            await self.close_upload(upload)
+
+    async def detach_uploads(self, websocket):
+        """连接断开时关闭其上传文件，已收到的部分保留用于续传"""
+        for upload in [u for u in self.uploads.values() if u["websocket"] is websocket]:
+            await self.close_upload(upload)
+
+    @handler("file_request", fields={"download_id": str})
+    async def on_request_file(self, websocket, username, data):
+        """按 sha256 或文件名 (最近一次上传) 下载共享文件，可选 offset/length 指定字节范围
+
+        只能下载分享到自己当前所在房间的文件和自己上传的文件。
+        """
+        download_id = str(data.get("download_id", ""))
+        if not re.fullmatch(r"[0-9a-f]{32}", download_id) or download_id in self.downloads:
+            self.send(websocket, {"type": "file_error", "message": "无效的下载ID"})
+            return
+        filename = Path(data.get("filename", "")).name
+        sha256 = data.get("sha256")
+        if sha256 is not None and not re.fullmatch(r"[0-9a-f]{64}", str(sha256)):
+            sha256 = None
+        path = await self.files.resolve(sha256, filename, (self.user_rooms.get(username, "global"),), username)
+        if path is None:
+            self.send(websocket, {"type": "file_error", "download_id": download_id, "message": "文件不存在"})
+            return
+        task = asyncio.create_task(self.serve_file(
+            websocket, download_id, path, filename or path.name, data.get("offset", 0), data.get("length")))
+        self.downloads[download_id] = (websocket, task)
+        task.add_done_callback(lambda _: self.downloads.pop(download_id, None))
+
+    async def serve_file(self, websocket, download_id, path, filename, offset=0, length=None):
+        """把文件按块直接写到连接上
+
+        文件通过 mmap 映射后逐块切片，不会整体读入内存；
+        直接 await websocket.send 以获得背压，不经过有界发送队列 (下载数据不能丢帧)。
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            with open(path, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                offset = int(offset)
+                if not 0 <= offset <= size:
+                    raise ValueError("请求的范围超出文件大小")
+                if length is not None:
+                    length = int(length)
+                    if length < 0:
+                        raise ValueError("请求的长度不能为负数")
+                end = size if length is None else min(size, offset + length)
+                await websocket.send(self.codec.encode({
+                    "type": "file_download_start",
+                    "download_id": download_id,
+                    "filename": filename,
+                    "size": size,
+                    "offset": offset,
+                    "length": end - offset
+                }), text=True)
+                if end <= offset:
+                    return
+                raw_id = bytes.fromhex(download_id)
+                prefix = wire.CHUNK_PREFIX if websocket in self.compact else b""
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    pos = offset
+                    while pos < end:
+                        n = min(DOWNLOAD_CHUNK_SIZE, end - pos)
+                        # 切片可能触发缺页读盘，放到线程中执行
+                        chunk = await loop.run_in_executor(None, mm.__getitem__, slice(pos, pos + n))
+                        await websocket.send(prefix + CHUNK_HEADER.pack(raw_id, pos) + chunk)
+                        self.m_file_bytes.inc(n, "out")
+                        pos += n
+        except websockets.ConnectionClosed:
+            pass
+        except (OSError, ValueError) as e:
+            self.send(websocket, {"type": "file_error", "download_id": download_id, "message": str(e)})
+        except (TypeError, OverflowError):
+            self.send(websocket, {"type": "file_error", "download_id": download_id, "message": "无效的下载范围"})
+
+    # ---------- 多进程总线 ----------
+    def publish(self, op, **fields):
+        """把本地的状态变更发布给其他 worker"""
+        if self.bus is not None and not local_only.get():
+            self.bus.publish({"op": op, **fields})
+
+    def state_changed(self):
+        self.state_version = time.time()
+        self.publish_state()
+
+    def publish_state(self):
+        # 房主、禁言、屏蔽词等全局状态很小，每次变化都整体发布，以修改时间较新的为准
+        self.publish("state", owner=self.owner, muted_users=list(self.muted_users),
+                     banned_words=self.banned_words, kicked_users=self.kicked_users,
+                     version=self.state_version)
+
+    async def on_bus_message(self, message):
+        """应用其他 worker 发来的变更，期间的状态变化不会再次发布"""
+        fn = getattr(self, f"bus_{message.get('op')}", None)
+        if fn is None:
+            return
+        token = local_only.set(True)
+        try:
+            await fn(message)
+        except Exception as e:
+            log.error(f"处理总线消息 {message.get('op')} 失败: {e}")
+        finally:
+            local_only.reset(token)
+
+    @handler("peer_hello", fields={"node": str}, registered=False)
+    async def on_peer_hello(self, websocket, username, data):
+        """其他联邦节点连接进来"""
+        node = data["node"]
+        if not isinstance(self.bus, PeerBus) or not self.bus.check_secret(data.get("secret")) \
+                or node == self.bus.node or websocket in self.clients or websocket in self.peer_sockets:
+            self.send(websocket, {"type": "error", "message": "拒绝联邦连接"})
+            return
+        self.peer_sockets[websocket] = node
+        # 直接发送，保证 peer_welcome 先于任何 peer 消息到达
+        await websocket.send(self.codec.encode({"type": "peer_welcome", "node": self.bus.node}), text=True)
+        await self.bus.attach(node, websocket)
+
+    @handler("peer", fields={"message": dict}, registered=False)
+    async def on_peer(self, websocket, username, data):
+        node = self.peer_sockets.get(websocket)
+        if node is not None:
+            await self.bus.receive(node, data["message"])
+
+    async def bus_sync_request(self, message):
+        # 新启动的 worker 请求当前状态
+        local_only.set(False)
+        for room_id, room in self.rooms.items():
+            if room_id != "global":
+                self.publish("create_room", room=room_id, info=room | {"members": []})
+        for username in self.clients.usernames():
+            self.publish("presence", username=username, online=True, room=self.user_rooms.get(username))
+        self.publish_state()
+
+    async def bus_broadcast(self, message):
+        if not self.bus.shared_storage and self.history and message["message"].get("type") == "message":
+            # 联邦节点各自保存聊天记录 (id 按本节点重新分配)
+            self.history.append(message["room"], message["message"])
+        await self.broadcast(message["message"], message["room"])
+
+    async def bus_file_shared(self, message):
+        if not self.bus.shared_storage and self.history:
+            self.history.append(message["room"], message["message"])
+        self.deliver_file_shared(message["room"], message["message"])
+
+    async def bus_private(self, message):
+        target_ws = self.clients.find(message["target"])
+        if target_ws:
+            self.send(target_ws, message["message"])
+
+    async def bus_presence(self, message):
+        username = message["username"]
+        workers = self.remote_users.setdefault(username, set())
+        if message["online"]:
+            workers.add(message["worker"])
+            if username not in self.user_order:
+                await self.add_user(username)
+                self.presence_changed(username, False)
+            room_id = message.get("room")
+            if room_id in self.rooms and self.user_rooms.get(username) != room_id:
+                await self.join_room(username, room_id)
+        else:
+            workers.discard(message["worker"])
+            if not workers:
+                del self.remote_users[username]
+            self.drop_user(username)
+
+    async def bus_worker_down(self, message):
+        # worker 异常退出，移除它上面的用户 (联邦节点转告的断开消息用 down 指明是哪个节点)
+        down = message.get("down", message["worker"])
+        for username, workers in list(self.remote_users.items()):
+            if down in workers:
+                await self.bus_presence({"username": username, "online": False, "worker": down})
+
+    async def bus_state(self, message):
+        if message.get("version", 0) <= self.state_version:
+            return
+        self.state_version = message["version"]
+        self.owner = message["owner"]
+        self.muted_users = set(message["muted_users"])
+        self.banned_words = message["banned_words"]
+        self.kicked_users = message["kicked_users"]
+        self.rebuild_banned_pattern()
+
+    async def bus_create_room(self, message):
+        room_id = message["room"]
+        if room_id not in self.rooms:
+            self.rooms[room_id] = message["info"] | {"members": set(message["info"]["members"])}
+            self.room_sockets[room_id] = set()
+
+    async def bus_join_room(self, message):
+        await self.join_room(message["username"], message["room"])
+
+    async def bus_remove_room(self, message):
+        if message["room"] in self.rooms:
+            await self._remove_room(message["room"], message["notice"])
+
+    async def bus_kick(self, message):
+        # 被踢用户下线需要同步给其他 worker
+        local_only.set(False)
+        await self.kick_connections(message["target"])
 
     async def run(self):
-        logging.info(f"TouchFox V{SERVER_VERSION} 服务器监听 {self.host}:{self.port}")
-        # 启动房间过期检查任务
-        self.expiry_task = asyncio.create_task(self.check_room_expiry())
-        async with websockets.serve(self.handle_client, self.host, self.port):
-            await asyncio.Future()
-            # 取消过期检查任务
-            if self.expiry_task and not self.expiry_task.done():
-                self.expiry_task.cancel()
-                try:
-                    await self.expiry_task
-                except asyncio.CancelledError:
-                    pass
+        log.info(f"TouchFox V{SERVER_VERSION} 服务器监听 {self.host}:{self.port}")
+        await self.files.open()
+        await self.expire_partials()
+        if self.history:
+            await self.history.open()
+        if self.worker is not None:
+            self.bus = make_bus(self.cfg, self.worker[0])
+            await self.bus.connect(self.on_bus_message)
+            self.publish("sync_request")
+        elif self.cfg.getboolean("FEDERATION", "enabled", fallback=False):
+            if not self.cfg.get("FEDERATION", "secret", fallback=""):
+                raise ValueError("联邦模式必须设置 [FEDERATION] secret")
+            peers = [url.strip() for url in self.cfg.get("FEDERATION", "peers", fallback="").split(",") if url.strip()]
+            self.bus = PeerBus(self.cfg.get("FEDERATION", "node_id", fallback="") or f"{self.host}:{self.port}",
+                               peers, self.cfg.get("FEDERATION", "secret", fallback=""))
+            await self.bus.connect(self.on_bus_message)
+            log.info(f"联邦节点 {self.bus.node}，peers: {', '.join(peers) or '无'}")
+        if self.watchdog:
+            self.watchdog.start()
+        if hasattr(signal, "SIGUSR1"):
+            try:
+                asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, self.toggle_profile)
+            except (NotImplementedError, RuntimeError):
+                pass
+        monitor = asyncio.create_task(self.monitor_loop(self.cfg.getfloat("METRICS", "lag_interval", fallback=0.5)))
+        metrics_server = None
+        metrics_port = self.cfg.getint("METRICS", "port", fallback=0)
+        if metrics_port:
+            metrics_server = await metrics.serve(self.metrics, self.cfg.get("METRICS", "host", fallback="127.0.0.1"),
+                                                 metrics_port + (self.worker[0] if self.worker else 0))
+        try:
+            # 多进程模式下各 worker 通过 SO_REUSEPORT 监听同一端口，由内核分配连接
+            async with websockets.serve(self.handle_client, self.host, self.port,
+                                        reuse_port=self.worker is not None,
+                                        compression=None, extensions=server_extensions(self.cfg),
+                                        **tuning.serve_options(self.cfg)):
+                if self.worker is not None:
+                    # 主进程退出后总线断开，worker 随之退出
+                    await self.bus.wait_closed()
+                else:
+                    await asyncio.Future()
+        finally:
+            monitor.cancel()
+            if self.profiler:
+                await self.stop_profile()
+            if self.watchdog:
+                self.watchdog.stop()
+            if metrics_server:
+                metrics_server.close()
+            # 取消房间过期定时器
+            for room_id in list(self.room_timers):
+                self.cancel_room_expiry(room_id)
+            if self.presence_timer:
+                self.presence_timer.cancel()
+            if self.partial_timer:
+                self.partial_timer.cancel()
+            # 把缓冲中的聊天记录写入磁盘
+            if self.history:
+                await self.history.close()
+            await self.files.close()
+            if self.bus:
+                await self.bus.close()
+
+
+def worker_main(host, port, owner_password, settings, index, count):
+    """多进程模式中 worker 进程的入口"""
+    cfg = configparser.ConfigParser()
+    cfg.read_dict(settings)
+    logpipe.setup(cfg, index)
+    try:
+        tuning.run(ChatServer(host, port, owner_password, cfg, (index, count)).run(), cfg)
+    except KeyboardInterrupt:
+        pass
+
+
+async def run_workers(host, port, owner_password, cfg, count):
+    """启动 count 个 worker 进程共同监听同一端口，主进程负责本机总线"""
+    hub = None
+    if cfg.get("BUS", "backend", fallback="local") != "redis":
+        path = cfg.get("BUS", "path", fallback="") or os.path.join(tempfile.gettempdir(), f"touchfox-{port}.sock")
+        if os.path.exists(path):
+            os.unlink(path)
+        cfg["BUS"]["path"] = path
+        hub = BusHub(path)
+        await hub.start()
+    
+    settings = {section: dict(cfg[section]) for section in cfg.sections()}
+    ctx = multiprocessing.get_context("spawn")
+    processes = [ctx.Process(target=worker_main, name=f"touchfox-worker-{i}",
+                             args=(host, port, owner_password, settings, i, count))
+                 for i in range(count)]
+    for p in processes:
+        p.start()
+    log.info(f"已启动 {count} 个 worker 进程")
+    loop = asyncio.get_running_loop()
+    try:
+        await asyncio.gather(*(loop.run_in_executor(None, p.join) for p in processes))
+    finally:
+        for p in processes:
+            if p.is_alive():
+                p.terminate()
+        if hub:
+            await hub.close()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="TouchFox 服务器")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker 进程数，大于1时多个进程通过 SO_REUSEPORT 共享端口 (仅 Linux/BSD)")
+    parser.add_argument("--uvloop", action="store_true", help="使用 uvloop 事件循环 (同 [TUNING] uvloop = true)")
+    args = parser.parse_args()
+    if args.workers > 1 and not hasattr(socket, "SO_REUSEPORT"):
+        log.error("当前系统不支持 SO_REUSEPORT，无法使用多进程模式")
+        exit(1)
     config = load_config()
     if config is None:
         exit(1)
-    host, port, owner_password = config
+    host, port, owner_password, cfg = config
+    logpipe.setup(cfg)
+    if args.workers > 1 and cfg.getboolean("FEDERATION", "enabled"):
+        log.error("联邦模式只能以单进程运行，请去掉 --workers 参数")
+        exit(1)
+    if cfg.getboolean("FEDERATION", "enabled") and not cfg.get("FEDERATION", "secret"):
+        log.error("联邦模式必须设置 [FEDERATION] secret，否则任何客户端都能冒充节点")
+        exit(1)
+    if args.uvloop:
+        cfg["TUNING"]["uvloop"] = "true"
     try:
-        asyncio.run(ChatServer(host, port, owner_password).run())
+        if args.workers > 1:
+            asyncio.run(run_workers(host, port, owner_password, cfg, args.workers))
+        else:
+            tuning.run(ChatServer(host, port, owner_password, cfg).run(), cfg)
     except OSError as e:
-        logging.error(f"端口已被占用,将自动退出...")
+        log.error(f"端口已被占用,将自动退出...")
         exit(1)
     except Exception as e:
-        logging.error(f"未知错误导致服务器启动失败: {e}")
+        log.error(f"未知错误导致服务器启动失败: {e}")
         exit(1)
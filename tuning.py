@@ -0,0 +1,76 @@
+# region COPYRIGHT
+
+# Copyright © 2025 [MinerMouse]
+# Luogu UID:1203704
+# Portions Copyright © 2025 ILoveScratch2
+
+# endregion
+
+# tuning.py
+
+"""事件循环与连接参数 (server.ini 的 [TUNING] 段)
+
+默认值与 websockets / asyncio 自身的默认值相同，不修改配置时行为不变。
+括号中是用 benchmark.py 的负载在单核机器上测得的影响 (100 个客户端，10 个发送者各 20 条/秒，
+服务器与压测进程共用一个核心，差别在 10% 以内的都视为噪声)。
+
+- uvloop: 使用 uvloop 事件循环 (需要安装 uvloop，Windows 不支持)
+  (每条消息的服务器 CPU 时间没有可测出的差别，时间主要花在编码、压缩和 websockets
+  的帧处理上，而不是事件循环本身)
+- backlog: 监听 socket 的连接等待队列长度，大量客户端同时重连时调大可避免连接被拒
+  (不影响稳态吞吐量)
+- max_size: 单条消息的最大字节数，none 为不限制；超过的连接会被关闭
+- max_queue: 每个连接已接收但还未处理的消息数上限，达到后暂停读取该连接，
+  none 为不限制 (处理跟不上时内存不受控) (调到 128 没有可测出的差别)
+- ping_interval / ping_timeout: 心跳间隔和超时秒数，none 为关闭心跳；
+  调小可以更快发现断线的客户端，但每次心跳都要处理所有连接
+  (1000 个空闲连接: 默认 20 秒约占 1% CPU，间隔 1 秒约占 14% CPU)
+- write_limit: 每个连接的写缓冲区上限 (字节)，超过后该连接的发送任务等待缓冲区排空；
+  调大可以减少慢客户端上的等待，代价是每个连接占用更多内存
+  (调到 262144 没有可测出的差别)
+"""
+
+import asyncio, logging
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+SECTION = "TUNING"
+
+DEFAULTS = {"uvloop": "false", "backlog": "100", "max_size": "1048576", "max_queue": "16",
+            "ping_interval": "20", "ping_timeout": "20", "write_limit": "32768"}
+
+
+def _optional(cfg, key, kind):
+    """读取可以设为 none 的数值选项"""
+    value = cfg.get(SECTION, key, fallback=DEFAULTS[key]).strip().lower()
+    if value in ("none", ""):
+        return None
+    try:
+        return kind(value)
+    except ValueError:
+        logging.warning(f"无效的 {key} 设置 {value}，使用默认值 {DEFAULTS[key]}")
+        return kind(DEFAULTS[key])
+
+
+def serve_options(cfg):
+    """返回传给 websockets.serve 的连接参数"""
+    return {
+        "backlog": cfg.getint(SECTION, "backlog", fallback=100),
+        "max_size": _optional(cfg, "max_size", int),
+        "max_queue": _optional(cfg, "max_queue", int),
+        "ping_interval": _optional(cfg, "ping_interval", float),
+        "ping_timeout": _optional(cfg, "ping_timeout", float),
+        "write_limit": cfg.getint(SECTION, "write_limit", fallback=32768),
+    }
+
+
+def run(main, cfg):
+    """运行协程 main，按配置选择事件循环"""
+    if cfg.getboolean(SECTION, "uvloop", fallback=False):
+        if uvloop is not None:
+            return uvloop.run(main)
+        logging.warning("未安装 uvloop，使用默认事件循环")
+    return asyncio.run(main)
@@ -0,0 +1,152 @@
+# region COPYRIGHT
+
+# Copyright © 2025 [MinerMouse]
+# Luogu UID:1203704
+# Portions Copyright © 2025 ILoveScratch2
+
+# endregion
+
+# wire.py
+
+"""紧凑二进制协议 (MessagePack)
+
+注册时客户端在 register 中声明 "wire": ["msgpack"]，服务器在 api_version
+中回复 "wire": "msgpack" 表示同意。此后该连接上的消息以二进制帧发送:
+
+- 消息帧: msgpack 编码的 [类型标签, 字段]，常用消息类型使用 TYPE_TAGS 中的整数标签
+- 服务器发出的用户名、房间ID等字段替换为整数ID，首次使用前先发送
+  [INTERN, {ID: 字符串}] 定义帧
+- 分块传输帧: CHUNK_PREFIX + 原有的传输帧头 + 数据
+  (0xC1 在 MessagePack 中永不使用，因此不会与消息帧混淆)
+
+文本帧始终是 JSON，旧客户端不受影响。
+"""
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from codec import CodecError
+
+WIRE_NAME = "msgpack"
+CHUNK_PREFIX = b"\xc1"
+INTERN = 0
+MAX_INTERNED = 65536
+
+# 标签从1开始，0 保留给定义帧；只能在末尾追加
+TYPE_TAGS = (
+    "message", "user_list", "room_info", "system_message", "private_message",
+    "private_message_sent", "api_version", "owner_changed", "owner_broadcast",
+    "file_shared", "file_progress", "file_error", "error", "history", "register",
+    "get_history", "get_users", "create_room", "join_room", "set_preference",
+    "file_upload_start", "file_upload_ready", "file_request", "file_download_start",
+    "banned_word", "kicked", "user_joined", "user_left",
+    "user_presence",
+)
+TAG_OF = {name: i for i, name in enumerate(TYPE_TAGS, 1)}
+NAME_OF = {i: name for name, i in TAG_OF.items()}
+
+# 服务器发出的消息中会被替换为整数ID的字段
+INTERN_FIELDS = ("username", "from", "to", "room", "current_room", "owner")
+INTERN_LIST_FIELDS = ("users", "joined", "left")
+
+
+def available():
+    return msgpack is not None
+
+
+class InternTable:
+    """服务器全局的 字符串 -> 整数ID 表，所有连接共用同一套ID，
+    这样同一条广播只需编码一次；每个连接只需记住自己已收到哪些定义。"""
+
+    def __init__(self):
+        self.ids = {}
+        self.strings = []
+
+    def intern(self, value):
+        ident = self.ids.get(value)
+        if ident is None:
+            if len(self.strings) >= MAX_INTERNED:
+                return None
+            ident = self.ids[value] = len(self.strings)
+            self.strings.append(value)
+        return ident
+
+    def encode(self, message):
+        """编码一条消息，返回 (帧, 用到的ID集合)"""
+        body = dict(message)
+        msg_type = body.pop("type", None)
+        used = set()
+        for field in INTERN_FIELDS:
+            value = body.get(field)
+            if isinstance(value, str):
+                ident = self.intern(value)
+                if ident is not None:
+                    body[field] = ident
+                    used.add(ident)
+        for field in INTERN_LIST_FIELDS:
+            values = body.get(field)
+            if isinstance(values, list) and all(isinstance(v, str) for v in values):
+                idents = [self.intern(v) for v in values]
+                if None not in idents:
+                    body[field] = idents
+                    used.update(idents)
+        return msgpack.packb([TAG_OF.get(msg_type, msg_type), body]), used
+
+    def definitions(self, idents):
+        return msgpack.packb([INTERN, {i: self.strings[i] for i in idents}])
+
+
+def encode(message):
+    """不做字符串替换的编码 (客户端发往服务器)"""
+    body = dict(message)
+    msg_type = body.pop("type", None)
+    return msgpack.packb([TAG_OF.get(msg_type, msg_type), body])
+
+
+def _unpack(frame):
+    try:
+        tag, body = msgpack.unpackb(frame, strict_map_key=False)
+    except (ValueError, TypeError) as e:
+        raise CodecError(f"无法解析消息: {e}") from None
+    if not isinstance(body, dict):
+        raise CodecError("消息必须是对象")
+    return tag, body
+
+
+def decode(frame, strings=None):
+    """解码一条消息帧，strings 为已收到的 ID -> 字符串定义"""
+    return _resolve(*_unpack(frame), strings)
+
+
+def _resolve(tag, body, strings):
+    if strings is not None:
+        try:
+            for field in INTERN_FIELDS:
+                value = body.get(field)
+                if isinstance(value, int) and not isinstance(value, bool):
+                    body[field] = strings[value]
+            for field in INTERN_LIST_FIELDS:
+                values = body.get(field)
+                if isinstance(values, list):
+                    body[field] = [strings[v] if isinstance(v, int) else v for v in values]
+        except KeyError as e:
+            raise CodecError(f"未定义的字符串ID {e}") from None
+    body["type"] = NAME_OF.get(tag, tag)
+    return body
+
+
+class Decoder:
+    """客户端使用: 解码服务器发来的紧凑帧，维护字符串ID定义"""
+
+    def __init__(self):
+        self.strings = {}
+
+    def decode(self, frame):
+        """返回消息 dict；定义帧返回 None"""
+        tag, body = _unpack(frame)
+        if tag == INTERN:
+            self.strings.update(body)
+            return None
+        return _resolve(tag, body, self.strings)